@@ -18,12 +18,13 @@ def cyclegan(model, img_path):
     if model not in model_mapping:
         raise ValueError("Model not recognized or supported.")
 
-    cur_path = os.getcwd()
-    os.chdir("F:/CS 543/Project/CycleGan")
+    # test.py runs in the CycleGan directory, passed as the subprocess cwd instead of changing the cwd of the
+    # whole process, which other threads of the caller may be using
+    cyclegan_dir = os.path.dirname(os.path.abspath(__file__))
 
     model_name = model_mapping[model]
     python_executable = "F:/CS 543/Project/venv/Scripts/python.exe"  # Path to Python executable in your virtual environment
-    test_script = "F:/CS 543/Project/CycleGan/test.py"
+    test_script = os.path.join(cyclegan_dir, "test.py")
     if model_name == "im2seg":
         command = [
             python_executable,  # Use Python executable from virtual environment
@@ -59,11 +60,11 @@ def cyclegan(model, img_path):
             "--preprocess",
             "resize_and_crop",
         ]
-    # Change to the CycleGan directory
     try:
         # Execute the command
         subprocess.run(
             command,
+            cwd=cyclegan_dir,
             check=True,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
@@ -75,8 +76,6 @@ def cyclegan(model, img_path):
         print("STDOUT:", e.stdout)
         print("STDERR:", e.stderr)
         raise
-    finally:
-        os.chdir(cur_path)
 
 
 # if __name__ == "__main__":
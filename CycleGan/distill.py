@@ -0,0 +1,121 @@
+"""Distill a trained generator into a smaller student generator, then report its latency and fidelity.
+
+The teacher is [checkpoints_dir]/[teacher_name]/[teacher_epoch]_net_G.pth, e.g. the checkpoint used by test.py.
+The student is saved in [checkpoints_dir]/[name] and is loaded by test.py with the student generator options:
+    python distill.py --dataroot ./datasets/summer --name summer2winter_student --teacher_name summer2winter --netG resnet_4blocks_dw --ngf 32
+    python test.py --dataroot image.jpg --name summer2winter_student --model test --no_dropout --netG resnet_4blocks_dw --ngf 32
+"""
+import os
+import time
+import torch
+from options.distill_options import DistillOptions
+from data import create_dataset
+from models import create_model
+
+
+def time_generator(net, images, repeats=3):
+    """Return the median time in ms of a forward pass of <net> on each image"""
+    timings = []
+    with torch.no_grad():
+        net(images[0])  # warm up
+        for image in images:
+            for _ in range(repeats):
+                if image.is_cuda:
+                    torch.cuda.synchronize()
+                start = time.perf_counter()
+                net(image)
+                if image.is_cuda:
+                    torch.cuda.synchronize()
+                timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def evaluate(model, dataset, num_report):
+    """Compare the student with the teacher on up to <num_report> images.
+
+    Returns a dict with the parameter counts, the latencies in ms, the mean L1 error and the PSNR in dB, in range [0,1].
+    """
+    images = []
+    l1_errors = []
+    squared_errors = []
+    for i, data in enumerate(dataset):
+        if i >= num_report:
+            break
+        model.set_input(data)
+        model.test()
+        difference = (model.fake - model.fake_teacher) * 0.5  # [-1,1] outputs, errors in range [0,1]
+        l1_errors.append(difference.abs().mean().item())
+        squared_errors.append(difference.pow(2).mean().item())
+        images.append(model.real[:1])
+    mse = max(sum(squared_errors) / max(len(squared_errors), 1), 1e-10)
+    teacher_params, student_params = model.count_parameters()
+    teacher_ms = time_generator(model.netG_teacher, images)
+    student_ms = time_generator(model.netG, images)
+    return {
+        'teacher_params': teacher_params,
+        'student_params': student_params,
+        'teacher_ms': teacher_ms,
+        'student_ms': student_ms,
+        'speedup': teacher_ms / student_ms,
+        'l1': sum(l1_errors) / max(len(l1_errors), 1),
+        'psnr': 10 * torch.log10(torch.tensor(1.0 / mse)).item(),
+        'images': len(images),
+    }
+
+
+def write_report(opt, results):
+    """Append a row to the report table in [checkpoints_dir]/[report_file]"""
+    report_path = os.path.join(opt.checkpoints_dir, opt.report_file)
+    header = '| student | teacher | netG | ngf | params | ms/image | speedup | L1 | PSNR (dB) | images |\n' \
+             '|---|---|---|---|---|---|---|---|---|---|\n'
+    row = '| {} | {} | {} | {} | {:.2f}M / {:.2f}M | {:.1f} / {:.1f} | {:.2f}x | {:.4f} | {:.2f} | {} |\n'.format(
+        opt.name, opt.teacher_name, opt.netG, opt.ngf,
+        results['student_params'] / 1e6, results['teacher_params'] / 1e6,
+        results['student_ms'], results['teacher_ms'], results['speedup'],
+        results['l1'], results['psnr'], results['images'])
+    new_file = not os.path.isfile(report_path)
+    with open(report_path, 'a') as report_file:
+        if new_file:
+            report_file.write(header)
+        report_file.write(row)
+    print(header + row, end='')
+    print('Report saved: %s' % report_path)
+
+
+if __name__ == '__main__':
+    opt = DistillOptions().parse()
+    dataset = create_dataset(opt)
+    print('The number of training images = %d' % len(dataset))
+
+    model = create_model(opt)
+    model.setup(opt)
+    total_iters = 0
+
+    for epoch in range(opt.epoch_count, opt.n_epochs + opt.n_epochs_decay + 1):
+        epoch_start_time = time.time()
+        epoch_iter = 0
+        for i, data in enumerate(dataset):
+            total_iters += opt.batch_size
+            epoch_iter += opt.batch_size
+            model.set_input(data)
+            model.optimize_parameters()
+            if total_iters % opt.print_freq == 0:
+                losses = model.get_current_losses()
+                print('(epoch: %d, iters: %d) %s' % (epoch, epoch_iter,
+                                                     ' '.join('%s: %.4f' % (k, v) for k, v in losses.items())))
+
+        model.save_networks('latest')
+        if epoch % opt.save_epoch_freq == 0:
+            print('saving the model at the end of epoch %d, iters %d' % (epoch, total_iters))
+            model.save_networks(epoch)
+        print('End of epoch %d / %d \t Time Taken: %d sec' % (epoch, opt.n_epochs + opt.n_epochs_decay, time.time() - epoch_start_time))
+        model.update_learning_rate()
+
+    # the report uses the images in a fixed order, without the random flips of the training
+    opt.serial_batches = True
+    opt.no_flip = True
+    opt.batch_size = 1
+    write_report(opt, evaluate(model, create_dataset(opt), opt.num_report))
+    print('Test the student with: --name %s --model test --netG %s --ngf %d --norm %s%s' % (
+        opt.name, opt.netG, opt.ngf, opt.norm, ' --no_dropout' if opt.no_dropout else ''))
@@ -133,20 +133,22 @@ class BaseModel(ABC):
             if isinstance(name, str):
                 load_filename = "%s_net_%s.pth" % (epoch, name)
                 load_path = os.path.join(self.save_dir, load_filename)
-                net = getattr(self, "net" + name)
-                if isinstance(net, torch.nn.DataParallel):
-                    net = net.module
-                state_dict = torch.load(load_path, map_location=str(self.device))
-                if hasattr(state_dict, "_metadata"):
-                    del state_dict._metadata
-
-                for key in list(
-                    state_dict.keys()
-                ): 
-                    self.__patch_instance_norm_state_dict(
-                        state_dict, net, key.split(".")
-                    )
-                net.load_state_dict(state_dict)
+                self.load_network(getattr(self, "net" + name), load_path)
+
+    def load_network(self, net, load_path):
+        if isinstance(net, torch.nn.DataParallel):
+            net = net.module
+        state_dict = torch.load(load_path, map_location=str(self.device))
+        if hasattr(state_dict, "_metadata"):
+            del state_dict._metadata
+
+        for key in list(
+            state_dict.keys()
+        ): 
+            self.__patch_instance_norm_state_dict(
+                state_dict, net, key.split(".")
+            )
+        net.load_state_dict(state_dict)
 
     def print_networks(self, verbose):
         for name in self.model_names:
@@ -0,0 +1,99 @@
+import os
+import torch
+from .base_model import BaseModel
+from . import networks
+
+
+class DistillModel(BaseModel):
+    """ This class trains a small student generator to reproduce the outputs of a trained generator (the teacher).
+
+    It only needs unlabeled images from one domain ('--dataset_mode single'): the teacher output is the target of an L1 loss.
+    The student is saved as [epoch]_net_G.pth in checkpoints_dir/name, so <TestModel> loads it with the student
+    options (--netG, --ngf, --norm, --no_dropout).
+
+    Example, a resnet student of the summer2winter teacher:
+        python distill.py --dataroot ./datasets/summer --name summer2winter_student --teacher_name summer2winter --netG resnet_4blocks_dw --ngf 32
+    """
+    @staticmethod
+    def modify_commandline_options(parser, is_train=True):
+        """Add new model-specific options, and rewrite default values for existing options.
+
+        Parameters:
+            parser          -- original option parser
+            is_train (bool) -- whether training phase or test phase. You can use this flag to add training-specific or test-specific options.
+
+        Returns:
+            the modified parser.
+
+        The student options are the usual generator options, the teacher options are prefixed with 'teacher_'.
+        """
+        assert is_train, 'DistillModel cannot be used during test time, use TestModel with the student checkpoint'
+        parser.set_defaults(dataset_mode='single', netG='resnet_4blocks_dw', ngf=32, no_dropout=True)
+        parser.add_argument('--teacher_name', type=str, required=True, help='name of the teacher experiment: [checkpoints_dir]/[teacher_name]/[teacher_epoch]_net_G.pth is loaded')
+        parser.add_argument('--teacher_epoch', type=str, default='latest', help='which epoch of the teacher to load')
+        parser.add_argument('--teacher_netG', type=str, default='resnet_9blocks', help='teacher generator architecture [resnet_9blocks | resnet_6blocks | unet_256 | unet_128]')
+        parser.add_argument('--teacher_ngf', type=int, default=64, help='# of teacher gen filters in the last conv layer')
+        parser.add_argument('--teacher_norm', type=str, default='instance', help='teacher normalization [instance | batch | none]')
+        parser.add_argument('--teacher_dropout', action='store_true', help='the teacher has dropout layers (it was used without --no_dropout)')
+        parser.add_argument('--teacher_eval', action='store_true', help='run the teacher in eval mode. By default it runs like TestModel without --eval')
+        return parser
+
+    def __init__(self, opt):
+        """Initialize the distill class.
+
+        Parameters:
+            opt (Option class)-- stores all the experiment flags; needs to be a subclass of BaseOptions
+        """
+        BaseModel.__init__(self, opt)
+        # specify the training losses you want to print out. The training/test scripts  will call <BaseModel.get_current_losses>
+        self.loss_names = ['G_L1']
+        # specify the images you want to save/display. The training/test scripts  will call <BaseModel.get_current_visuals>
+        self.visual_names = ['real', 'fake_teacher', 'fake']
+        # only the student is saved, under the name TestModel loads
+        self.model_names = ['G']
+        self.netG = networks.define_G(opt.input_nc, opt.output_nc, opt.ngf, opt.netG,
+                                      opt.norm, not opt.no_dropout, opt.init_type, opt.init_gain, self.gpu_ids)
+        self.netG_teacher = networks.define_G(opt.input_nc, opt.output_nc, opt.teacher_ngf, opt.teacher_netG,
+                                              opt.teacher_norm, opt.teacher_dropout, opt.init_type, opt.init_gain, self.gpu_ids)
+        self.load_network(self.netG_teacher, self.teacher_path())
+        if opt.teacher_eval:
+            self.netG_teacher.eval()
+        self.set_requires_grad(self.netG_teacher, False)
+
+        self.criterionL1 = torch.nn.L1Loss()
+        self.optimizer_G = torch.optim.Adam(self.netG.parameters(), lr=opt.lr, betas=(opt.beta1, 0.999))
+        self.optimizers.append(self.optimizer_G)
+
+    def teacher_path(self):
+        return os.path.join(self.opt.checkpoints_dir, self.opt.teacher_name, '%s_net_G.pth' % self.opt.teacher_epoch)
+
+    def set_input(self, input):
+        """Unpack input data from the dataloader and perform necessary pre-processing steps.
+
+        Parameters:
+            input: a dictionary that contains the data itself and its metadata information.
+        """
+        self.real = input['A'].to(self.device)
+        self.image_paths = input['A_paths']
+
+    def forward(self):
+        """Run forward pass; called by both functions <optimize_parameters> and <test>."""
+        with torch.no_grad():
+            self.fake_teacher = self.netG_teacher(self.real)  # G_teacher(real)
+        self.fake = self.netG(self.real)  # G(real)
+
+    def backward_G(self):
+        """Calculate the L1 loss between the student and the teacher outputs"""
+        self.loss_G_L1 = self.criterionL1(self.fake, self.fake_teacher)
+        self.loss_G_L1.backward()
+
+    def optimize_parameters(self):
+        self.forward()
+        self.optimizer_G.zero_grad()
+        self.backward_G()
+        self.optimizer_G.step()
+
+    def count_parameters(self):
+        """Return the number of parameters of the teacher and of the student"""
+        return (sum(p.numel() for p in self.netG_teacher.parameters()),
+                sum(p.numel() for p in self.netG.parameters()))
@@ -0,0 +1,30 @@
+from .base_options import BaseOptions
+
+
+class DistillOptions(BaseOptions):
+    """This class includes the options of distill.py, which trains a student generator against a teacher checkpoint.
+
+    It also includes shared options defined in BaseOptions, and the teacher options of <DistillModel>.
+    """
+
+    def initialize(self, parser):
+        parser = BaseOptions.initialize(self, parser)  # define shared options
+        parser.add_argument('--phase', type=str, default='train', help='train, val, test, etc')
+        # training parameters
+        parser.add_argument('--n_epochs', type=int, default=10, help='number of epochs with the initial learning rate')
+        parser.add_argument('--n_epochs_decay', type=int, default=10, help='number of epochs to linearly decay learning rate to zero')
+        parser.add_argument('--beta1', type=float, default=0.5, help='momentum term of adam')
+        parser.add_argument('--lr', type=float, default=0.0002, help='initial learning rate for adam')
+        parser.add_argument('--lr_policy', type=str, default='linear', help='learning rate policy. [linear | step | plateau | cosine]')
+        parser.add_argument('--lr_decay_iters', type=int, default=50, help='multiply by a gamma every lr_decay_iters iterations')
+        parser.add_argument('--epoch_count', type=int, default=1, help='the starting epoch count, we save the model by <epoch_count>, <epoch_count>+<save_latest_freq>, ...')
+        parser.add_argument('--continue_train', action='store_true', help='continue training: load the latest student')
+        # saving and display parameters
+        parser.add_argument('--print_freq', type=int, default=100, help='frequency of showing training results on console')
+        parser.add_argument('--save_epoch_freq', type=int, default=5, help='frequency of saving checkpoints at the end of epochs')
+        # report parameters
+        parser.add_argument('--num_report', type=int, default=50, help='how many images are used for the latency/quality report')
+        parser.add_argument('--report_file', type=str, default='distill_report.txt', help='the report table is appended to [checkpoints_dir]/[report_file]')
+        parser.set_defaults(model='distill')
+        self.isTrain = True
+        return parser
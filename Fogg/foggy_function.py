@@ -4,6 +4,10 @@ from lib.dataset import DatasetInitializer
 from lib.models import ModelsBuilder
 from lib.train import Trainer
 from lib.plot import plot_clear2fog_intensity
+from lib.transmission import clear2fog_full_resolution, clear2fog_native_aspect_ratio
+from lib import analytic_fog
+from lib.bundle import load_bundle_weights
+from lib.distill import STUDENT_WEIGHTS_FILENAME, STUDENT_GROUP
 
 datasetInit = DatasetInitializer(256, 256)
 models_builder = ModelsBuilder()
@@ -11,12 +15,25 @@ models_builder = ModelsBuilder()
 use_transmission_map = False  # @param{type: "boolean"}
 use_gauss_filter = False  # @param{type: "boolean"}
 use_resize_conv = False  # @param{type: "boolean"}
+# Replaces generator_clear2fog by its distilled student (lib.distill), several times faster with a slightly
+# different fog. Its weights are STUDENT_WEIGHTS_FILENAME in weights_path
+use_student_generator = False  # @param{type: "boolean"}
 
-generator_clear2fog = models_builder.build_generator(
-    use_transmission_map=use_transmission_map,
-    use_gauss_filter=use_gauss_filter,
-    use_resize_conv=use_resize_conv,
-)
+
+def build_generator_clear2fog(builder, student=False):
+    if student:
+        return builder.build_student_generator(
+            use_transmission_map=use_transmission_map,
+            use_gauss_filter=use_gauss_filter,
+        )
+    return builder.build_generator(
+        use_transmission_map=use_transmission_map,
+        use_gauss_filter=use_gauss_filter,
+        use_resize_conv=use_resize_conv,
+    )
+
+
+generator_clear2fog = build_generator_clear2fog(models_builder)
 generator_fog2clear = models_builder.build_generator(use_transmission_map=False)
 
 use_intensity_for_fog_discriminator = False  # @param{type: "boolean"}
@@ -34,21 +51,45 @@ trainer = Trainer(
 
 
 print("Current working directory:", os.getcwd())
-trainer.configure_checkpoint(weights_path=weights_path, load_optimizers=False)
-
-
-def add_fog(img_path, save_directory="FoggyImg"):
+# Loads the newest of the checkpoints, the bundle or the .h5 files, like training does. Only the clear2fog
+# generator is used here, the other models are left out
+trainer.configure_checkpoint(weights_path=weights_path, load_optimizers=False, models=['generator_clear2fog'])
+
+if use_student_generator:
+    generator_clear2fog = build_generator_clear2fog(models_builder, student=True)
+    load_bundle_weights(os.path.join(weights_path, STUDENT_WEIGHTS_FILENAME), {STUDENT_GROUP: generator_clear2fog})
+
+# Fully convolutional copy of generator_clear2fog, for native aspect ratio images. Built on first use.
+generator_clear2fog_any_size = None
+
+
+def get_generator_clear2fog_any_size():
+    global generator_clear2fog_any_size
+    if generator_clear2fog_any_size is None:
+        generator_clear2fog_any_size = build_generator_clear2fog(ModelsBuilder(image_height=None, image_width=None),
+                                                                 student=use_student_generator)
+        generator_clear2fog_any_size.set_weights(generator_clear2fog.get_weights())
+    return generator_clear2fog_any_size
+
+
+def add_fog(img_path, save_directory="FoggyImg", intensity=0.35, high_resolution=False, native_aspect_ratio=False,
+            method="gan", depth_map=None):
+    """
+    :param high_resolution: composites the predicted transmission map onto the original image, at its resolution
+    :param native_aspect_ratio: runs the generator at the image's aspect ratio instead of cropping it to a square,
+        the output keeps the original framing
+    :param method: "gan" uses generator_clear2fog, "analytic" the atmospheric scattering model of
+        `lib.analytic_fog` at full resolution, much faster but without the learned fog appearance
+    :param depth_map: depth map [height, width] of the image for the "analytic" method, estimated if None
+    """
+    if method not in ["gan", "analytic"]:
+        raise Exception("Unknown fog method: {}".format(method))
     # Ensure the FoggyImg directory exists
     if not os.path.exists(save_directory):
         os.makedirs(save_directory)
 
     # Load the image
     image_clear = tf.io.decode_png(tf.io.read_file(img_path), channels=3)
-    image_clear, _ = datasetInit.preprocess_image_test(image_clear, 0)
-
-    # Generate foggy effect
-    step = 0.35
-    fig = plot_clear2fog_intensity(generator_clear2fog, image_clear, step)
 
     # Define the filename for the foggy image based on the original image name
     base_filename = os.path.basename(
@@ -58,8 +99,28 @@ def add_fog(img_path, save_directory="FoggyImg"):
     foggy_filename = f"{name_part}_fogg.jpg"  # Append '_fogg' to the name
     save_path = os.path.join(save_directory, foggy_filename)  # Combine into a full path
 
-    # Save the figure to the specified path
-    fig.savefig(save_path, bbox_inches="tight", pad_inches=0)
+    if method == "analytic":
+        image_fog = analytic_fog.add_fog(image_clear.numpy(), intensity, depth=depth_map)
+        tf.io.write_file(save_path, tf.io.encode_jpeg(image_fog, quality=95))
+    elif high_resolution:
+        # Run the generator at 256 px and composite its transmission map onto the original image
+        if native_aspect_ratio:
+            image_fog = clear2fog_full_resolution(get_generator_clear2fog_any_size(), image_clear, intensity,
+                                                  native_aspect_ratio=True)
+        else:
+            image_fog = clear2fog_full_resolution(generator_clear2fog, image_clear, intensity)
+        tf.io.write_file(save_path, tf.io.encode_jpeg(image_fog, quality=95))
+    elif native_aspect_ratio:
+        image_fog = clear2fog_native_aspect_ratio(get_generator_clear2fog_any_size(), image_clear, intensity)
+        tf.io.write_file(save_path, tf.io.encode_jpeg(image_fog, quality=95))
+    else:
+        image_clear, _ = datasetInit.preprocess_image_test(image_clear, 0)
+
+        # Generate foggy effect
+        fig = plot_clear2fog_intensity(generator_clear2fog, image_clear, intensity)
+
+        # Save the figure to the specified path
+        fig.savefig(save_path, bbox_inches="tight", pad_inches=0)
 
     # Optionally, print the path for debugging
     print(f"Saved foggy image at: {save_path}")
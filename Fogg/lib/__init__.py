@@ -1 +1 @@
-from . import plot, dataset, models, tools, train
+from . import plot, dataset, models, tools, train, transmission, shards, annotations, benchmark, distribute, telemetry, gauss, analytic_fog, bundle, distill
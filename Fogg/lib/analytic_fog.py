@@ -0,0 +1,239 @@
+import numpy as np
+
+# The depth of a frame without depth map is estimated on a copy downscaled to about this many pixels on its short
+# side, the estimate is smoothed anyway
+DEPTH_RESOLUTION = 256
+
+
+def _slice(x, start, stop, axis):
+    index = [slice(None)] * x.ndim
+    index[axis] = slice(start, stop)
+    return x[tuple(index)]
+
+
+def min_filter_1d(x, radius, axis):
+    """
+    Minimum over a (2 * radius + 1) window along `axis`, edges padded. The window minimum is built by doubling
+    (minimums over 2, 4, 8... values) then two overlapping windows, so it costs O(log radius) passes.
+    """
+    size = 2 * radius + 1
+    padding = [(0, 0)] * x.ndim
+    padding[axis] = (radius, radius)
+    x = np.pad(x, padding, mode='edge')
+    length = x.shape[axis] - size + 1
+    width = 1
+    while 2 * width <= size:
+        n = x.shape[axis]
+        x = np.minimum(_slice(x, 0, n - width, axis), _slice(x, width, n, axis))
+        width *= 2
+    return np.minimum(_slice(x, 0, length, axis), _slice(x, size - width, size - width + length, axis))
+
+
+def min_filter(x, radius):
+    """
+    Minimum over a (2 * radius + 1) square window, computed as two 1D minimums (rows then columns).
+    :param x: array [..., height, width]
+    :param radius:
+    :return: array with the same shape as `x`
+    """
+    return min_filter_1d(min_filter_1d(x, radius, x.ndim - 2), radius, x.ndim - 1)
+
+
+def box_filter(x, radius):
+    """
+    Mean over a (2 * radius + 1) square window with cumulative sums, the cost doesn't depend on the radius.
+    The borders are averaged over the valid part of the window only.
+    :param x: array [..., height, width]
+    :param radius:
+    :return: float32 array with the same shape as `x`
+    """
+    def mean_1d(a, axis):
+        n = a.shape[axis]
+        cumsum = np.cumsum(a, axis=axis, dtype=np.float64)
+        cumsum = np.concatenate([np.zeros_like(np.take(cumsum, [0], axis=axis)), cumsum], axis=axis)
+        end = np.minimum(np.arange(n) + radius + 1, n)
+        start = np.maximum(np.arange(n) - radius, 0)
+        shape = [1] * a.ndim
+        shape[axis] = n
+        counts = (end - start).reshape(shape)
+        return (np.take(cumsum, end, axis=axis) - np.take(cumsum, start, axis=axis)) / counts
+
+    return mean_1d(mean_1d(x, x.ndim - 2), x.ndim - 1).astype(np.float32)
+
+
+def dark_channel(image, radius=7):
+    """
+    Dark channel (He et al., https://doi.org/10.1109/TPAMI.2010.168): minimum over the color channels and a local
+    window. It's high in bright, low saturation regions (sky, haze, distant objects) and low elsewhere.
+    :param image: float array [..., height, width, 3] in range [0,1]
+    :param radius: window radius
+    :return: float32 array [..., height, width]
+    """
+    return min_filter(image.min(axis=-1), radius).astype(np.float32)
+
+
+def estimate_depth(image, radius=7, vertical_weight=0.5, smooth_radius=15):
+    """
+    Cheap relative depth estimate of a clear image, for when no depth map is available: the dark channel (bright
+    regions like the sky are usually far) blended with a vertical prior (the top of a frame is usually farther than
+    the bottom), then smoothed so the fog doesn't follow the textures.
+    :param image: float array [..., height, width, 3] in range [0,1], a single image or a batch
+    :param radius: dark channel window radius
+    :param vertical_weight: weight of the vertical prior, in range [0,1]
+    :param smooth_radius: radius of the final box filter
+    :return: float32 array [..., height, width] in range [0,1], 1 being the farthest
+    """
+    height = image.shape[-3]
+    vertical = np.linspace(1., 0., height, dtype=np.float32)[:, np.newaxis]
+    depth = (1 - vertical_weight) * dark_channel(image, radius) + vertical_weight * vertical
+    depth = box_filter(depth, smooth_radius)
+    return normalize_depth(depth)
+
+
+def normalize_depth(depth):
+    """
+    Rescales each depth map [..., height, width] to the range [0,1], a constant map becomes 1.
+    """
+    depth = np.asarray(depth, dtype=np.float32)
+    low = depth.min(axis=(-2, -1), keepdims=True)
+    high = depth.max(axis=(-2, -1), keepdims=True)
+    spread = high - low
+    constant = spread < 1e-6
+    return np.where(constant, np.float32(1), (depth - low) / np.where(constant, np.float32(1), spread))
+
+
+def scattering_coefficient(depth, intensity, iterations=30):
+    """
+    Finds the scattering coefficient `beta` such that the mean transmission `mean(exp(-beta * depth))` is
+    `1 - intensity`, the mean transmission the GAN is trained to produce for the same intensity
+    (`Trainer.transmission_map_loss`). Bisection on a subsample of the depth map, run for all the maps of a batch
+    at once.
+    :param depth: array [..., height, width] in range [0,1]
+    :param intensity: fog intensity in range [0,1], a single one or one per depth map
+    :param iterations: bisection iterations
+    :return: float beta for a single depth map, else an array [...]
+    """
+    depth = np.asarray(depth)
+    batch_shape = depth.shape[:-2]
+    target = 1. - np.clip(np.broadcast_to(np.asarray(intensity, dtype=np.float64), batch_shape), 0., 0.999)
+    step = max(1, int(np.sqrt(depth.shape[-2] * depth.shape[-1] / 65536)))
+    samples = depth[..., ::step, ::step].reshape(batch_shape + (-1,)).astype(np.float64)
+
+    def mean_transmission(beta):
+        return np.mean(np.exp(-beta[..., np.newaxis] * samples), axis=-1)
+
+    low = np.zeros(batch_shape)
+    high = np.ones(batch_shape)
+    while True:
+        grow = (mean_transmission(high) > target) & (high < 1e4)
+        if not grow.any():
+            break
+        high = np.where(grow, high * 2, high)
+    for _ in range(iterations):
+        beta = 0.5 * (low + high)
+        above = mean_transmission(beta) > target
+        low = np.where(above, beta, low)
+        high = np.where(above, high, beta)
+    beta = np.where(target >= 1., 0., 0.5 * (low + high))
+    return float(beta) if beta.ndim == 0 else beta
+
+
+def add_fog(image, intensity, depth=None, atmospheric_light=1., chunk_rows=256, depth_offset=0.1):
+    """
+    Adds fog to a full resolution image with the atmospheric scattering model `I * t + A * (1 - t)`,
+    `t = exp(-beta * d)`, the model the transmission map generators follow. `beta` is chosen so the same intensity
+    gives about the same mean fog as the GAN. The composition is done `chunk_rows` rows at a time, so the float
+    temporaries stay small for any resolution.
+    :param image: uint8 array [height, width, 3]
+    :param intensity: fog intensity in range [0,1]
+    :param depth: relative depth map [height, width], any range (normalized here, higher is farther). Estimated
+        with `estimate_depth` if None
+    :param atmospheric_light: the fog color A, a float or an RGB triplet in range [0,1]. White by default, like the
+        generators
+    :param chunk_rows: number of rows composited at once
+    :param depth_offset: minimal depth, so the nearest pixels get some fog as well
+    :return: the foggy uint8 image [height, width, 3]
+    """
+    depths = None if depth is None else [np.asarray(depth)]
+    return add_fog_stack([np.asarray(image)], [intensity], depths, atmospheric_light, chunk_rows, depth_offset)[0]
+
+
+def add_fog_stack(images, intensities, depths=None, atmospheric_light=1., chunk_rows=256, depth_offset=0.1):
+    """
+    `add_fog` for frames of the same size: the depth estimate, its normalization and the bisection of `beta` run
+    once for all of them. Without depth maps, the depth and the transmission are computed on the frames downscaled
+    to about `DEPTH_RESOLUTION` pixels and upsampled (nearest) while compositing, only these small copies are
+    stacked.
+    :param images: sequence of uint8 arrays [height, width, 3] of the same size, or an array [batch, height, width, 3]
+    :param intensities: one intensity per image
+    :param depths: None, or one depth map [height, width] per image
+    :return: list of foggy uint8 images
+    """
+    height, width = images[0].shape[:2]
+    if depths is None:
+        step = max(1, -(-min(height, width) // DEPTH_RESOLUTION))
+        depths = estimate_depth(np.stack([image[::step, ::step] for image in images]).astype(np.float32) / 255.)
+    else:
+        step = 1
+        depths = np.stack(depths)
+        if depths.shape[1:3] != (height, width):
+            raise Exception("The depth map shape {} doesn't match the image shape {}".format(depths.shape[1:],
+                                                                                             images[0].shape))
+    depths = depth_offset + (1 - depth_offset) * normalize_depth(depths)
+    beta = scattering_coefficient(depths, np.asarray(intensities, dtype=np.float64).reshape(-1))
+    transmission = np.exp(-beta[:, np.newaxis, np.newaxis] * depths).astype(np.float32)
+    light = np.asarray(atmospheric_light, dtype=np.float32) * 255.
+
+    rows_index = np.arange(height) // step
+    columns_index = np.arange(width) // step
+    results = []
+    for image, image_transmission in zip(images, transmission):
+        result = np.empty_like(image, dtype=np.uint8)
+        for row in range(0, height, chunk_rows):
+            rows = slice(row, row + chunk_rows)
+            t = image_transmission[np.ix_(rows_index[rows], columns_index)][..., np.newaxis]
+            # I * t + A * (1 - t) = A + (I - A) * t, in place on the float copy of the chunk
+            fog = image[rows].astype(np.float32)
+            fog -= light
+            fog *= t
+            fog += light
+            np.clip(fog, 0, 255, out=fog)
+            np.rint(fog, out=fog)
+            result[rows] = fog
+        results.append(result)
+    return results
+
+
+def upsample_nearest(x, height, width, step):
+    return np.repeat(np.repeat(x, step, axis=0), step, axis=1)[:height, :width]
+
+
+def add_fog_batch(images, intensities, depths=None, max_stack=8, **kwargs):
+    """
+    Applies `add_fog` to a batch of frames, which can have different resolutions. The frames of the same size are
+    processed together by `add_fog_stack`, up to `max_stack` at a time.
+    :param images: iterable of uint8 arrays [height, width, 3]
+    :param intensities: a single intensity or one per image
+    :param depths: None or one depth map (or None) per image
+    :param max_stack: maximum number of frames per stack
+    :param kwargs: `add_fog` arguments
+    :return: list of foggy uint8 images
+    """
+    images = [np.asarray(image) for image in images]
+    if np.isscalar(intensities):
+        intensities = [intensities] * len(images)
+    if depths is None:
+        depths = [None] * len(images)
+    groups = {}
+    for i, (image, depth) in enumerate(zip(images, depths)):
+        groups.setdefault((image.shape, depth is None), []).append(i)
+    results = [None] * len(images)
+    for (_, no_depth), indices in groups.items():
+        for start in range(0, len(indices), max_stack):
+            stack = indices[start:start + max_stack]
+            stack_depths = None if no_depth else [depths[i] for i in stack]
+            foggy = add_fog_stack([images[i] for i in stack], [intensities[i] for i in stack], stack_depths,
+                                  **kwargs)
+            for i, image in zip(stack, foggy):
+                results[i] = image
+    return results
@@ -0,0 +1,119 @@
+import tensorflow as tf
+import pandas as pd
+import fnmatch
+import os
+import pickle
+
+ANNOTATIONS_PATTERN = 'Annotations*.csv'
+INDEX_VERSION = 1
+
+
+def stat_paths(paths):
+    """
+    Returns the modification time and size of each path, used to detect changes since the index was saved.
+    A new or deleted annotation file changes the modification time of its directory, so stating the directories
+    is enough to detect them without listing their (possibly huge number of) files.
+    :param paths: iterable of file or directory paths
+    :return: dict {path: (mtime_nsec, length)}, None if any of the paths doesn't exist anymore
+    """
+    stats = {}
+    for p in paths:
+        try:
+            s = tf.io.gfile.stat(p)
+        except tf.errors.NotFoundError:
+            return None
+        stats[p] = (s.mtime_nsec, s.length if not s.is_directory else 0)
+    return stats
+
+
+def find_annotation_files(path, pattern=ANNOTATIONS_PATTERN):
+    """
+    Walks `path` recursively and returns the annotation files and the walked directories.
+    Because tf.io.matching_files doesn't walk recursively on linux, had to do it manually. The file names returned
+    by the walk are filtered directly instead of globbing every directory again.
+    :param path:
+    :param pattern:
+    :return: (sorted list of annotation files, list of directories)
+    """
+    annotation_files = []
+    directories = []
+    for directory, _, files in tf.io.gfile.walk(path):
+        directories.append(directory)
+        annotation_files.extend(os.path.join(directory, f) for f in fnmatch.filter(files, pattern))
+    return sorted(annotation_files), directories
+
+
+def read_annotation_files(annotation_files, process_annotations_file, max_workers=8):
+    """
+    Reads the annotation files in parallel and concatenates them once.
+    :param annotation_files: list of annotation file paths
+    :param process_annotations_file: function that reads a single annotation file into a dataframe
+    :param max_workers: number of reading threads
+    :return: a dataframe, None if there are no annotation files
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    if len(annotation_files) == 0:
+        return None
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        dataframes = list(executor.map(process_annotations_file, annotation_files))
+    return pd.concat(dataframes, ignore_index=True)
+
+
+def load_index(index_path):
+    if index_path is None or not tf.io.gfile.exists(index_path):
+        return None
+    try:
+        with tf.io.gfile.GFile(index_path, 'rb') as f:
+            index = pickle.load(f)
+    except Exception as e:
+        print("Couldn't load the annotations index {}: {}".format(index_path, e))
+        return None
+    if index.get('version') != INDEX_VERSION:
+        return None
+    return index
+
+
+def save_index(index_path, stats, images_df):
+    """
+    Saves the index next to a temporary name first, so an interrupted save never leaves a corrupted index.
+    A read-only dataset directory only disables the index.
+    """
+    index = {'version': INDEX_VERSION, 'stats': stats, 'dataframe': images_df}
+    tmp_path = index_path + '.tmp'
+    try:
+        with tf.io.gfile.GFile(tmp_path, 'wb') as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        tf.io.gfile.rename(tmp_path, index_path, overwrite=True)
+    except (OSError, tf.errors.OpError) as e:
+        print("Couldn't save the annotations index {}: {}".format(index_path, e))
+
+
+def annotations_to_dataframe(path, process_annotations_file, index_path=None, max_workers=8):
+    """
+    Finds all the annotation files in `path` and returns their combined dataframe.
+    If `index_path` is set, the combined dataframe is persisted there together with the modification times of the
+    annotation files and the directories, and reloaded by later calls unless one of them changed.
+    :param path: the dataset path
+    :param process_annotations_file: function that reads a single annotation file into a dataframe
+    :param index_path: the index file, None disables the index
+    :param max_workers: number of reading threads
+    :return: a dataframe
+    """
+    index = load_index(index_path)
+    if index is not None and stat_paths(index['stats'].keys()) == index['stats']:
+        print("Annotations loaded from index {}".format(index_path))
+        return index['dataframe']
+
+    annotation_files, directories = find_annotation_files(path)
+    if len(annotation_files) == 0:
+        raise Exception("No annotation files found!")
+
+    images_df = read_annotation_files(annotation_files, process_annotations_file, max_workers)
+    if images_df is None or len(images_df.index) == 0:
+        raise Exception("No images found!")
+
+    if index_path is not None:
+        stats = stat_paths(directories + annotation_files)
+        if stats is not None:
+            save_index(index_path, stats, images_df)
+    return images_df
@@ -0,0 +1,377 @@
+import tensorflow as tf
+import time
+
+
+def time_function(fn, *args, warmup=3, iterations=20, median=False):
+    """
+    Measures the mean duration of `fn(*args)` in seconds, after `warmup` calls (tracing, memory allocation).
+    :param fn: the function to benchmark
+    :param args: the function arguments
+    :param warmup: number of untimed calls
+    :param iterations: number of timed calls
+    :param median: times each call and returns the median instead, less sensitive to the outliers of slow calls
+    :return: float, mean (or median) seconds per call
+    """
+    for _ in range(warmup):
+        result = fn(*args)
+    if warmup:
+        _block(result)
+    if median:
+        durations = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            _block(fn(*args))
+            durations.append(time.perf_counter() - start)
+        return sorted(durations)[len(durations) // 2]
+    start = time.perf_counter()
+    for _ in range(iterations):
+        result = fn(*args)
+    _block(result)
+    return (time.perf_counter() - start) / iterations
+
+
+def _block(result):
+    # Eager tensors may still be computed asynchronously, reading them waits for the result
+    for x in tf.nest.flatten(result):
+        if isinstance(x, tf.Tensor):
+            x.numpy()
+
+
+def graph_size(tf_function, *args):
+    """
+    Number of operations in the graph traced by a `tf.function` for the given arguments.
+    """
+    return len(tf_function.get_concrete_function(*args).graph.get_operations())
+
+
+def transmission_map_loss_reference(trainer, clear_image, generated_image, intensity):
+    """
+    The original per image loop implementation of `Trainer.transmission_map_loss`, kept as a reference.
+    """
+    if trainer.normalized_input:
+        intensity = intensity * 0.5 + 0.5
+    t = 1 - intensity
+    expected_image = []
+    for i in range(clear_image.shape[0]):
+        expected_image.append(clear_image[i] * t[i] + (1 - t[i]))
+    expected_image = tf.convert_to_tensor(expected_image)
+
+    return trainer.LAMBDA * tf.abs(tf.reduce_mean(expected_image) - tf.reduce_mean(generated_image))
+
+
+def benchmark_losses(trainer=None, batch_sizes=(1, 4, 16, 64), image_size=256, iterations=20):
+    """
+    Compares `Trainer.transmission_map_loss` with its reference implementation: value, traced graph size and
+    duration for each batch size. The values should match up to float rounding, and the graph size shouldn't depend
+    on the batch size anymore. The other losses are already batched ops and are timed for reference.
+    :param trainer: a `Trainer`, only its loss settings are used. A default one is created if None
+    :param batch_sizes:
+    :param image_size:
+    :param iterations:
+    :return: list of dicts, one per batch size
+    """
+    if trainer is None:
+        from .train import Trainer
+        trainer = Trainer(None, None, None, None)
+
+    @tf.function
+    def reference(clear, generated, intensity):
+        return transmission_map_loss_reference(trainer, clear, generated, intensity)
+
+    vectorized = tf.function(trainer.transmission_map_loss)
+
+    @tf.function
+    def other_losses(clear, generated):
+        return (trainer.whitening_loss(clear, generated), trainer.rgb_ratio_loss(clear, generated),
+                trainer.identity_loss(clear, generated))
+
+    results = []
+    print("{:>6} | {:>14} | {:>8} | {:>8} | {:>10} | {:>10} | {:>14}".format(
+        'batch', 'max abs diff', 'ref ops', 'vec ops', 'ref ms', 'vec ms', 'other loss ms'))
+    for batch_size in batch_sizes:
+        shape = (batch_size, image_size, image_size, 3)
+        clear = tf.random.uniform(shape, -1, 1)
+        generated = tf.random.uniform(shape, -1, 1)
+        intensity = tf.random.uniform((batch_size, 1), -1, 1)
+
+        result = {
+            'batch_size': batch_size,
+            'max_abs_diff': abs(float(reference(clear, generated, intensity)) -
+                                float(vectorized(clear, generated, intensity))),
+            'reference_ops': graph_size(reference, clear, generated, intensity),
+            'vectorized_ops': graph_size(vectorized, clear, generated, intensity),
+            'reference_ms': 1000 * time_function(reference, clear, generated, intensity, iterations=iterations),
+            'vectorized_ms': 1000 * time_function(vectorized, clear, generated, intensity, iterations=iterations),
+            'other_losses_ms': 1000 * time_function(other_losses, clear, generated, iterations=iterations),
+        }
+        results.append(result)
+        print("{batch_size:>6} | {max_abs_diff:>14.3e} | {reference_ops:>8} | {vectorized_ops:>8} | "
+              "{reference_ms:>10.3f} | {vectorized_ms:>10.3f} | {other_losses_ms:>14.3f}".format(**result))
+    return results
+
+
+def gauss_blur_reference(x, sigma, radius=None):
+    """
+    Gaussian blur with a dense 2D depthwise kernel, the reference of `gauss.SeparableGaussianBlur`.
+    """
+    import numpy as np
+    from .gauss import gaussian_kernel_1d
+    kernel_1d = gaussian_kernel_1d(sigma, radius)
+    r = len(kernel_1d) // 2
+    channels = x.shape[-1]
+    kernel = np.tile(np.outer(kernel_1d, kernel_1d)[:, :, np.newaxis, np.newaxis], [1, 1, channels, 1])
+    x = tf.pad(x, [[0, 0], [r, r], [r, r], [0, 0]], mode='REFLECT')
+    return tf.nn.depthwise_conv2d(x, tf.constant(kernel, dtype=tf.float32), strides=[1, 1, 1, 1], padding='VALID')
+
+
+def benchmark_gauss_blur(sigmas=(1, 2, 4, 8), sizes=(256, 512, 1024), batch_size=1, iterations=20):
+    """
+    Compares the separable gaussian blur of the transmission map with a dense 2D kernel: max difference and
+    duration for each sigma and map size.
+    :param sigmas: standard deviations, the kernels have 2 * ceil(3 * sigma) + 1 taps
+    :param sizes: square map sizes
+    :param batch_size:
+    :param iterations:
+    :return: list of dicts, one per (sigma, size)
+    """
+    from .gauss import SeparableGaussianBlur
+    results = []
+    print("{:>6} | {:>5} | {:>6} | {:>14} | {:>10} | {:>12}".format(
+        'sigma', 'taps', 'size', 'max abs diff', 'dense ms', 'separable ms'))
+    for sigma in sigmas:
+        layer = SeparableGaussianBlur(sigma)
+        separable = tf.function(lambda x: layer(x))
+        dense = tf.function(lambda x: gauss_blur_reference(x, sigma))
+        for size in sizes:
+            x = tf.random.uniform((batch_size, size, size, 1))
+            result = {
+                'sigma': sigma,
+                'taps': 2 * layer.radius + 1,
+                'size': size,
+                'max_abs_diff': float(tf.reduce_max(tf.abs(separable(x) - dense(x)))),
+                'dense_ms': 1000 * time_function(dense, x, iterations=iterations),
+                'separable_ms': 1000 * time_function(separable, x, iterations=iterations),
+            }
+            results.append(result)
+            print("{sigma:>6} | {taps:>5} | {size:>6} | {max_abs_diff:>14.3e} | {dense_ms:>10.3f} | "
+                  "{separable_ms:>12.3f}".format(**result))
+    return results
+
+
+def instance_normalization_reference(layer, x):
+    """
+    The original `InstanceNormalization.call`, normalizing then scaling and shifting the whole tensor.
+    """
+    mean, variance = tf.nn.moments(x, axes=[1, 2], keepdims=True)
+    inv = tf.math.rsqrt(variance + layer.epsilon)
+    normalized = (x - mean) * inv
+    return layer.scale * normalized + layer.offset
+
+
+def benchmark_instance_normalization(shapes=((1, 128, 128, 64), (1, 64, 64, 128), (1, 32, 32, 256),
+                                             (4, 128, 128, 64), (16, 64, 64, 128)), iterations=50):
+    """
+    Compares `InstanceNormalization` with its reference implementation and with Keras `GroupNormalization(groups=-1)`
+    (when available), on shapes of the generators' blocks. The layers share the same scale and offset.
+    :param shapes: [batch, height, width, channels] inputs
+    :param iterations:
+    :return: list of dicts, one per shape
+    """
+    from .models import InstanceNormalization
+    group_normalization_class = getattr(tf.keras.layers, 'GroupNormalization', None)
+    results = []
+    print("{:>20} | {:>14} | {:>10} | {:>10} | {:>14}".format(
+        'shape', 'max abs diff', 'ref ms', 'fused ms', 'group norm ms'))
+    for shape in shapes:
+        x = tf.random.normal(shape, 1., 2.)
+        layer = InstanceNormalization()
+        layer(x)  # builds the weights
+        reference = tf.function(lambda t: instance_normalization_reference(layer, t))
+        fused = tf.function(lambda t: layer(t))
+        result = {
+            'shape': 'x'.join(str(d) for d in shape),
+            'max_abs_diff': float(tf.reduce_max(tf.abs(reference(x) - fused(x)))),
+            'reference_ms': 1000 * time_function(reference, x, iterations=iterations),
+            'fused_ms': 1000 * time_function(fused, x, iterations=iterations),
+            'group_normalization_ms': float('nan'),
+        }
+        if group_normalization_class is not None:
+            group_normalization = group_normalization_class(groups=-1, epsilon=layer.epsilon)
+            group_normalization(x)
+            group_normalization.set_weights(layer.get_weights())
+            group = tf.function(lambda t: group_normalization(t))
+            result['group_normalization_ms'] = 1000 * time_function(group, x, iterations=iterations)
+        results.append(result)
+        print("{shape:>20} | {max_abs_diff:>14.3e} | {reference_ms:>10.3f} | {fused_ms:>10.3f} | "
+              "{group_normalization_ms:>14.3f}".format(**result))
+    return results
+
+
+def benchmark_analytic_fog(sizes=((720, 1280), (1080, 1920), (2160, 3840)), intensity=0.5, generator=None,
+                           batch_size=8, warmup=3, iterations=15):
+    """
+    Median durations of the analytic fog engine on random frames, alone and per frame of a batch of `batch_size`
+    frames of the same size (`analytic_fog.add_fog_batch`), and of the GAN at full resolution
+    (`transmission.clear2fog_full_resolution`) if a generator is given, with the mean absolute difference of their
+    outputs (in uint8 levels).
+    :param sizes: (height, width) of the frames
+    :param intensity:
+    :param generator: a clear2fog generator, optional
+    :param batch_size:
+    :param warmup:
+    :param iterations:
+    :return: list of dicts, one per size
+    """
+    import numpy as np
+    from . import analytic_fog
+    from .transmission import clear2fog_full_resolution
+    results = []
+    print("{:>11} | {:>11} | {:>14} | {:>8} | {:>13}".format('size', 'analytic ms', 'batch ms/frame', 'gan ms',
+                                                            'mean abs diff'))
+    for height, width in sizes:
+        image = np.random.randint(0, 256, (height, width, 3), dtype=np.uint8)
+        batch = [np.random.randint(0, 256, (height, width, 3), dtype=np.uint8) for _ in range(batch_size)]
+        analytic = analytic_fog.add_fog(image, intensity)
+        result = {
+            'size': '{}x{}'.format(height, width),
+            'analytic_ms': 1000 * time_function(analytic_fog.add_fog, image, intensity, warmup=warmup,
+                                                iterations=iterations, median=True),
+            'batch_ms_per_frame': 1000 * time_function(analytic_fog.add_fog_batch, batch, intensity, warmup=1,
+                                                       iterations=max(3, iterations // batch_size),
+                                                       median=True) / batch_size,
+            'gan_ms': float('nan'),
+            'mean_abs_diff': float('nan'),
+        }
+        if generator is not None:
+            gan = clear2fog_full_resolution(generator, image, intensity).numpy()
+            result['gan_ms'] = 1000 * time_function(clear2fog_full_resolution, generator, image, intensity,
+                                                    warmup=warmup, iterations=iterations, median=True)
+            result['mean_abs_diff'] = float(np.mean(np.abs(gan.astype(np.float32) - analytic)))
+        results.append(result)
+        print("{size:>11} | {analytic_ms:>11.1f} | {batch_ms_per_frame:>14.1f} | {gan_ms:>8.1f} | "
+              "{mean_abs_diff:>13.2f}".format(**result))
+    return results
+
+
+def benchmark_intensity_sweep(counts=(1, 4, 8, 16), use_transmission_map=True, iterations=3):
+    """
+    Times `transmission.clear2fog_intensity_sweep` for sweeps of several lengths, with a generator conditioned at the
+    input ('concat', the whole generator runs for each intensity) and one conditioned in the decoder ('decoder', the
+    image is encoded once).
+    :param counts: numbers of intensities of the sweeps
+    :param use_transmission_map:
+    :param iterations:
+    :return: list of dicts, one per sweep length
+    """
+    import numpy as np
+    from .models import ModelsBuilder
+    from .transmission import clear2fog_intensity_sweep
+    generators = {conditioning: ModelsBuilder(intensity_conditioning=conditioning).build_generator(
+        use_transmission_map=use_transmission_map) for conditioning in ['concat', 'decoder']}
+    image = np.random.randint(0, 256, (256, 256, 3), dtype=np.uint8)
+    results = []
+    print("{:>11} | {:>9} | {:>10} | {:>7}".format('intensities', 'concat ms', 'decoder ms', 'speedup'))
+    for count in counts:
+        intensities = list(np.linspace(0, 1, count))
+        result = {'intensities': count}
+        for conditioning, generator in generators.items():
+            result[conditioning + '_ms'] = 1000 * time_function(clear2fog_intensity_sweep, generator, image,
+                                                                intensities, warmup=1, iterations=iterations)
+        result['speedup'] = result['concat_ms'] / result['decoder_ms']
+        results.append(result)
+        print("{intensities:>11} | {concat_ms:>9.1f} | {decoder_ms:>10.1f} | {speedup:>7.2f}".format(**result))
+    return results
+
+
+def benchmark_student_generator(teacher=None, student=None, test_clear=None, batch_sizes=(1, 8), iterations=10):
+    """
+    Speed against fidelity of a student generator (`distill.Distiller`): parameters and forward pass duration of
+    both generators for each batch size, and the student's error against the teacher if `test_clear` is given.
+    :param teacher: a clear2fog generator, a new one with a transmission map if None
+    :param student: a student generator, a new one with the default filters if None
+    :param test_clear: dataset of (images, intensities) batches for the fidelity, optional
+    :param batch_sizes:
+    :param iterations:
+    :return: dict with the 'speed' results (one dict per batch size) and the 'fidelity' (None without `test_clear`)
+    """
+    from .models import ModelsBuilder
+    from .train import Trainer
+    from .distill import Distiller
+    builder = ModelsBuilder()
+    if teacher is None:
+        teacher = builder.build_generator(use_transmission_map=True)
+    if student is None:
+        student = builder.build_student_generator(use_transmission_map=True)
+    print("Parameters: teacher {:,}, student {:,}".format(teacher.count_params(), student.count_params()))
+    teacher_call = tf.function(lambda image, intensity: teacher((image, intensity)))
+    student_call = tf.function(lambda image, intensity: student((image, intensity)))
+    speed = []
+    print("{:>10} | {:>10} | {:>10} | {:>7}".format('batch size', 'teacher ms', 'student ms', 'speedup'))
+    for batch_size in batch_sizes:
+        image = tf.random.uniform([batch_size] + list(teacher.inputs[0].shape[1:]), -1, 1)
+        intensity = tf.random.uniform((batch_size, 1), -1, 1)
+        result = {
+            'batch_size': batch_size,
+            'teacher_ms': 1000 * time_function(teacher_call, image, intensity, iterations=iterations),
+            'student_ms': 1000 * time_function(student_call, image, intensity, iterations=iterations),
+        }
+        result['speedup'] = result['teacher_ms'] / result['student_ms']
+        speed.append(result)
+        print("{batch_size:>10} | {teacher_ms:>10.1f} | {student_ms:>10.1f} | {speedup:>7.2f}".format(**result))
+    fidelity = None
+    if test_clear is not None:
+        fidelity = Distiller(Trainer(teacher, None, None, None), student).evaluate(test_clear)
+        print("Fidelity: MAE {mae:.4f}, PSNR {psnr:.2f} dB".format(**fidelity))
+        for intensity, mae in fidelity['mae_per_intensity'].items():
+            print("    intensity {:.1f}: MAE {:.4f}".format(intensity, mae))
+    return {'speed': speed, 'fidelity': fidelity}
+
+
+def benchmark_train_step(configs=None, batch_size=1, steps=10, warmup=2):
+    """
+    Compares the `Trainer.train_step` throughput of several precision and compilation configurations.
+    The models are built again for each configuration, since the dtype policy is set when building them.
+    :param configs: list of dicts with the keys 'dtype_policy' (see `ModelsBuilder`) and 'jit_compile'.
+        Defaults to float32 and mixed_bfloat16, each with and without XLA
+    :param batch_size:
+    :param steps: number of timed steps
+    :param warmup: number of untimed steps (tracing and compilation)
+    :return: list of dicts, one per configuration
+    """
+    from .models import ModelsBuilder
+    from .train import Trainer
+    if configs is None:
+        configs = [{'dtype_policy': policy, 'jit_compile': jit_compile}
+                   for policy in [None, 'mixed_bfloat16'] for jit_compile in [False, True]]
+
+    results = []
+    print("{:>16} | {:>5} | {:>10} | {:>10}".format('policy', 'XLA', 'step ms', 'images/sec'))
+    for config in configs:
+        builder = ModelsBuilder(dtype_policy=config['dtype_policy'])
+        trainer = Trainer(builder.build_generator(use_transmission_map=False),
+                          builder.build_generator(use_transmission_map=False),
+                          builder.build_discriminator(use_intensity=False),
+                          builder.build_discriminator(use_intensity=False),
+                          jit_compile=config['jit_compile'])
+        shape = (batch_size, builder.image_height, builder.image_width, builder.output_channels)
+        clear = (tf.random.uniform(shape, -1, 1), tf.random.uniform((batch_size, 1), -1, 1))
+        fog = (tf.random.uniform(shape, -1, 1), tf.random.uniform((batch_size, 1), -1, 1))
+        seconds = time_function(trainer.train_step, clear, fog, warmup=warmup, iterations=steps)
+        result = dict(config, step_ms=1000 * seconds, images_per_sec=batch_size / seconds)
+        results.append(result)
+        print("{:>16} | {:>5} | {:>10.1f} | {:>10.2f}".format(str(config['dtype_policy']), str(config['jit_compile']),
+                                                            result['step_ms'], result['images_per_sec']))
+        # Releases the models before building the next configuration
+        del trainer
+        tf.keras.backend.clear_session()
+    return results
+
+
+if __name__ == '__main__':
+    benchmark_losses()
+    benchmark_gauss_blur()
+    benchmark_instance_normalization()
+    benchmark_analytic_fog()
+    benchmark_intensity_sweep()
+    benchmark_student_generator()
+    benchmark_train_step()
@@ -0,0 +1,194 @@
+import numpy as np
+import json
+import os
+import struct
+
+# Default file name of the bundle in a weights directory
+BUNDLE_FILENAME = 'weights.fogg'
+MAGIC = b'FOGGPACK'
+VERSION = 1
+# Tensors start on multiples of ALIGNMENT bytes in the file
+ALIGNMENT = 64
+# magic, version, length of the JSON index
+HEADER_FORMAT = '<8sIQ'
+
+
+def align(offset, alignment=ALIGNMENT):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def write_bundle(path, groups, metadata=None):
+    """
+    Writes named groups of arrays in a single file: a small binary header, a JSON index and the arrays stored
+    contiguously (C order, aligned to `ALIGNMENT` bytes), so `Bundle` can map them with `np.memmap` instead of
+    parsing them. The file is written under a temporary name then renamed, a reader never sees it half written.
+    :param path: the bundle file
+    :param groups: dict group name -> list of (name, array), e.g. the weights of a model or an optimizer. The arrays
+        can be numpy arrays or variables, the variables are read one at a time while writing
+    :param metadata: JSON serializable dict stored in the index
+    :return: path
+    """
+    index = {'groups': {}, 'metadata': metadata or {}}
+    offset = 0
+    arrays = []
+    for group, named_arrays in groups.items():
+        entries = []
+        for name, array in named_arrays:
+            # tf.DType.as_numpy_dtype for the variables
+            dtype = np.dtype(getattr(array.dtype, 'as_numpy_dtype', array.dtype))
+            shape = [int(d) for d in array.shape]
+            offset = align(offset)
+            entries.append({'name': name, 'dtype': dtype.str, 'shape': shape, 'offset': offset})
+            arrays.append((offset, array))
+            offset += dtype.itemsize * int(np.prod(shape, dtype=np.int64))
+        index['groups'][group] = entries
+    index_bytes = json.dumps(index).encode('utf-8')
+    data_start = align(struct.calcsize(HEADER_FORMAT) + len(index_bytes))
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, len(index_bytes)))
+        f.write(index_bytes)
+        for array_offset, array in arrays:
+            f.seek(data_start + array_offset)
+            f.write(np.asarray(array, order='C').tobytes())
+        # The file ends with the last array, even if it's empty
+        f.truncate(data_start + offset)
+    os.replace(temp_path, path)
+    return path
+
+
+class Bundle:
+    """
+    Read only view of a bundle written by `write_bundle`. The file is mapped once, the arrays are views of the
+    mapping: nothing is read before an array is used, and the processes that load the same bundle share its pages
+    through the page cache.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, version, index_length = struct.unpack(HEADER_FORMAT, f.read(struct.calcsize(HEADER_FORMAT)))
+            if magic != MAGIC:
+                raise Exception("{} isn't a weights bundle".format(path))
+            if version > VERSION:
+                raise Exception("Unsupported bundle version {} in {}".format(version, path))
+            index = json.loads(f.read(index_length).decode('utf-8'))
+        self.groups = index['groups']
+        self.metadata = index['metadata']
+        self.data_start = align(struct.calcsize(HEADER_FORMAT) + index_length)
+        data_length = os.path.getsize(path) - self.data_start
+        # np.memmap can't map 0 bytes
+        self.data = np.memmap(path, dtype=np.uint8, mode='r', offset=self.data_start) if data_length > 0 \
+            else np.zeros(0, dtype=np.uint8)
+
+    def array(self, entry):
+        dtype = np.dtype(entry['dtype'])
+        count = int(np.prod(entry['shape'], dtype=np.int64))
+        start = entry['offset']
+        return self.data[start:start + count * dtype.itemsize].view(dtype).reshape(entry['shape'])
+
+    def arrays(self, group):
+        """
+        :return: list of (name, read only array view) of a group, in the order they were written
+        """
+        if group not in self.groups:
+            raise Exception("No group {} in the bundle {}".format(group, self.path))
+        return [(entry['name'], self.array(entry)) for entry in self.groups[group]]
+
+    def load_variables(self, variables, group):
+        """
+        Assigns the arrays of a group to variables, in order. Each array is copied once, from the mapped file into
+        the variable.
+        :param variables: list of tf.Variable, e.g. `model.weights`
+        :param group:
+        """
+        arrays = self.arrays(group)
+        if len(arrays) != len(variables):
+            raise Exception("The group {} has {} arrays, {} variables expected".format(group, len(arrays),
+                                                                                        len(variables)))
+        for variable, (name, array) in zip(variables, arrays):
+            if tuple(variable.shape) != array.shape:
+                raise Exception("Shape mismatch for {} in the group {}: {} in the bundle, {} expected".format(
+                    name, group, array.shape, tuple(variable.shape)))
+            variable.assign(array)
+
+    def load_model(self, model, group):
+        self.load_variables(model.weights, group)
+
+    def load_optimizer(self, optimizer, group):
+        """
+        The optimizer variables are created by its first step, it must have been built before
+        (`Trainer.build_optimizers`).
+        """
+        self.load_variables(optimizer_variables(optimizer), group)
+
+
+def optimizer_variables(optimizer):
+    # `weights` for the legacy optimizers, `variables` for the others
+    return optimizer.weights if hasattr(optimizer, 'weights') else optimizer.variables
+
+
+def model_arrays(model):
+    return [(variable.name, variable) for variable in model.weights]
+
+
+def optimizer_arrays(optimizer):
+    return [(variable.name, variable) for variable in optimizer_variables(optimizer)]
+
+
+def load_bundle_weights(path, models):
+    """
+    Loads only the given models from a bundle, e.g. the clear2fog generator for inference.
+    :param path: the bundle file
+    :param models: dict group name -> model, the group names are the ones of `Trainer.get_checkpoint_objects`
+    :return: the bundle metadata
+    """
+    bundle = Bundle(path)
+    for group, model in models.items():
+        bundle.load_model(model, group)
+        print("Weights loaded: {} from {}".format(group, path))
+    return bundle.metadata
+
+
+def convert_legacy_weights(trainer, weights_path, bundle_path=None, include_optimizers=True):
+    """
+    Converts the `.h5` and `.pkl` files written by `Trainer.save_weights` in `weights_path` to a bundle.
+    The `.h5` files are loaded into the trainer's models, which must have the architecture they were saved with.
+    The `.pkl` files are copied as they are, without building the optimizers.
+    :param trainer: a `Trainer`
+    :param weights_path: directory of the `.h5` and `.pkl` files
+    :param bundle_path: defaults to `BUNDLE_FILENAME` in `weights_path`
+    :param include_optimizers:
+    :return: the bundle path
+    """
+    import pickle
+    if bundle_path is None:
+        bundle_path = os.path.join(weights_path, BUNDLE_FILENAME)
+    previous_weights_path = trainer.weights_path
+    trainer.weights_path = weights_path
+    try:
+        models, model_paths = trainer.get_models_and_paths()
+        optimizers, optimizer_paths = trainer.get_optimizers_and_paths()
+    finally:
+        trainer.weights_path = previous_weights_path
+    names = trainer.get_checkpoint_objects(include_optimizers=True)
+    groups = {}
+    for model, path in zip(models, model_paths):
+        if model is None or not os.path.isfile(path):
+            print("Not found: {}".format(path))
+            continue
+        model.load_weights(path)
+        groups[next(name for name, obj in names.items() if obj is model)] = model_arrays(model)
+    if include_optimizers:
+        for optimizer, path in zip(optimizers, optimizer_paths):
+            if not os.path.isfile(path):
+                print("Not found: {}".format(path))
+                continue
+            with open(path, 'rb') as f:
+                arrays = pickle.load(f)
+            group = next(name for name, obj in names.items() if obj is optimizer)
+            groups[group] = [('{}/{}'.format(group, i), array) for i, array in enumerate(arrays)]
+    write_bundle(bundle_path, groups, {'total_epochs': trainer.total_epochs, 'source': 'legacy'})
+    print("Bundle written: {} ({} groups)".format(bundle_path, len(groups)))
+    return bundle_path
@@ -7,6 +7,11 @@ COLUMN_PATH = 'path'
 COLUMN_INTENSITY = 'intensity'
 INTENSITY_VALUE_RANDOM = 'random'
 INTENSITY_VALUE_SAMPLE = 'sample'
+JITTER_OFFSET = 30
+SPLIT_TRAIN_CLEAR = 'train_clear'
+SPLIT_TRAIN_FOG = 'train_fog'
+SPLIT_TEST_CLEAR = 'test_clear'
+SPLIT_TEST_FOG = 'test_fog'
 
 
 def split_dataframe(df, smaller_split_ratio, random_seed=None):
@@ -49,11 +54,42 @@ def image_names_generator(df, intensity_value=None, random_range=(0.1, 0.95)):
     return gen
 
 
+def random_intensity(random_range=(0.1, 0.95)):
+    intensity = tf.random.uniform((1,), minval=random_range[0], maxval=random_range[1], dtype=tf.float32)
+    return tf.round(intensity * 100) / 100
+
+
+def image_names_dataset(df, intensity_value=None, random_range=(0.1, 0.95),
+                        autotune=tf.data.experimental.AUTOTUNE):
+    """
+    Vectorized equivalent of `image_names_generator`: returns a `tf.data.Dataset` of (path, intensity) built with
+    `from_tensor_slices`, so no python code runs per element once the pipeline starts.
+    :param df:
+    :param intensity_value: possible values: [None, 'random', 'sample'], same as `image_names_generator`
+    :param random_range:
+    :param autotune:
+    :return: tf.data.Dataset yielding (tf.string, tf.float32 of shape (1,))
+    """
+    import numpy as np
+    paths = df[COLUMN_PATH].to_numpy(dtype=str)
+    if intensity_value == INTENSITY_VALUE_RANDOM:
+        return tf.data.Dataset.from_tensor_slices(paths).map(lambda path: (path, random_intensity(random_range)),
+                                                             num_parallel_calls=autotune)
+    if intensity_value == INTENSITY_VALUE_SAMPLE:
+        sample_intensities = np.arange(1, 10, dtype=np.float32) / 10
+        paths = np.repeat(paths, len(sample_intensities))
+        intensities = np.tile(sample_intensities, len(paths) // len(sample_intensities))
+    else:
+        intensities = df[COLUMN_INTENSITY].to_numpy(dtype=np.float32)
+    return tf.data.Dataset.from_tensor_slices((paths, intensities[:, np.newaxis]))
+
+
 # noinspection PyMethodMayBeStatic
 class DatasetInitializer:
     def __init__(self, image_height=256, image_width=256, channels=3, dataset_path='dataset/', normalized_input=True,
-                 sample_images_path='sample_images/'):
+                 sample_images_path='sample_images/', use_annotations_index=True):
         self.dataset_path = dataset_path
+        self.use_annotations_index = use_annotations_index
         self.sample_images_path = sample_images_path
         self.image_height = image_height
         self.image_width = image_width
@@ -127,8 +163,7 @@ class DatasetInitializer:
 
     def random_jitter(self, image):
         # resizing to 286 x 286 x 3
-        jitter_offset = 30
-        image = self.resize_to_thumbnail(image, self.image_height + jitter_offset, self.image_width + jitter_offset)
+        image = self.resize_to_thumbnail(image, self.image_height + JITTER_OFFSET, self.image_width + JITTER_OFFSET)
 
         # randomly cropping to 256 x 256 x 3
         image = tf.image.random_crop(
@@ -150,6 +185,50 @@ class DatasetInitializer:
         image = self.random_jitter(image)
         return image, intensity
 
+    def resize_image_for_cache(self, image, intensity, train=True):
+        """
+        Resizes a decoded image to the size expected after the cache and keeps it as uint8, so the cache stores
+        4x less data than normalized float32 images. Train images are resized to the random jitter input size,
+        test images directly to [image_height, image_width].
+        """
+        if train:
+            image = self.resize_to_thumbnail(image, self.image_height + JITTER_OFFSET, self.image_width + JITTER_OFFSET)
+        else:
+            image = self.resize_to_thumbnail(image, self.image_height, self.image_width)
+        return tf.cast(image, tf.uint8), intensity
+
+    def augment_cached_image_train(self, image, intensity):
+        # random jitter first: cropping and flipping uint8 images is cheaper than float32 ones
+        image = self.random_jitter(image)
+        return self.normalize_image_and_intensity(image, intensity)
+
+    def cache_dataset(self, dataset, cache_path, name, key=''):
+        """
+        Caches a dataset in memory if `cache_path` is None, otherwise in cache files inside `cache_path`,
+        which allows datasets larger than the RAM. Cache files are reused by later runs with the same `name` and
+        `key`, the files of `name` with another key are deleted, so the directory keeps a single cache per name.
+        """
+        if cache_path is None:
+            return dataset.cache()
+        import glob
+        from . import tools
+        tools.create_dir(cache_path)
+        prefix = os.path.join(cache_path, '{}-{}'.format(name, key))
+        for path in glob.glob(os.path.join(glob.escape(cache_path), glob.escape(name) + '-*')):
+            # The cache files are the prefix followed by '.index', '_<shard>.data-...' or '.lockfile'
+            if not path.startswith(prefix + '.') and not path.startswith(prefix + '_'):
+                os.remove(path)
+        return dataset.cache(prefix)
+
+    def cache_key(self, source):
+        """
+        Key of the cache files of a split: the cached images depend on their source (the split file paths, or the
+        shards) and on the size they were resized to.
+        """
+        import hashlib
+        size = '{}x{}+{}'.format(self.image_height, self.image_width, JITTER_OFFSET)
+        return hashlib.md5('{}\n{}'.format(size, source).encode()).hexdigest()[:12]
+
     def preprocess_image_test(self, image, intensity):
         image, intensity = self.normalize_image_and_intensity(image, intensity)
         image = self.resize_to_thumbnail(image, self.image_height, self.image_width)
@@ -158,35 +237,26 @@ class DatasetInitializer:
     def process_annotations_file(self, file_path):
         df = pd.read_csv(file_path, names=[COLUMN_PATH, COLUMN_INTENSITY])
         parent = os.path.dirname(file_path)
-        df[COLUMN_PATH] = df[COLUMN_PATH].apply(lambda p: os.path.join(parent, p))
+        paths = df[COLUMN_PATH].astype(str)
+        # Same as os.path.join(parent, path) per row: absolute paths replace the parent
+        df[COLUMN_PATH] = paths.where(paths.map(os.path.isabs), os.path.join(parent, '') + paths)
         return df
 
-    def annotations_to_dataframe(self, path):
-        import numpy as np
-        images_df = None
-        annotation_files = None
-        # Because tf.io.matching_files doesn't walk recursively on linux, had to do it manually
-        for d in tf.io.gfile.walk(path):
-            files = tf.io.matching_files(os.path.join(d[0], "Annotations*.csv")).numpy()
-            if annotation_files is not None:
-                annotation_files = np.concatenate((annotation_files, files))
-            else:
-                annotation_files = files
-
-        if annotation_files is None:
-            raise Exception("No annotation files found!")
-
-        for s in annotation_files:
-            df = self.process_annotations_file(s.decode())
-            if images_df is None:
-                images_df = df
-            else:
-                images_df = images_df.append(df)
-
-        if images_df is None:
-            raise Exception("No images found!")
+    def annotations_index_path(self, path):
+        """
+        The annotations index is saved next to the dataset directory rather than inside it, since writing it
+        inside would change the modification time of the directory and invalidate it.
+        :param path: the dataset path
+        :return: the index path, None if the index is disabled
+        """
+        if not self.use_annotations_index:
+            return None
+        return os.path.normpath(path) + '.annotations_index.pkl'
 
-        return images_df
+    def annotations_to_dataframe(self, path):
+        from . import annotations
+        return annotations.annotations_to_dataframe(path, self.process_annotations_file,
+                                                    index_path=self.annotations_index_path(path))
 
     def fill_train_test_dataframes(self, test_split=0.3, random_seed=None):
         images_df = self.annotations_to_dataframe(self.dataset_path)
@@ -207,44 +277,135 @@ class DatasetInitializer:
         print("Found {} sample clear image(s) and {} sample fog image(s)".format(df_length(self.sample_clear_df),
                                                                                  df_length(self.sample_fog_df)))
 
+    def build_shards(self, shards_path, test_split=0.3, random_seed=None, images_per_shard=1000,
+                     compression='GZIP', autotune=tf.data.experimental.AUTOTUNE):
+        """
+        Decodes every train and test image once, center-resizes it to the random jitter input size
+        ([image_height + 30, image_width + 30]) and writes the results into compressed TFRecord shards with a
+        manifest, to be read by `prepare_dataset(shards_path=...)`.
+        The train/test split is done here, so it's fixed for all trainings reading these shards.
+        :param shards_path: the output directory
+        :param test_split:
+        :param random_seed:
+        :param images_per_shard: maximum number of images in a single shard
+        :param compression: TFRecord compression type: 'GZIP', 'ZLIB' or ''
+        :param autotune:
+        :return: the manifest dict
+        """
+        from . import shards, tools
+        tools.create_dir(shards_path)
+        self.fill_train_test_dataframes(test_split, random_seed=random_seed)
+        height = self.image_height + JITTER_OFFSET
+        width = self.image_width + JITTER_OFFSET
+
+        def resize(image, intensity):
+            image = self.resize_to_thumbnail(image, height, width)
+            return tf.cast(image, tf.uint8), intensity
+
+        manifest = {
+            'image_height': height,
+            'image_width': width,
+            'channels': self.channels,
+            'compression': compression,
+            'splits': {},
+        }
+        for split_name, df in [(SPLIT_TRAIN_CLEAR, self.train_clear_df), (SPLIT_TRAIN_FOG, self.train_fog_df),
+                               (SPLIT_TEST_CLEAR, self.test_clear_df), (SPLIT_TEST_FOG, self.test_fog_df)]:
+            dataset = image_names_dataset(df).map(self.preprocess_image_path, num_parallel_calls=autotune).map(
+                resize, num_parallel_calls=autotune).prefetch(autotune)
+            files, count = shards.write_shards(dataset, shards_path, split_name, images_per_shard, compression)
+            manifest['splits'][split_name] = {'files': files, 'count': count}
+            print("Split {}: {} image(s) written in {} shard(s)".format(split_name, count, len(files)))
+
+        shards.save_manifest(shards_path, manifest)
+        return manifest
+
+    def shards_to_datasets(self, shards_path, autotune=tf.data.experimental.AUTOTUNE):
+        from . import shards
+        manifest = shards.load_manifest(shards_path)
+        train_clear = shards.read_shards(shards_path, SPLIT_TRAIN_CLEAR, manifest, autotune=autotune)
+        train_fog = shards.read_shards(shards_path, SPLIT_TRAIN_FOG, manifest, autotune=autotune)
+        test_clear = shards.read_shards(shards_path, SPLIT_TEST_CLEAR, manifest, autotune=autotune)
+        test_fog = shards.read_shards(shards_path, SPLIT_TEST_FOG, manifest, autotune=autotune)
+        counts = {split_name: split['count'] for split_name, split in manifest['splits'].items()}
+        print("Read shards from {}: {}".format(shards_path, counts))
+        return train_clear, train_fog, test_clear, test_fog
+
     def prepare_dataset(self, batch_size, buffer_size=1000,
                         test_split=0.3,
                         autotune=tf.data.experimental.AUTOTUNE,
                         return_sample=True, sample_batch_size=1,
-                        random_seed=None):
-        self.fill_train_test_dataframes(test_split, random_seed=random_seed)
+                        random_seed=None, shards_path=None, cache_path=None, drop_remainder=True):
+        """
+        Reads, decodes and resizes the images once, caches them as uint8 (in memory, or on disk when `cache_path`
+        is set), then shuffles them and applies the random intensities, random jitter and normalization after the
+        cache, so they change every epoch.
+        :param batch_size:
+        :param buffer_size: shuffle buffer size
+        :param test_split:
+        :param autotune:
+        :param return_sample:
+        :param sample_batch_size:
+        :param random_seed: seed of the train/test split
+        :param shards_path: if set, train and test images are read from the TFRecord shards written by
+            `build_shards` instead of the original files, `test_split` and `random_seed` are then ignored for them
+        :param cache_path: directory of the cache files, the datasets are cached in memory if None. The files are
+            reused by the next runs only with the same split, so a `random_seed` (or `shards_path`) is needed for
+            the cache to be reused. A new split replaces the previous cache files
+        :param drop_remainder: drops the last incomplete train batch, so every train step has the same batch size
+        :return:
+        """
+        import json
         self.fill_sample_dataframes()
 
-        train_clear_gen = image_names_generator(self.train_clear_df, intensity_value=INTENSITY_VALUE_RANDOM)
-        train_fog_gen = image_names_generator(self.train_fog_df)
-        test_clear_gen = image_names_generator(self.test_clear_df, intensity_value=INTENSITY_VALUE_RANDOM)
-        test_fog_gen = image_names_generator(self.test_fog_df)
-        sample_clear_gen = image_names_generator(self.sample_clear_df, intensity_value=INTENSITY_VALUE_SAMPLE)
-        sample_fog_gen = image_names_generator(self.sample_fog_df)
-
-        output_types = (tf.string, tf.float32)
-        train_clear = tf.data.Dataset.from_generator(train_clear_gen, output_types).shuffle(buffer_size).map(
-            self.preprocess_image_path)
-        train_fog = tf.data.Dataset.from_generator(train_fog_gen, output_types).shuffle(buffer_size).map(
-            self.preprocess_image_path)
-        test_clear = tf.data.Dataset.from_generator(test_clear_gen, output_types).shuffle(buffer_size).map(
-            self.preprocess_image_path)
-        test_fog = tf.data.Dataset.from_generator(test_fog_gen, output_types).shuffle(buffer_size).map(
-            self.preprocess_image_path)
-        sample_clear = tf.data.Dataset.from_generator(sample_clear_gen, output_types).map(self.preprocess_image_path)
-        sample_fog = tf.data.Dataset.from_generator(sample_fog_gen, output_types).map(self.preprocess_image_path)
-
-        train_clear = train_clear.map(
-            self.preprocess_image_train, num_parallel_calls=autotune).cache().batch(batch_size)
-
-        train_fog = train_fog.map(
-            self.preprocess_image_train, num_parallel_calls=autotune).cache().batch(batch_size)
-
-        test_clear = test_clear.map(
-            self.preprocess_image_test, num_parallel_calls=autotune).cache().batch(batch_size)
-
-        test_fog = test_fog.map(
-            self.preprocess_image_test, num_parallel_calls=autotune).cache().batch(batch_size)
+        if shards_path is not None:
+            from . import shards
+            # Train and test images were already resized by `build_shards`
+            train_clear, train_fog, test_clear, test_fog = self.shards_to_datasets(shards_path, autotune)
+            # The manifest lists the shard files and image counts, it changes when the shards are built again
+            source = '{}\n{}'.format(os.path.abspath(shards_path),
+                                     json.dumps(shards.load_manifest(shards_path), sort_keys=True))
+            cache_keys = [self.cache_key(source)] * 4
+        else:
+            self.fill_train_test_dataframes(test_split, random_seed=random_seed)
+            dataframes = [self.train_clear_df, self.train_fog_df, self.test_clear_df, self.test_fog_df]
+            # File reads and decoding run in parallel, the order doesn't matter since it's shuffled after the cache
+            train_clear, train_fog, test_clear, test_fog = [
+                image_names_dataset(df, autotune=autotune).map(self.preprocess_image_path,
+                                                               num_parallel_calls=autotune, deterministic=False)
+                for df in dataframes]
+            # The cache files are only valid for the same split
+            cache_keys = [self.cache_key('\n'.join(df[COLUMN_PATH])) for df in dataframes]
+
+        def prepare(dataset, name, cache_key, train, clear):
+            dataset = dataset.map(lambda image, intensity: self.resize_image_for_cache(image, intensity, train),
+                                  num_parallel_calls=autotune, deterministic=False)
+            dataset = self.cache_dataset(dataset, cache_path, name, cache_key)
+            dataset = dataset.shuffle(buffer_size, reshuffle_each_iteration=True)
+            if clear:
+                # Clear images get a new random intensity each epoch
+                dataset = dataset.map(lambda image, intensity: (image, random_intensity()),
+                                      num_parallel_calls=autotune)
+            if train:
+                dataset = dataset.map(self.augment_cached_image_train, num_parallel_calls=autotune)
+            else:
+                dataset = dataset.map(self.normalize_image_and_intensity, num_parallel_calls=autotune)
+            return dataset.batch(batch_size, drop_remainder=drop_remainder and train).prefetch(autotune)
+
+        train_clear = prepare(train_clear, SPLIT_TRAIN_CLEAR, cache_keys[0], train=True, clear=True)
+        train_fog = prepare(train_fog, SPLIT_TRAIN_FOG, cache_keys[1], train=True, clear=False)
+        test_clear = prepare(test_clear, SPLIT_TEST_CLEAR, cache_keys[2], train=False, clear=True)
+        test_fog = prepare(test_fog, SPLIT_TEST_FOG, cache_keys[3], train=False, clear=False)
+
+        if not return_sample:
+            return (train_clear, train_fog), (test_clear, test_fog)
+
+        # Sample images are few and always iterated in the same order, they're kept in memory
+        sample_clear = image_names_dataset(self.sample_clear_df, intensity_value=INTENSITY_VALUE_SAMPLE,
+                                           autotune=autotune)
+        sample_fog = image_names_dataset(self.sample_fog_df, autotune=autotune)
+        sample_clear = sample_clear.map(self.preprocess_image_path, num_parallel_calls=autotune)
+        sample_fog = sample_fog.map(self.preprocess_image_path, num_parallel_calls=autotune)
 
         sample_clear = sample_clear.map(
             self.preprocess_image_test, num_parallel_calls=autotune).cache().batch(sample_batch_size)
@@ -252,7 +413,4 @@ class DatasetInitializer:
         sample_fog = sample_fog.map(
             self.preprocess_image_test, num_parallel_calls=autotune).cache().batch(sample_batch_size)
 
-        if return_sample:
-            return (train_clear, train_fog), (test_clear, test_fog), (sample_clear, sample_fog)
-
-        return (train_clear, train_fog), (test_clear, test_fog)
\ No newline at end of file
+        return (train_clear, train_fog), (test_clear, test_fog), (sample_clear, sample_fog)
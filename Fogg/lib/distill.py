@@ -0,0 +1,173 @@
+import tensorflow as tf
+import os
+
+# Bundle of the student generator (and its optimizer) in a weights directory, next to the trainer's bundle
+STUDENT_WEIGHTS_FILENAME = 'generator_clear2fog_student.fogg'
+# Groups of the student bundle, `bundle.load_bundle_weights(path, {STUDENT_GROUP: student})` loads the student alone
+STUDENT_GROUP = 'generator_clear2fog_student'
+STUDENT_OPTIMIZER_GROUP = 'generator_clear2fog_student_optimizer'
+
+
+class Distiller:
+    """
+    Trains a student generator (`ModelsBuilder.build_student_generator`) to reproduce the outputs of the trained
+    clear2fog generator of a `Trainer`, the teacher, on clear images and random intensities. No discriminator is
+    involved, the student only learns the teacher's mapping. The distillation step runs like `Trainer.train_step`:
+    in the trainer's strategy, with its optimizer settings, loss scaling and XLA compilation.
+    """
+
+    def __init__(self, trainer, student, intensities_per_image=2):
+        """
+        :param trainer: a `Trainer` whose `generator_clear2fog` is trained, e.g. after `Trainer.configure_checkpoint`.
+            The teacher isn't trained, the student gets an optimizer from `Trainer.create_optimizer`
+        :param student: the generator to train, with the same (image, intensity) inputs, built in the trainer's
+            strategy scope (`ModelsBuilder(strategy=...)`)
+        :param intensities_per_image: each image of a batch is used with that many random intensities in a step
+        """
+        self.trainer = trainer
+        self.teacher = trainer.generator_clear2fog
+        self.student = student
+        self.normalized_input = trainer.normalized_input
+        self.intensities_per_image = intensities_per_image
+        self.optimizer = trainer.create_optimizer(loss_scale=student.compute_dtype == 'float16')
+        self.distill_step_element_spec = None
+        self.distill_step = None
+        self.replica_distill_step = None
+        self.build_distill_step()
+        self.total_steps = 0
+
+    def build_distill_step(self):
+        # Same as `Trainer.build_train_step`
+        if not self.trainer.distributed:
+            image_shape = [None] + list(self.student.inputs[0].shape[1:])
+            self.distill_step = tf.function(self.distill_step_body,
+                                            input_signature=[tf.TensorSpec(image_shape, tf.float32)],
+                                            jit_compile=self.trainer.jit_compile)
+            return
+        self.replica_distill_step = tf.function(self.distill_step_body, jit_compile=True) if self.trainer.jit_compile \
+            else self.distill_step_body
+        input_signature = [self.distill_step_element_spec] if self.distill_step_element_spec is not None else None
+        self.distill_step = tf.function(self.distributed_distill_step_body, input_signature=input_signature)
+
+    def distributed_distill_step_body(self, images):
+        strategy = self.trainer.strategy
+        per_replica_loss = strategy.run(self.replica_distill_step, args=(images,))
+        return strategy.reduce(tf.distribute.ReduceOp.SUM, per_replica_loss, axis=None)
+
+    def to_model_intensity(self, intensity):
+        return intensity * 2 - 1 if self.normalized_input else intensity
+
+    def to_unit_range(self, image):
+        return image * 0.5 + 0.5 if self.normalized_input else image
+
+    def distill_step_body(self, images):
+        """
+        :param images: batch of clear images, in the models input range
+        :return: the mean absolute difference between the student and the teacher outputs, divided by the number of
+            replicas
+        """
+        images = tf.tile(images, [self.intensities_per_image, 1, 1, 1])
+        intensity = self.to_model_intensity(tf.random.uniform([tf.shape(images)[0], 1], 0., 1.))
+        teacher_output = self.teacher((images, intensity), training=False)
+        with tf.GradientTape() as tape:
+            student_output = self.student((images, intensity), training=True)
+            loss = tf.reduce_mean(tf.abs(tf.cast(student_output, tf.float32) - tf.cast(teacher_output, tf.float32)))
+            # The gradients are summed over the replicas, as in `Trainer.train_step_body`
+            loss *= 1.0 / self.trainer.strategy.num_replicas_in_sync
+            scaled_loss = self.trainer.get_scaled_loss(self.optimizer, loss)
+        gradients = self.trainer.get_unscaled_gradients(
+            self.optimizer, tape.gradient(scaled_loss, self.student.trainable_variables))
+        self.optimizer.apply_gradients(zip(gradients, self.student.trainable_variables))
+        return loss
+
+    def distill(self, train_clear, epochs=10, progress_print_rate=10, weights_path=None, test_clear=None):
+        """
+        :param train_clear: dataset of (images, intensities) batches, like the `train_clear` of `Trainer.train`.
+            The intensities are ignored, the steps draw their own
+        :param epochs:
+        :param progress_print_rate: prints the loss every `progress_print_rate` steps
+        :param weights_path: if set, the student is saved there after each epoch (`save_student`), by the chief
+            worker only
+        :param test_clear: if set, `evaluate` runs on it after each epoch
+        :return: list of the mean loss of each epoch
+        """
+        from .tools import print_with_timestamp
+        dataset = train_clear.map(lambda images, intensities: images)
+        if self.trainer.distributed:
+            dataset = self.trainer.strategy.experimental_distribute_dataset(dataset)
+            if dataset.element_spec != self.distill_step_element_spec:
+                self.distill_step_element_spec = dataset.element_spec
+                self.build_distill_step()
+        chief = self.trainer.is_chief()
+        epoch_losses = []
+        for epoch in range(epochs):
+            total_loss = 0.
+            steps = 0
+            for images in dataset:
+                loss = float(self.distill_step(images))
+                total_loss += loss
+                steps += 1
+                self.total_steps += 1
+                if progress_print_rate and steps % progress_print_rate == 0:
+                    print_with_timestamp("Epoch {}, step {}: loss {:.4f}".format(epoch + 1, steps, loss))
+            epoch_losses.append(total_loss / max(steps, 1))
+            print_with_timestamp("Epoch {} done, mean loss {:.4f}".format(epoch + 1, epoch_losses[-1]))
+            if test_clear is not None:
+                fidelity = self.evaluate(test_clear)
+                print_with_timestamp("Fidelity: MAE {mae:.4f}, PSNR {psnr:.2f} dB".format(**fidelity))
+            if chief and weights_path is not None:
+                self.save_student(weights_path)
+        return epoch_losses
+
+    def evaluate(self, test_clear, intensities=(0.1, 0.3, 0.5, 0.7, 0.9)):
+        """
+        Compares the student with the teacher on each batch of `test_clear` at fixed intensities, in range [0,1].
+        :param test_clear: dataset of (images, intensities) batches, the intensities are ignored
+        :param intensities: intensities in range [0,1]
+        :return: dict with the mean absolute error 'mae', the PSNR in dB 'psnr' and the 'mae' of each intensity
+            'mae_per_intensity'
+        """
+        errors = {intensity: [] for intensity in intensities}
+        squared_errors = []
+        for images, _ in test_clear:
+            for intensity in intensities:
+                model_intensity = self.to_model_intensity(tf.fill([tf.shape(images)[0], 1], float(intensity)))
+                teacher_output = self.to_unit_range(self.teacher((images, model_intensity), training=False))
+                student_output = self.to_unit_range(self.student((images, model_intensity), training=False))
+                difference = tf.cast(student_output, tf.float32) - tf.cast(teacher_output, tf.float32)
+                errors[intensity].append(float(tf.reduce_mean(tf.abs(difference))))
+                squared_errors.append(float(tf.reduce_mean(tf.square(difference))))
+        mae_per_intensity = {intensity: sum(e) / max(len(e), 1) for intensity, e in errors.items()}
+        mse = sum(squared_errors) / max(len(squared_errors), 1)
+        return {
+            'mae': sum(mae_per_intensity.values()) / len(mae_per_intensity),
+            'psnr': float(10 * tf.math.log(1. / max(mse, 1e-10)) / tf.math.log(10.)),
+            'mae_per_intensity': mae_per_intensity,
+        }
+
+    def get_bundle_objects(self, include_optimizer=True):
+        objects = {STUDENT_GROUP: self.student}
+        if include_optimizer:
+            objects[STUDENT_OPTIMIZER_GROUP] = self.optimizer
+        return objects
+
+    def save_student(self, weights_path, save_optimizer=True):
+        """
+        Writes the student (and its optimizer) in a bundle with `Trainer.save_bundle`.
+        :return: the bundle path
+        """
+        from . import tools
+        tools.create_dir(weights_path)
+        path = os.path.join(weights_path, STUDENT_WEIGHTS_FILENAME)
+        self.trainer.save_bundle(path, objects=self.get_bundle_objects(save_optimizer))
+        print("Student saved: {}".format(path))
+        return path
+
+    def load_student(self, weights_path, load_optimizer=True):
+        """
+        Loads a student saved by `save_student`, to continue its distillation.
+        """
+        if load_optimizer:
+            self.trainer.build_optimizer(self.optimizer, self.student)
+        self.trainer.load_bundle(os.path.join(weights_path, STUDENT_WEIGHTS_FILENAME),
+                                 objects=self.get_bundle_objects(load_optimizer))
@@ -0,0 +1,125 @@
+import tensorflow as tf
+import json
+import os
+import sys
+
+TF_CONFIG = 'TF_CONFIG'
+
+
+def configure_local_devices(num_cpus):
+    """
+    Splits the host CPU into `num_cpus` logical devices, so a `MirroredStrategy` can be tested without GPUs.
+    Must be called before TensorFlow initializes its devices (before any tensor is created).
+    :param num_cpus: number of logical CPU devices
+    :return: list of the logical CPU device names
+    """
+    cpu = tf.config.list_physical_devices('CPU')[0]
+    tf.config.set_logical_device_configuration(cpu, [tf.config.LogicalDeviceConfiguration()] * num_cpus)
+    return [device.name for device in tf.config.list_logical_devices('CPU')]
+
+
+def create_strategy(kind='mirrored', num_cpus=None):
+    """
+    Creates the distribution strategy given to `ModelsBuilder` and `Trainer`.
+    :param kind: 'mirrored': one replica per local GPU (or per logical CPU if `num_cpus` is set).
+        'multi_worker': one replica per worker process, the cluster and the worker's task are read from the
+        TF_CONFIG environment variable (see `local_cluster_config`)
+    :param num_cpus: number of logical CPU devices for 'mirrored', None uses the GPUs (or the CPU if there aren't)
+    :return: tf.distribute.Strategy
+    """
+    if kind == 'mirrored':
+        devices = configure_local_devices(num_cpus) if num_cpus is not None else None
+        return tf.distribute.MirroredStrategy(devices=devices)
+    if kind == 'multi_worker':
+        if TF_CONFIG not in os.environ:
+            raise Exception("The {} environment variable is required by the multi worker strategy".format(TF_CONFIG))
+        return tf.distribute.MultiWorkerMirroredStrategy()
+    raise Exception("Unknown strategy: {}".format(kind))
+
+
+def is_chief(strategy):
+    """
+    The chief is the worker that saves the weights and writes the logs: the 'chief' task if the cluster has one,
+    otherwise the worker 0. A strategy without a cluster is always the chief.
+    """
+    resolver = getattr(strategy, 'cluster_resolver', None)
+    if resolver is None or not resolver.task_type:
+        return True
+    if resolver.task_type == 'chief':
+        return True
+    return resolver.task_type == 'worker' and resolver.task_id == 0 and \
+        'chief' not in resolver.cluster_spec().as_dict()
+
+
+def local_cluster_config(num_workers, base_port=23456, host='localhost'):
+    """
+    TF_CONFIG values of a cluster of `num_workers` worker processes on the same host.
+    :param num_workers:
+    :param base_port: the workers listen on consecutive ports starting from it
+    :param host:
+    :return: list of dicts, one per worker
+    """
+    workers = ['{}:{}'.format(host, base_port + i) for i in range(num_workers)]
+    return [{'cluster': {'worker': workers}, 'task': {'type': 'worker', 'index': i}} for i in range(num_workers)]
+
+
+def launch_local_workers(args, num_workers, base_port=23456):
+    """
+    Runs `num_workers` python processes with the same arguments, each one with its own TF_CONFIG, and waits for them.
+    Every worker should create its strategy with `create_strategy('multi_worker')`.
+    :param args: arguments of the python interpreter, e.g. ['-m', 'lib.distribute', '--worker']
+    :param num_workers:
+    :param base_port:
+    :return: list of the workers exit codes
+    """
+    import subprocess
+    processes = []
+    for config in local_cluster_config(num_workers, base_port):
+        env = dict(os.environ)
+        env[TF_CONFIG] = json.dumps(config)
+        processes.append(subprocess.Popen([sys.executable] + list(args), env=env))
+    return [p.wait() for p in processes]
+
+
+def run_worker(steps=2, batch_size_per_replica=1):
+    """
+    Trains fresh models on random images for `steps` steps with the multi worker strategy, used to check a local
+    cluster started by `launch_local_workers`.
+    """
+    from .models import ModelsBuilder
+    from .train import Trainer
+    from .tools import print_with_timestamp
+    strategy = create_strategy('multi_worker')
+    builder = ModelsBuilder(strategy=strategy)
+    trainer = Trainer(builder.build_generator(use_transmission_map=False),
+                      builder.build_generator(use_transmission_map=False),
+                      builder.build_discriminator(use_intensity=False),
+                      builder.build_discriminator(use_intensity=False),
+                      strategy=strategy)
+    batch_size = batch_size_per_replica * strategy.num_replicas_in_sync
+    shape = (steps * batch_size, builder.image_height, builder.image_width, builder.output_channels)
+
+    def random_dataset(seed):
+        images = tf.random.stateless_uniform(shape, [seed, 0], -1, 1)
+        intensities = tf.random.stateless_uniform((shape[0], 1), [seed, 1], -1, 1)
+        return tf.data.Dataset.from_tensor_slices((images, intensities)).batch(batch_size, drop_remainder=True)
+
+    trainer.train(random_dataset(1), random_dataset(2), epochs=1, progress_print_rate=1, load_config_first=False,
+                  save_config_each_epoch=False, save_sample_generator_output=False,
+                  save_sample_gen_and_disc_output=False, plot_only_one_sample_gen_and_disc=False)
+    print_with_timestamp("Worker done, chief: {}".format(trainer.is_chief()))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Trains on random images with a local multi worker cluster")
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--steps', type=int, default=2)
+    parser.add_argument('--worker', action='store_true', help="run as one of the workers")
+    arguments = parser.parse_args()
+    if arguments.worker:
+        run_worker(arguments.steps)
+    else:
+        exit_codes = launch_local_workers(['-m', 'lib.distribute', '--worker', '--steps', str(arguments.steps)],
+                                          arguments.workers)
+        print("Workers exit codes: {}".format(exit_codes))
@@ -0,0 +1,65 @@
+import tensorflow as tf
+import numpy as np
+import math
+
+
+def gaussian_kernel_1d(sigma, radius=None):
+    """
+    Normalized 1D gaussian kernel.
+    :param sigma: standard deviation, in pixels
+    :param radius: kernel radius, the kernel has 2 * radius + 1 taps. Defaults to ceil(3 * sigma)
+    :return: float32 numpy array [2 * radius + 1]
+    """
+    if radius is None:
+        radius = max(1, int(math.ceil(3 * sigma)))
+    x = np.arange(-radius, radius + 1, dtype=np.float64)
+    kernel = np.exp(-0.5 * (x / sigma) ** 2)
+    return (kernel / kernel.sum()).astype(np.float32)
+
+
+class SeparableGaussianBlur(tf.keras.layers.Layer):
+    """Gaussian blur applied as a horizontal then a vertical 1D depthwise convolution, 2 * (2 * radius + 1)
+    multiply-adds per pixel and channel instead of (2 * radius + 1)^2 for a 2D kernel.
+    The borders are mirrored, so a constant map stays constant. Always computed in float32, the kernels aren't
+    weights and don't change the checkpoints layout."""
+
+    def __init__(self, sigma=2.0, radius=None, **kwargs):
+        kwargs.setdefault('dtype', 'float32')
+        super(SeparableGaussianBlur, self).__init__(**kwargs)
+        self.sigma = sigma
+        self.kernel = gaussian_kernel_1d(sigma, radius)
+        self.radius = len(self.kernel) // 2
+
+    def build(self, input_shape):
+        channels = input_shape[-1]
+        # depthwise_conv2d filters: [filter_height, filter_width, channels, 1]
+        kernel = np.tile(self.kernel[:, np.newaxis, np.newaxis], [1, channels, 1])
+        self.horizontal_kernel = tf.constant(kernel[np.newaxis], dtype=tf.float32)
+        self.vertical_kernel = tf.constant(kernel[:, np.newaxis], dtype=tf.float32)
+        super(SeparableGaussianBlur, self).build(input_shape)
+
+    def call(self, x, **kwargs):
+        r = self.radius
+        x = tf.pad(x, [[0, 0], [r, r], [r, r], [0, 0]], mode='REFLECT')
+        x = tf.nn.depthwise_conv2d(x, self.horizontal_kernel, strides=[1, 1, 1, 1], padding='VALID')
+        return tf.nn.depthwise_conv2d(x, self.vertical_kernel, strides=[1, 1, 1, 1], padding='VALID')
+
+    def get_config(self):
+        config = super(SeparableGaussianBlur, self).get_config()
+        config.update({'sigma': self.sigma, 'radius': self.radius})
+        return config
+
+
+def gauss_blur_model(shape, name=None, sigma=2.0, radius=None):
+    """
+    Model that blurs its input with a `SeparableGaussianBlur`, used to smooth the transmission map of the
+    generators built with `use_transmission_map=True, use_gauss_filter=True`.
+    :param shape: input shape [height, width, channels], height and width can be None
+    :param name: model name
+    :param sigma: standard deviation of the gaussian, in pixels
+    :param radius: kernel radius, defaults to ceil(3 * sigma)
+    :return: tf.keras.Model
+    """
+    inp = tf.keras.layers.Input(shape=shape, dtype='float32')
+    out = SeparableGaussianBlur(sigma, radius)(inp)
+    return tf.keras.Model(inputs=inp, outputs=out, name=name)
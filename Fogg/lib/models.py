@@ -1,11 +1,14 @@
 import tensorflow as tf
+from contextlib import contextmanager, nullcontext
 
 
 class InstanceNormalization(tf.keras.layers.Layer):
-    """Instance Normalization Layer (https://arxiv.org/abs/1607.08022)."""
+    """Instance Normalization Layer (https://arxiv.org/abs/1607.08022).
+    Always computed in float32, the moments of a bfloat16/float16 input aren't accurate enough."""
 
-    def __init__(self, epsilon=1e-5):
-        super(InstanceNormalization, self).__init__()
+    def __init__(self, epsilon=1e-5, **kwargs):
+        kwargs.setdefault('dtype', 'float32')
+        super(InstanceNormalization, self).__init__(**kwargs)
         self.epsilon = epsilon
 
     def build(self, input_shape):
@@ -23,17 +26,142 @@ class InstanceNormalization(tf.keras.layers.Layer):
 
     def call(self, x, **kwargs):
         mean, variance = tf.nn.moments(x, axes=[1, 2], keepdims=True)
-        inv = tf.math.rsqrt(variance + self.epsilon)
-        normalized = (x - mean) * inv
-        return self.scale * normalized + self.offset
+        # scale * (x - mean) * inv + offset, folded into a single multiply-add per element: the multiplier and the
+        # shift are computed once per image and channel
+        multiplier = self.scale * tf.math.rsqrt(variance + self.epsilon)
+        shift = self.offset - mean * multiplier
+        return x * multiplier + shift
+
+
+class IntensityDownsample(tf.keras.Sequential):
+    """First downsampling block of a model conditioned with 'concat', called on [image, intensity].
+    Its convolution has the weights of a convolution of the image with the intensity appended as a constant channel,
+    but the intensity plane is never built: the convolution of a constant plane is the intensity times the
+    convolution of a plane of ones, which is the same for every image of the batch (it's only computed once, with
+    the zero padded borders). `conv(image) + intensity * conv(ones)` has the outputs of the concatenation.
+    It's a `Sequential` with the layers of the block, so the checkpoints of the concatenation models load as is."""
+
+    def input_channels(self, input_shape):
+        image_shape = tf.TensorShape(input_shape[0])
+        return image_shape[:-1].concatenate([image_shape[-1] + 1])
+
+    def build(self, input_shape):
+        shape = self.input_channels(input_shape)
+        for layer in self.layers:
+            layer.build(shape)
+            shape = layer.compute_output_shape(shape)
+        self.built = True
+
+    def call(self, inputs, training=None):
+        image, intensity = inputs
+        conv = self.layers[0]
+        dtype = image.dtype
+        strides = [1] + list(conv.strides) + [1]
+        padding = conv.padding.upper()
+        ones = tf.ones(tf.concat([[1], tf.shape(image)[1:3], [1]], axis=0), dtype)
+        # The intensity channel is the last input channel of the kernels
+        if isinstance(conv, tf.keras.layers.SeparableConv2D):
+            depthwise = tf.cast(conv.depthwise_kernel, dtype)
+            pointwise = tf.cast(conv.pointwise_kernel, dtype)
+            x = tf.nn.separable_conv2d(image, depthwise[:, :, :-1], pointwise[:, :, :-1], strides, padding)
+            plane = tf.nn.separable_conv2d(ones, depthwise[:, :, -1:], pointwise[:, :, -1:], strides, padding)
+        else:
+            kernel = tf.cast(conv.kernel, dtype)
+            x = tf.nn.conv2d(image, kernel[:, :, :-1], strides, padding)
+            plane = tf.nn.conv2d(ones, kernel[:, :, -1:], strides, padding)
+        x = x + tf.cast(tf.reshape(intensity, [-1, 1, 1, 1]), dtype) * plane
+        if conv.use_bias:
+            x = tf.nn.bias_add(x, tf.cast(conv.bias, dtype))
+        x = conv.activation(x)
+        for layer in self.layers[1:]:
+            x = layer(x, training=training)
+        return x
+
+    def compute_output_shape(self, input_shape):
+        shape = self.input_channels(input_shape)
+        for layer in self.layers:
+            shape = layer.compute_output_shape(shape)
+        return shape
+
+
+class FiLM(tf.keras.layers.Layer):
+    """Feature-wise linear modulation (https://arxiv.org/abs/1709.07871) of a feature map by the intensity:
+    `x * (1 + gamma) + beta`, with per channel `gamma` and `beta` predicted from the intensity by a dense layer.
+    The dense layer starts at zero, so the modulation starts as the identity."""
+
+    def build(self, input_shape):
+        channels = input_shape[0][-1]
+        self.dense = tf.keras.layers.Dense(2 * channels, kernel_initializer='zeros', dtype=self.dtype_policy)
+        self.dense.build(input_shape[1])
+        super(FiLM, self).build(input_shape)
+
+    def call(self, inputs, **kwargs):
+        x, intensity = inputs
+        gamma, beta = tf.split(self.dense(tf.cast(intensity, self.compute_dtype)), 2, axis=-1)
+        gamma = gamma[:, tf.newaxis, tf.newaxis, :]
+        beta = beta[:, tf.newaxis, tf.newaxis, :]
+        return x * (1 + gamma) + beta
+
+
+# The generators downsample 8 times, so their input height and width must be multiples of 2^8
+GENERATOR_SIZE_MULTIPLE = 256
+# Filters of the downsampling levels of the student generators (`ModelsBuilder.build_student_generator`)
+STUDENT_FILTERS = (32, 64, 128, 128, 256, 256)
 
 
 class ModelsBuilder:
-    def __init__(self, output_channels=3, image_height=256, image_width=256, normalized_input=True):
+    def __init__(self, output_channels=3, image_height=256, image_width=256, normalized_input=True,
+                 dtype_policy=None, strategy=None, intensity_conditioning='concat'):
+        """
+        :param image_height: input height of the models. None builds fully convolutional models that take any height
+            (a multiple of `GENERATOR_SIZE_MULTIPLE` for the generators), they have the same weights as the fixed
+            size models and can load their checkpoints
+        :param image_width: input width of the models, None for any width
+        :param dtype_policy: Keras mixed precision policy used to build the models, e.g. 'mixed_bfloat16' (CPU) or
+            'mixed_float16' (GPU, needs loss scaling, which `Trainer` enables automatically). None keeps float32.
+            InstanceNormalization layers and the models outputs stay float32 either way.
+        :param strategy: a `tf.distribute.Strategy`, the models are built in its scope so their variables are
+            mirrored across its replicas. It should be the same strategy given to `Trainer`
+        :param intensity_conditioning: how the models with an intensity input use it. 'concat': appended to the
+            image as a constant channel (the layout of the existing weights), folded in the first convolution
+            (`IntensityDownsample`) instead of being built. 'film': modulates the output of each
+            downsampling block (`FiLM`), these models can't load weights trained with 'concat'.
+            'decoder': generators only, the encoder sees the image alone and the intensity modulates the bottleneck
+            and the skip connections in the decoder (`FiLM`). The generator is then an 'encoder' and a 'decoder'
+            model, so a sweep of intensities can encode the image once (`EncodedImages`). The discriminators use
+            'concat'
+        """
         self.output_channels = output_channels
         self.image_height = image_height
         self.image_width = image_width
         self.normalized_input = normalized_input
+        self.dtype_policy = dtype_policy
+        self.strategy = strategy
+        if intensity_conditioning not in ['concat', 'film', 'decoder']:
+            raise Exception("Unknown intensity conditioning: {}".format(intensity_conditioning))
+        self.intensity_conditioning = intensity_conditioning
+
+    @contextmanager
+    def policy_scope(self):
+        """
+        Keras layers take the global policy when they are created, so it's set only while building a model.
+        The distribution strategy scope, if any, is entered as well.
+        """
+        with self.strategy.scope() if self.strategy is not None else nullcontext():
+            if self.dtype_policy is None:
+                yield
+                return
+            previous_policy = tf.keras.mixed_precision.global_policy()
+            tf.keras.mixed_precision.set_global_policy(self.dtype_policy)
+            try:
+                yield
+            finally:
+                tf.keras.mixed_precision.set_global_policy(previous_policy)
+
+    def float32_output(self, x, name):
+        if self.dtype_policy is None:
+            return x
+        return tf.keras.layers.Activation('linear', dtype='float32', name=name)(x)
 
     def downsample(self, filters, size, norm_type='instancenorm', apply_norm=True):
         initializer = tf.random_normal_initializer(0., 0.02)
@@ -97,22 +225,87 @@ class ModelsBuilder:
 
         return result
 
-    def concatenate_image_and_intensity(self, image_input, intensity_input):
-        intensity = tf.keras.layers.RepeatVector(self.image_height * self.image_height)(intensity_input)
-        intensity = tf.keras.layers.Reshape((self.image_height, self.image_height, 1))(intensity)
-        return tf.keras.layers.Concatenate(axis=-1)([image_input, intensity])
+    def separable_downsample(self, filters, size, norm_type='instancenorm', apply_norm=True):
+        """
+        `downsample` with a depthwise separable convolution, for the student generators.
+        """
+        initializer = tf.random_normal_initializer(0., 0.02)
+
+        result = tf.keras.Sequential()
+        result.add(
+            tf.keras.layers.SeparableConv2D(filters, size, strides=2, padding='same',
+                                            depthwise_initializer=initializer, pointwise_initializer=initializer,
+                                            use_bias=False))
+
+        if apply_norm:
+            if norm_type.lower() == 'batchnorm':
+                result.add(tf.keras.layers.BatchNormalization())
+            elif norm_type.lower() == 'instancenorm':
+                result.add(InstanceNormalization())
+
+        result.add(tf.keras.layers.LeakyReLU())
+
+        return result
+
+    def separable_upsample(self, filters, size, norm_type='instancenorm'):
+        """
+        Bilinear upsampling followed by a depthwise separable convolution, for the student generators.
+        """
+        initializer = tf.random_normal_initializer(0., 0.02)
+
+        result = tf.keras.Sequential()
+        result.add(tf.keras.layers.UpSampling2D(2, interpolation='bilinear'))
+        result.add(
+            tf.keras.layers.SeparableConv2D(filters, size, padding='same',
+                                            depthwise_initializer=initializer, pointwise_initializer=initializer,
+                                            use_bias=False))
+
+        if norm_type.lower() == 'batchnorm':
+            result.add(tf.keras.layers.BatchNormalization())
+        elif norm_type.lower() == 'instancenorm':
+            result.add(InstanceNormalization())
+
+        result.add(tf.keras.layers.ReLU())
+
+        return result
+
+    def fold_intensity(self, block):
+        """
+        The first downsampling block of a model conditioned with 'concat', see `IntensityDownsample`.
+        """
+        return IntensityDownsample(block.layers)
+
+    def condition_on_intensity(self, x, intensity_input):
+        """
+        Applies the FiLM conditioning to the output of a downsampling block, if enabled and the model has an
+        intensity input.
+        """
+        if intensity_input is None or self.intensity_conditioning != 'film':
+            return x
+        return FiLM()([x, intensity_input])
+
+    def decoder_conditioning(self, intensity_input, count):
+        """
+        :return: `count` FiLM layers for the bottleneck and the skip connections of a generator with the 'decoder'
+            intensity conditioning, None otherwise
+        """
+        if intensity_input is None or self.intensity_conditioning != 'decoder':
+            return None
+        return [FiLM() for i in range(count)]
 
     def build_generator(self, use_transmission_map=False, use_gauss_filter=True, norm_type='instancenorm',
                         use_intensity=True, kernel_size=4,
-                        use_resize_conv=False):
-        image_input = tf.keras.layers.Input(shape=[self.image_height, self.image_height, self.output_channels])
-        inputs = image_input
-        x = image_input
-        if use_intensity:
-            intensity_input = tf.keras.layers.Input(shape=(1,))
-            inputs = [image_input, intensity_input]
-            x = self.concatenate_image_and_intensity(x, intensity_input)
-
+                        use_resize_conv=False, gauss_sigma=2.0):
+        """
+        :param gauss_sigma: standard deviation in pixels of the gaussian blur of the transmission map, with
+            `use_transmission_map` and `use_gauss_filter`
+        """
+        with self.policy_scope():
+            return self.build_generator_model(use_transmission_map, use_gauss_filter, norm_type, use_intensity,
+                                              kernel_size, use_resize_conv, gauss_sigma)
+
+    def build_generator_model(self, use_transmission_map, use_gauss_filter, norm_type, use_intensity, kernel_size,
+                              use_resize_conv, gauss_sigma=2.0):
         down_stack = [
             self.downsample(64, kernel_size, norm_type=norm_type, apply_norm=False),  # (bs, 128, 128, 64)
             self.downsample(128, kernel_size, norm_type=norm_type),  # (bs, 64, 64, 128)
@@ -154,48 +347,135 @@ class ModelsBuilder:
                                                name='transmission_layer' if use_transmission_map else 'output_layer',
                                                kernel_initializer=initializer,
                                                activation='tanh' if self.normalized_input else 'sigmoid')  # (bs, 256, 256, 1)
+        return self.unet_generator(down_stack, up_stack, last, use_intensity, use_transmission_map, use_gauss_filter,
+                                   gauss_sigma)
+
+    def build_student_generator(self, use_transmission_map=False, use_gauss_filter=True, norm_type='instancenorm',
+                                use_intensity=True, kernel_size=3, filters=STUDENT_FILTERS, gauss_sigma=2.0):
+        """
+        Slim generator with the interface of `build_generator`, trained to imitate a generator (`distill.Distiller`):
+        fewer levels, narrower and depthwise separable convolutions, without dropout.
+        :param filters: filters of each downsampling level, the upsampling levels mirror them. The input height and
+            width must be multiples of 2 ** len(filters)
+        """
+        with self.policy_scope():
+            down_stack = [self.separable_downsample(filters[0], kernel_size, norm_type=norm_type, apply_norm=False)]
+            down_stack += [self.separable_downsample(f, kernel_size, norm_type=norm_type) for f in filters[1:]]
+            up_stack = [self.separable_upsample(f, kernel_size, norm_type=norm_type) for f in reversed(filters[:-1])]
+            # The output layer of `build_generator`, full resolution from the first level
+            last = tf.keras.layers.Conv2DTranspose(1 if use_transmission_map else self.output_channels, 4, strides=2,
+                                                   padding='same',
+                                                   kernel_initializer=tf.random_normal_initializer(0., 0.02),
+                                                   name='transmission_layer' if use_transmission_map
+                                                   else 'output_layer',
+                                                   activation='tanh' if self.normalized_input else 'sigmoid')
+            return self.unet_generator(down_stack, up_stack, last, use_intensity, use_transmission_map,
+                                       use_gauss_filter, gauss_sigma)
+
+    def unet_generator(self, down_stack, up_stack, last, use_intensity, use_transmission_map, use_gauss_filter,
+                       gauss_sigma):
+        """
+        Connects the blocks of a generator: the downsampling blocks, the upsampling blocks with the skip
+        connections, the output layer and the transmission map composition, with the builder's intensity
+        conditioning.
+        """
+        image_input = tf.keras.layers.Input(shape=[self.image_height, self.image_width, self.output_channels])
+        inputs = image_input
+        x = image_input
+        intensity_input = None
+        if use_intensity:
+            intensity_input = tf.keras.layers.Input(shape=(1,))
+            inputs = [image_input, intensity_input]
+
         # Downsampling through the model
         skips = []
-        for down in down_stack:
-            x = down(x)
+        for i, down in enumerate(down_stack):
+            if i == 0 and intensity_input is not None and self.intensity_conditioning == 'concat':
+                x = self.fold_intensity(down)([x, intensity_input])
+            else:
+                x = self.condition_on_intensity(down(x), intensity_input)
             skips.append(x)
-        skips = reversed(skips[:-1])
 
+        films = self.decoder_conditioning(intensity_input, len(down_stack))
+        if films is None:
+            x = self.decode(skips, up_stack, last)
+            return tf.keras.Model(inputs=inputs, outputs=self.generator_output(image_input, x, use_transmission_map,
+                                                                               use_gauss_filter, gauss_sigma))
+
+        # 'decoder' conditioning: the encoder doesn't depend on the intensity, it's a model of its own so its
+        # features can be computed once and decoded for several intensities
+        encoder = tf.keras.Model(inputs=image_input, outputs=skips, name='encoder')
+        decoder_image_input = tf.keras.layers.Input(shape=image_input.shape[1:])
+        decoder_intensity_input = tf.keras.layers.Input(shape=(1,))
+        features_inputs = [tf.keras.layers.Input(shape=skip.shape[1:]) for skip in skips]
+        x = self.decode(features_inputs, up_stack, last, films, decoder_intensity_input)
+        x = self.generator_output(decoder_image_input, x, use_transmission_map, use_gauss_filter, gauss_sigma)
+        decoder = tf.keras.Model(inputs=[decoder_image_input, decoder_intensity_input] + features_inputs,
+                                 outputs=x, name='decoder')
+        return tf.keras.Model(inputs=inputs, outputs=decoder([image_input, intensity_input] + encoder(image_input)))
+
+    def decode(self, skips, up_stack, last, films=None, intensity_input=None):
+        """
+        Upsampling path of the generators.
+        :param skips: outputs of the downsampling blocks, the last one being the bottleneck
+        :param up_stack: upsampling blocks
+        :param last: the output layer
+        :param films: None, or one FiLM layer per element of `skips` modulating it by `intensity_input`
+        :param intensity_input:
+        :return: output of `last`
+        """
+        if films is not None:
+            skips = [film([skip, intensity_input]) for film, skip in zip(films, skips)]
+        x = skips[-1]
         # Upsampling and establishing the skip connections
-        for up, skip in zip(up_stack, skips):
+        for up, skip in zip(up_stack, reversed(skips[:-1])):
             x = up(x)
             x = tf.keras.layers.Concatenate()([x, skip])
+        return last(x)
 
-        x = last(x)
+    def generator_output(self, image_input, x, use_transmission_map, use_gauss_filter, gauss_sigma):
+        x = self.float32_output(x, 'output_float32')
         if use_transmission_map:
+            # The fog composition is computed in float32
             transmission = x
             if self.normalized_input:
-                transmission = tf.keras.layers.Lambda(lambda t: t * 0.5 + 0.5, name='fix_transmission_range')(
-                    transmission)
+                transmission = tf.keras.layers.Lambda(lambda t: t * 0.5 + 0.5, name='fix_transmission_range',
+                                                      dtype='float32')(transmission)
             if use_gauss_filter:
                 from . import gauss
-                transmission = gauss.gauss_blur_model([self.image_height, self.image_width, 1], name="gauss_blur")(
-                    transmission)
+                # A layer instead of `gauss.gauss_blur_model`, so the blurred map is reachable from the generator's
+                # graph (see `transmission.get_transmission_model`)
+                transmission = gauss.SeparableGaussianBlur(gauss_sigma, name="gauss_blur")(transmission)
 
-            x = tf.keras.layers.multiply([image_input, transmission])
-            one_minus_t = tf.keras.layers.Lambda(lambda t: 1 - t, name='transmission_invert')(transmission)
-            x = tf.keras.layers.add([x, one_minus_t])
-
-        return tf.keras.Model(inputs=inputs, outputs=x)
+            x = tf.keras.layers.multiply([image_input, transmission], dtype='float32')
+            one_minus_t = tf.keras.layers.Lambda(lambda t: 1 - t, name='transmission_invert',
+                                                 dtype='float32')(transmission)
+            x = tf.keras.layers.add([x, one_minus_t], dtype='float32')
+        return x
 
     def build_discriminator(self, norm_type='instancenorm', use_intensity=True, kernel_size=4):
+        with self.policy_scope():
+            return self.build_discriminator_model(norm_type, use_intensity, kernel_size)
+
+    def build_discriminator_model(self, norm_type, use_intensity, kernel_size):
         initializer = tf.random_normal_initializer(0., 0.02)
-        inp = tf.keras.layers.Input(shape=[256, 256, 3], name='input_image')
+        inp = tf.keras.layers.Input(shape=[self.image_height, self.image_width, 3], name='input_image')
         inputs = inp
         x = inp
+        intensity_input = None
         if use_intensity:
             intensity_input = tf.keras.layers.Input(shape=(1,))
             inputs = [inp, intensity_input]
-            x = self.concatenate_image_and_intensity(x, intensity_input)
 
-        down1 = self.downsample(64, kernel_size, norm_type=norm_type, apply_norm=False)(x)  # (bs, 128, 128, 64)
+        down1 = self.downsample(64, kernel_size, norm_type=norm_type, apply_norm=False)
+        if intensity_input is not None and self.intensity_conditioning != 'film':
+            down1 = self.fold_intensity(down1)([x, intensity_input])  # (bs, 128, 128, 64)
+        else:
+            down1 = self.condition_on_intensity(down1(x), intensity_input)  # (bs, 128, 128, 64)
         down2 = self.downsample(128, kernel_size, norm_type=norm_type)(down1)  # (bs, 64, 64, 128)
+        down2 = self.condition_on_intensity(down2, intensity_input)
         down3 = self.downsample(256, kernel_size, norm_type=norm_type)(down2)  # (bs, 32, 32, 256)
+        down3 = self.condition_on_intensity(down3, intensity_input)
 
         zero_pad1 = tf.keras.layers.ZeroPadding2D()(down3)  # (bs, 34, 34, 256)
         conv = tf.keras.layers.Conv2D(512, kernel_size, strides=1,
@@ -209,4 +489,65 @@ class ModelsBuilder:
         zero_pad2 = tf.keras.layers.ZeroPadding2D()(leaky_relu)  # (bs, 33, 33, 512)
         last = tf.keras.layers.Conv2D(1, kernel_size, strides=1,
                                       kernel_initializer=initializer)(zero_pad2)  # (bs, 30, 30, 1)
-        return tf.keras.Model(inputs=inputs, outputs=last)
\ No newline at end of file
+        last = self.float32_output(last, 'output_float32')
+        return tf.keras.Model(inputs=inputs, outputs=last)
+
+
+def split_generator(generator):
+    """
+    :param generator: a generator built with `ModelsBuilder(intensity_conditioning='decoder')`
+    :return: (encoder, decoder) models, or None if the generator isn't split. The encoder takes an image and returns
+        the features of the downsampling blocks, the decoder takes [image, intensity] + features
+    """
+    layer_names = [layer.name for layer in generator.layers]
+    if 'encoder' not in layer_names or 'decoder' not in layer_names:
+        return None
+    return generator.get_layer('encoder'), generator.get_layer('decoder')
+
+
+class EncodedImages:
+    """
+    Encoder state of a batch of images for a generator built with `intensity_conditioning='decoder'`: the encoder
+    runs once, then each intensity only runs the decoder.
+    """
+
+    def __init__(self, generator, images):
+        """
+        :param generator: a generator split in an encoder and a decoder (`split_generator`)
+        :param images: batch of images [batch, height, width, channels], in the generator's input range
+        """
+        split = split_generator(generator)
+        if split is None:
+            raise Exception("The generator doesn't have a separate encoder, build it with "
+                            "intensity_conditioning='decoder'")
+        self.encoder, self.decoder = split
+        self.images = tf.convert_to_tensor(images, dtype=tf.float32)
+        self.features = self.encoder(self.images)
+
+    def decode(self, intensity):
+        """
+        :param intensity: a float or a tensor [batch, 1], in the generator's input range
+        :return: the generator output for the cached images and this intensity
+        """
+        batch_size = tf.shape(self.images)[0]
+        intensity = tf.broadcast_to(tf.reshape(tf.cast(intensity, tf.float32), [-1, 1]), [batch_size, 1])
+        return self.decoder([self.images, intensity] + self.features)
+
+    def sweep(self, intensities, intensities_per_call=4):
+        """
+        Decodes the cached images for each intensity. `intensities_per_call` intensities are decoded in a single
+        call, with the features repeated along the batch axis.
+        :param intensities: list of floats, in the generator's input range
+        :param intensities_per_call:
+        :return: list of outputs [batch, height, width, channels], one per intensity
+        """
+        batch_size = self.images.shape[0]
+        outputs = []
+        for start in range(0, len(intensities), intensities_per_call):
+            chunk = list(intensities)[start:start + intensities_per_call]
+            count = len(chunk)
+            intensity = tf.repeat(tf.constant(chunk, dtype=tf.float32), batch_size)[:, tf.newaxis]
+            repeated = [tf.tile(x, [count, 1, 1, 1]) for x in [self.images] + self.features]
+            output = self.decoder([repeated[0], intensity] + repeated[1:])
+            outputs.extend(tf.split(output, count, axis=0))
+        return outputs
@@ -89,13 +89,17 @@ def plot_generators_and_discriminators_predictions(test_input_clear, prediction_
                                                    discriminator_clear_output, discriminator_fog_output,
                                                    discriminator_fakeclear_output, discriminator_fakefog_output,
                                                    normalized_input=True, close_fig=False):
+    """
+    With `close_fig`, the figure is created without pyplot: it can't be shown, but it can be saved from any thread.
+    """
     import matplotlib.pyplot as plt
+    from matplotlib.figure import Figure
 
     image_clear, intensity_clear, image_fog, intensity_fog = get_images_and_intensities(test_input_clear,
                                                                                         test_input_fog,
                                                                                         normalized_input)
 
-    fig = plt.figure(figsize=(20, 10))
+    fig = Figure(figsize=(20, 10)) if close_fig else plt.figure(figsize=(20, 10))
 
     display_list = [image_clear, discriminator_clear_output[0, ..., -1],
                     prediction_clear2fog[0], discriminator_fakefog_output[0, ..., -1],
@@ -106,20 +110,16 @@ def plot_generators_and_discriminators_predictions(test_input_clear, prediction_
              'Fog {:0.2}'.format(intensity_fog), 'Is real fog? Expected: Yes',
              'To Clear', 'Is real clear? Expected: No']
     for i in range(8):
-        plt.subplot(2, 4, i + 1)
-        plt.title(title[i])
-        plt.axis('off')
+        ax = fig.add_subplot(2, 4, i + 1)
+        ax.set_title(title[i])
+        ax.axis('off')
         to_display = display_list[i]
         if i % 2 == 0:
             if normalized_input:
                 to_display = to_display * 0.5 + 0.5
-            plt.imshow(to_display)
+            ax.imshow(to_display)
         else:
-            plt.imshow(to_display, cmap='RdBu_r')
-            plt.clim(-4, 4)
-            plt.colorbar()
-    if close_fig:
-        plt.close(fig)
+            fig.colorbar(ax.imshow(to_display, cmap='RdBu_r', vmin=-4, vmax=4), ax=ax)
     return fig
 
 
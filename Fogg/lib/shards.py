@@ -0,0 +1,116 @@
+import tensorflow as tf
+import os
+
+MANIFEST_FILENAME = 'manifest.json'
+FEATURE_IMAGE = 'image'
+FEATURE_HEIGHT = 'height'
+FEATURE_WIDTH = 'width'
+FEATURE_INTENSITY = 'intensity'
+
+
+def serialize_example(image, intensity):
+    """
+    Serializes a resized image and its intensity into a tf.train.Example.
+    The image is stored as raw uint8 bytes, so reading it back doesn't need any decoding.
+    :param image: uint8 numpy array [height, width, channels]
+    :param intensity: float intensity as found in the annotations
+    :return: bytes
+    """
+    feature = {
+        FEATURE_IMAGE: tf.train.Feature(bytes_list=tf.train.BytesList(value=[image.tobytes()])),
+        FEATURE_HEIGHT: tf.train.Feature(int64_list=tf.train.Int64List(value=[image.shape[0]])),
+        FEATURE_WIDTH: tf.train.Feature(int64_list=tf.train.Int64List(value=[image.shape[1]])),
+        FEATURE_INTENSITY: tf.train.Feature(float_list=tf.train.FloatList(value=[float(intensity)])),
+    }
+    return tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString()
+
+
+def write_shards(dataset, shards_path, split_name, images_per_shard=1000, compression='GZIP'):
+    """
+    Writes a dataset of (uint8 image, intensity) into compressed TFRecord shards named
+    `{split_name}-{index:05d}.tfrecord` inside `shards_path`.
+    :param dataset: tf.data.Dataset yielding (image [height, width, channels] uint8, intensity of shape (1,))
+    :param shards_path: the output directory, should already exist
+    :param split_name: prefix of the shard files
+    :param images_per_shard: maximum number of images in a single shard
+    :param compression: TFRecord compression type: 'GZIP', 'ZLIB' or ''
+    :return: (list of shard file names relative to `shards_path`, number of written images)
+    """
+    options = tf.io.TFRecordOptions(compression_type=compression)
+    files = []
+    count = 0
+    writer = None
+    for image, intensity in dataset.as_numpy_iterator():
+        if count % images_per_shard == 0:
+            if writer is not None:
+                writer.close()
+            filename = '{}-{:05d}.tfrecord'.format(split_name, len(files))
+            writer = tf.io.TFRecordWriter(os.path.join(shards_path, filename), options=options)
+            files.append(filename)
+        writer.write(serialize_example(image, intensity[0]))
+        count += 1
+    if writer is not None:
+        writer.close()
+    return files, count
+
+
+def save_manifest(shards_path, manifest):
+    """
+    Saves the manifest atomically, so a partially built shards directory is never mistaken for a complete one.
+    :param shards_path:
+    :param manifest: a json serializable dict
+    :return: None
+    """
+    import json
+    path = os.path.join(shards_path, MANIFEST_FILENAME)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def load_manifest(shards_path):
+    import json
+    path = os.path.join(shards_path, MANIFEST_FILENAME)
+    if not os.path.exists(path):
+        raise Exception("No shards manifest found in {}".format(shards_path))
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def parse_example(serialized, channels=3):
+    features = tf.io.parse_single_example(serialized, {
+        FEATURE_IMAGE: tf.io.FixedLenFeature([], tf.string),
+        FEATURE_HEIGHT: tf.io.FixedLenFeature([], tf.int64),
+        FEATURE_WIDTH: tf.io.FixedLenFeature([], tf.int64),
+        FEATURE_INTENSITY: tf.io.FixedLenFeature([1], tf.float32),
+    })
+    image = tf.io.decode_raw(features[FEATURE_IMAGE], tf.uint8)
+    image = tf.reshape(image, tf.stack([features[FEATURE_HEIGHT], features[FEATURE_WIDTH], channels]))
+    return image, features[FEATURE_INTENSITY]
+
+
+def read_shards(shards_path, split_name, manifest=None, cycle_length=4,
+                autotune=tf.data.experimental.AUTOTUNE):
+    """
+    Reads a split written by `write_shards`, interleaving the shard files in parallel.
+    :param shards_path: the directory containing the manifest and the shards
+    :param split_name: the split to read
+    :param manifest: the loaded manifest, loaded from `shards_path` if None
+    :param cycle_length: number of shard files read concurrently
+    :param autotune:
+    :return: tf.data.Dataset yielding (uint8 image, intensity of shape (1,))
+    """
+    if manifest is None:
+        manifest = load_manifest(shards_path)
+    if split_name not in manifest['splits']:
+        raise Exception("Split {} not found in {}".format(split_name, shards_path))
+    split = manifest['splits'][split_name]
+    files = [os.path.join(shards_path, f) for f in split['files']]
+    compression = manifest['compression']
+    channels = manifest['channels']
+    return tf.data.Dataset.from_tensor_slices(tf.constant(files, dtype=tf.string)).shuffle(len(files) + 1).interleave(
+        lambda f: tf.data.TFRecordDataset(f, compression_type=compression),
+        cycle_length=cycle_length,
+        num_parallel_calls=autotune,
+        deterministic=False).map(lambda s: parse_example(s, channels), num_parallel_calls=autotune)
@@ -0,0 +1,127 @@
+import tensorflow as tf
+import time
+
+
+def host_memory_mb():
+    """
+    Resident memory of the current process in MB, measured with psutil (in requirements.txt). Without psutil, falls
+    back to the peak resident memory reported by the `resource` module (not available on Windows).
+    :return: float, None if it can't be measured
+    """
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 2 ** 20
+    except ImportError:
+        pass
+    try:
+        import resource
+        import sys
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Bytes on macOS, kilobytes on linux
+        return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+    except ImportError:
+        return None
+
+
+class StepTelemetry:
+    """
+    Accumulates the duration of the training steps, split between the time spent waiting for the next batch of the
+    dataset iterator and the time spent in `train_step`, over a window of steps and over the whole epoch.
+    """
+
+    def __init__(self):
+        self.window = self.empty_totals()
+        self.epoch = self.empty_totals()
+
+    def empty_totals(self):
+        return {'steps': 0, 'images': 0, 'data_seconds': 0., 'step_seconds': 0.}
+
+    def record(self, data_seconds, step_seconds, images):
+        for totals in [self.window, self.epoch]:
+            totals['steps'] += 1
+            totals['images'] += images
+            totals['data_seconds'] += data_seconds
+            totals['step_seconds'] += step_seconds
+
+    def summarize(self, totals):
+        """
+        :return: dict of the mean metrics of `totals`, None if there wasn't any step
+        """
+        if totals['steps'] == 0:
+            return None
+        total_seconds = totals['data_seconds'] + totals['step_seconds']
+        return {
+            'images_per_sec': totals['images'] / total_seconds if total_seconds > 0 else 0.,
+            'data_wait_ms': 1000 * totals['data_seconds'] / totals['steps'],
+            'step_ms': 1000 * totals['step_seconds'] / totals['steps'],
+            'data_wait_fraction': totals['data_seconds'] / total_seconds if total_seconds > 0 else 0.,
+        }
+
+    def pop_window(self):
+        summary = self.summarize(self.window)
+        self.window = self.empty_totals()
+        return summary
+
+    def epoch_summary(self):
+        return self.summarize(self.epoch)
+
+    def write_summaries(self, summary, step, train_step_traces=None):
+        """
+        Writes the metrics of a summary with the default summary writer.
+        :param summary: dict returned by `pop_window` or `epoch_summary`
+        :param step: the global training step
+        :param train_step_traces: number of `train_step` traces so far
+        """
+        tf.summary.scalar('telemetry/images_per_sec', summary['images_per_sec'], step=step,
+                          description='clear/fog pairs per second')
+        tf.summary.scalar('telemetry/data_wait_ms', summary['data_wait_ms'], step=step,
+                          description='mean wait for the next batch of the dataset iterator')
+        tf.summary.scalar('telemetry/step_ms', summary['step_ms'], step=step,
+                          description='mean duration of train_step')
+        tf.summary.scalar('telemetry/data_wait_fraction', summary['data_wait_fraction'], step=step,
+                          description='fraction of the time spent waiting for the input pipeline')
+        if train_step_traces is not None:
+            tf.summary.scalar('telemetry/train_step_traces', train_step_traces, step=step)
+        memory = host_memory_mb()
+        if memory is not None:
+            tf.summary.scalar('telemetry/host_memory_mb', memory, step=step)
+
+
+class ProfilerWindow:
+    """
+    Records a `tf.profiler` trace of the global steps in [start, stop), viewable in the TensorBoard profile tab.
+    """
+
+    def __init__(self, logdir, start, stop):
+        self.logdir = logdir
+        self.start = start
+        self.stop = stop
+        self.running = False
+
+    def before_step(self, step):
+        if not self.running and self.start <= step < self.stop:
+            print("Starting the profiler at step {}, logdir: {}".format(step, self.logdir))
+            tf.profiler.experimental.start(self.logdir)
+            self.running = True
+
+    def after_step(self, step):
+        if self.running and step + 1 >= self.stop:
+            self.close()
+
+    def close(self):
+        if self.running:
+            tf.profiler.experimental.stop()
+            self.running = False
+            print("Profiler stopped, trace saved in {}".format(self.logdir))
+
+
+def timed_next(iterator):
+    """
+    :return: (next element or None at the end, seconds spent waiting for it)
+    """
+    start = time.perf_counter()
+    try:
+        element = next(iterator)
+    except StopIteration:
+        element = None
+    return element, time.perf_counter() - start
@@ -3,12 +3,29 @@ from . import plot
 import os
 from matplotlib import pyplot as plt
 import pickle
+import functools
 
 
 class Trainer:
     def __init__(self, generator_clear2fog, generator_fog2clear,
                  discriminator_fog, discriminator_clear, LAMBDA=10,
-                 lr=2e-4, beta_1=0.5, normalized_input=True, LAMBDA_MULTIPLIER=5):
+                 lr=2e-4, beta_1=0.5, normalized_input=True, LAMBDA_MULTIPLIER=5, jit_compile=False,
+                 use_intensity_for_fog_discriminator=False, use_transmission_map_loss=True, use_whitening_loss=True,
+                 use_rgb_ratio_loss=True, strategy=None, reuse_clear2fog_encoder=True):
+        """
+        Models built with a 'mixed_float16' policy (`ModelsBuilder(dtype_policy=...)`) get loss scaled optimizers,
+        'mixed_bfloat16' has the float32 range and doesn't need loss scaling.
+        The `use_*` flags are bound here, so `train_step` is traced once for the whole training instead of once
+        per flags combination.
+        :param jit_compile: compiles `train_step` with XLA
+        :param strategy: a `tf.distribute.Strategy` (see `distribute.create_strategy`), the models must have been
+            built in its scope (`ModelsBuilder(strategy=...)`). The train datasets batch size is then the global
+            batch size, split between the replicas, and should be a multiple of the number of replicas.
+            None trains in a single replica
+        :param reuse_clear2fog_encoder: with a clear2fog generator built with `intensity_conditioning='decoder'`,
+            encodes the real clear images once in `train_step` and decodes them for the clear, zero and full
+            intensities, instead of running the whole generator 3 times. The losses and gradients are the same
+        """
         self.LAMBDA = LAMBDA
         self.LAMBDA_MULTIPLIER = LAMBDA_MULTIPLIER
         self.generator_clear2fog = generator_clear2fog
@@ -16,23 +33,178 @@ class Trainer:
         self.discriminator_fog = discriminator_fog
         self.discriminator_clear = discriminator_clear
         self.normalized_input = normalized_input
-        # Losses
-        self.loss_obj = tf.keras.losses.BinaryCrossentropy(from_logits=True)
-        self.generator_clear2fog_optimizer = tf.keras.optimizers.Adam(lr, beta_1=beta_1)
-        self.generator_fog2clear_optimizer = tf.keras.optimizers.Adam(lr, beta_1=beta_1)
-        self.discriminator_fog_optimizer = tf.keras.optimizers.Adam(lr, beta_1=beta_1)
-        self.discriminator_clear_optimizer = tf.keras.optimizers.Adam(lr, beta_1=beta_1)
+        self.use_intensity_for_fog_discriminator = use_intensity_for_fog_discriminator
+        self.use_transmission_map_loss = use_transmission_map_loss
+        self.use_whitening_loss = use_whitening_loss
+        self.use_rgb_ratio_loss = use_rgb_ratio_loss
+        # (encoder, decoder) of generator_clear2fog if its encoder is shared between intensities, else None
+        self.clear2fog_split = None
+        if reuse_clear2fog_encoder and generator_clear2fog is not None:
+            from .models import split_generator
+            self.clear2fog_split = split_generator(generator_clear2fog)
+        # Distribution, the default strategy is a single replica without distribution
+        self.distributed = strategy is not None
+        self.strategy = strategy if strategy is not None else tf.distribute.get_strategy()
+        # Losses, reduced manually since the Keras automatic reduction isn't allowed inside a distributed step
+        self.loss_obj = tf.keras.losses.BinaryCrossentropy(from_logits=True,
+                                                           reduction=tf.keras.losses.Reduction.NONE)
+        self.lr = lr
+        self.beta_1 = beta_1
+        loss_scale = any(model is not None and model.compute_dtype == 'float16' for model in
+                         [generator_clear2fog, generator_fog2clear, discriminator_fog, discriminator_clear])
+        self.generator_clear2fog_optimizer = self.create_optimizer(loss_scale)
+        self.generator_fog2clear_optimizer = self.create_optimizer(loss_scale)
+        self.discriminator_fog_optimizer = self.create_optimizer(loss_scale)
+        self.discriminator_clear_optimizer = self.create_optimizer(loss_scale)
+        self.jit_compile = jit_compile
+        self.train_step_traces = 0
+        self.train_step = None
+        self.replica_train_step = None
+        # Spec of the distributed dataset elements, set by `train`
+        self.train_step_element_spec = None
+        self.build_train_step()
         # Checkpoint Manager
         self.weights_path = None
+        self.checkpoint = None
+        self.checkpoint_manager = None
+        self.checkpoint_manager_optimizers = None
+        self.checkpoint_max_to_keep = 3
+        self.async_checkpoint = True
+        # Background rendering of the epoch samples
+        self.sample_rendering_executor = None
+        self.sample_rendering_futures = []
         self.tensorboard_base_logdir = 'tensorboard_logs'
         self.total_epochs = 0
+        self.total_steps = 0
         self.image_log_path = 'image_logs'
         self.config_path = 'trainer_config.json'
         self.tensorboard_current_logdir = None
+        # Independent inputs of the same model are concatenated into one forward pass in `train_step`. That doesn't
+        # change the outputs of per sample normalizations (InstanceNormalization), but it does for BatchNormalization
+        self.batch_model_calls = not any(self.uses_batch_norm(model) for model in
+                                         [generator_clear2fog, generator_fog2clear,
+                                          discriminator_fog, discriminator_clear])
+
+    def train_step_input_signature(self):
+        """
+        Both batches are (images, intensities) with an unknown batch size, so a smaller last batch doesn't retrace.
+        """
+        if self.generator_clear2fog is None:
+            return None
+        image_shape = [None] + list(self.generator_clear2fog.inputs[0].shape[1:])
+        batch_spec = (tf.TensorSpec(image_shape, tf.float32), tf.TensorSpec([None, 1], tf.float32))
+        return [batch_spec, batch_spec]
+
+    def build_train_step(self):
+        if not self.distributed:
+            self.train_step = tf.function(self.train_step_body, input_signature=self.train_step_input_signature(),
+                                          jit_compile=self.jit_compile)
+            return
+        # Like Keras, only the replica step is compiled with XLA, the cross replica reduction isn't
+        self.replica_train_step = tf.function(self.train_step_body, jit_compile=True) if self.jit_compile \
+            else self.train_step_body
+        input_signature = list(self.train_step_element_spec) if self.train_step_element_spec is not None else None
+        self.train_step = tf.function(self.distributed_train_step_body, input_signature=input_signature)
+
+    def distributed_train_step_body(self, real_clear_batch, real_fog_batch):
+        """
+        Runs `train_step_body` on each replica with its part of the global batch. Each replica loss is already
+        divided by the number of replicas, so their sum is the loss of the global batch.
+        :param real_clear_batch: distributed (images, intensities)
+        :param real_fog_batch: distributed (images, intensities)
+        :return: the 4 losses, as `train_step_body`
+        """
+        per_replica_losses = self.strategy.run(self.replica_train_step, args=(real_clear_batch, real_fog_batch))
+        return tuple(self.strategy.reduce(tf.distribute.ReduceOp.SUM, loss, axis=None)
+                     for loss in per_replica_losses)
+
+    def count_images(self, batch):
+        """
+        Number of images of a (possibly distributed) (images, intensities) batch on this worker.
+        """
+        return sum(int(images.shape[0]) for images in self.strategy.experimental_local_results(batch[0]))
+
+    def is_chief(self):
+        from .distribute import is_chief
+        return is_chief(self.strategy)
+
+    def set_train_step_flags(self, use_intensity_for_fog_discriminator=None, use_transmission_map_loss=None,
+                             use_whitening_loss=None, use_rgb_ratio_loss=None):
+        """
+        Updates the flags that are not None, `train_step` is rebuilt (and traced again) only if one of them changed.
+        """
+        flags = {
+            'use_intensity_for_fog_discriminator': use_intensity_for_fog_discriminator,
+            'use_transmission_map_loss': use_transmission_map_loss,
+            'use_whitening_loss': use_whitening_loss,
+            'use_rgb_ratio_loss': use_rgb_ratio_loss,
+        }
+        changed = False
+        for name, value in flags.items():
+            if value is not None and value != getattr(self, name):
+                setattr(self, name, value)
+                changed = True
+        if changed:
+            print("train_step flags changed, it will be traced again")
+            self.build_train_step()
+
+    def uses_batch_norm(self, model):
+        if model is None:
+            return False
+        return any(isinstance(m, tf.keras.layers.BatchNormalization) for m in model.submodules)
 
     def discriminator_fog_output(self, image, intensity, use_intensity_for_fog_discriminator, training=False):
         return self.discriminator_fog((image, intensity), training=training) if use_intensity_for_fog_discriminator else self.discriminator_fog(image)
 
+    def call_batched(self, model, inputs, training=False):
+        """
+        Calls `model` once on the concatenation of `inputs` along the batch axis and splits the output back, which
+        runs fewer and larger kernels than calling it on each input. Falls back to one call per input if
+        `batch_model_calls` is False.
+        :param model: a Keras model
+        :param inputs: list of model inputs, each one being a tensor or a tuple of tensors (image, intensity)
+        :param training:
+        :return: list of outputs, one per input
+        """
+        if not self.batch_model_calls or len(inputs) == 1:
+            return [model(x, training=training) for x in inputs]
+        sizes = [tf.shape(tf.nest.flatten(x)[0])[0] for x in inputs]
+        concatenated = tf.nest.map_structure(lambda *xs: tf.concat(xs, axis=0), *inputs)
+        return tf.split(model(concatenated, training=training), sizes, axis=0)
+
+    def clear2fog_outputs_shared_encoder(self, real_clear, clear_intensity, real_fog, fog_intensity, no_intensity,
+                                         training=False):
+        """
+        The clear2fog outputs of `train_step` with a generator split in an encoder and a decoder: `real_clear` is
+        encoded once and decoded for both of its intensities.
+        :return: fake fog (Phase 1), same fog (Phase 2), clear2clear (Phase 5) and the encoder features of
+            `real_clear`
+        """
+        encoder, decoder = self.clear2fog_split
+        clear_features, fog_features = self.call_encoder_batched(encoder, [real_clear, real_fog], training=training)
+        fake_fog, same_fog, fake_clear2clear = self.call_batched(decoder,
+                                                                 [[real_clear, clear_intensity] + clear_features,
+                                                                  [real_fog, fog_intensity] + fog_features,
+                                                                  [real_clear, no_intensity] + clear_features],
+                                                                 training=training)
+        return fake_fog, same_fog, fake_clear2clear, clear_features
+
+    def call_encoder_batched(self, encoder, images, training=False):
+        """
+        `call_batched` for a model with several outputs.
+        :return: list of the lists of outputs, one per image batch
+        """
+        if not self.batch_model_calls or len(images) == 1:
+            return [encoder(x, training=training) for x in images]
+        sizes = [tf.shape(x)[0] for x in images]
+        outputs = [tf.split(output, sizes, axis=0) for output in encoder(tf.concat(images, axis=0), training=training)]
+        return [list(features) for features in zip(*outputs)]
+
+    def discriminator_fog_outputs(self, images_and_intensities, use_intensity_for_fog_discriminator, training=False):
+        if use_intensity_for_fog_discriminator:
+            return self.call_batched(self.discriminator_fog, images_and_intensities, training=training)
+        return self.call_batched(self.discriminator_fog, [image for image, _ in images_and_intensities])
+
     def save_config(self):
         import json
         import os
@@ -42,6 +214,7 @@ class Trainer:
             'tensorboard_base_logdir': self.tensorboard_base_logdir,
             'tensorboard_current_logdir': self.tensorboard_current_logdir,
             'total_epochs': self.total_epochs,
+            'total_steps': self.total_steps,
             'image_log_path': self.image_log_path,
         }
 
@@ -68,6 +241,8 @@ class Trainer:
             self.tensorboard_current_logdir = config['tensorboard_current_logdir']
         if 'total_epochs' in config:
             self.total_epochs = config['total_epochs']
+        if 'total_steps' in config:
+            self.total_steps = config['total_steps']
         if 'image_log_path' in config:
             self.image_log_path = config['image_log_path']
 
@@ -76,14 +251,35 @@ class Trainer:
         for key in config:
             print("\t{}: {}".format(key, config[key]))
 
+    def create_optimizer(self, loss_scale=False):
+        """
+        Adam optimizer created in the strategy scope, with the trainer's learning rate.
+        :param loss_scale: wraps it in a `LossScaleOptimizer`, for models with a 'mixed_float16' policy
+        """
+        with self.strategy.scope():
+            optimizer = tf.keras.optimizers.Adam(self.lr, beta_1=self.beta_1)
+            if loss_scale:
+                optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+        return optimizer
+
+    def get_scaled_loss(self, optimizer, loss):
+        if isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+            return optimizer.get_scaled_loss(loss)
+        return loss
+
+    def get_unscaled_gradients(self, optimizer, gradients):
+        if isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+            return optimizer.get_unscaled_gradients(gradients)
+        return gradients
+
     def discriminator_loss(self, real, generated):
-        real_loss = self.loss_obj(tf.ones_like(real), real)
-        generated_loss = self.loss_obj(tf.zeros_like(generated), generated)
+        real_loss = tf.reduce_mean(self.loss_obj(tf.ones_like(real), real))
+        generated_loss = tf.reduce_mean(self.loss_obj(tf.zeros_like(generated), generated))
         total_disc_loss = real_loss + generated_loss
         return total_disc_loss * 0.5
 
     def generator_loss(self, generated):
-        return self.loss_obj(tf.ones_like(generated), generated)
+        return tf.reduce_mean(self.loss_obj(tf.ones_like(generated), generated))
 
     def calc_cycle_loss(self, real_image, cycled_image):
         loss1 = tf.reduce_mean(tf.abs(real_image - cycled_image))
@@ -94,15 +290,22 @@ class Trainer:
         return self.LAMBDA * loss
 
     def transmission_map_loss(self, clear_image, generated_image, intensity):
+        """
+        Compares the mean of the generated image with the mean of `clear_image * t + (1 - t)`, `t = 1 - intensity`.
+        Since `t` is constant per image, the expected mean is computed from the per image means of `clear_image`
+        without building the expected image, for any batch size.
+        :param clear_image: [batch, height, width, channels]
+        :param generated_image: [batch, height, width, channels]
+        :param intensity: [batch, 1]
+        :return:
+        """
         if self.normalized_input:
             intensity = intensity * 0.5 + 0.5
-        t = 1 - intensity
-        expected_image = []
-        for i in range(clear_image.shape[0]):
-            expected_image.append(clear_image[i] * t[i] + (1 - t[i]))
-        expected_image = tf.convert_to_tensor(expected_image)
+        t = tf.reshape(1 - intensity, [-1])
+        clear_mean = tf.reduce_mean(clear_image, axis=[1, 2, 3])
+        expected_mean = tf.reduce_mean(clear_mean * t + (1 - t))
 
-        return self.LAMBDA * tf.abs(tf.reduce_mean(expected_image) - tf.reduce_mean(generated_image))
+        return self.LAMBDA * tf.abs(expected_mean - tf.reduce_mean(generated_image))
 
     def whitening_loss(self, clear_image, generated_image):
         """
@@ -172,13 +375,132 @@ class Trainer:
         with open(filename, 'rb') as f:
             opt.set_weights(pickle.load(f))
 
-    def configure_checkpoint(self, weights_path, load_optimizers=True):
+    def get_checkpoint_directory(self):
+        return os.path.join(self.weights_path, 'checkpoints')
+
+    def get_checkpoint_write_directory(self):
+        """
+        Directory written by `save_checkpoint`: `get_checkpoint_directory()` on the chief. With a multi worker
+        strategy every worker must save (the saving reads the distributed variables collectively), the other
+        workers write in a temporary directory of their own, deleted after each save.
+        """
+        if self.is_chief():
+            return self.get_checkpoint_directory()
+        import tempfile
+        resolver = self.strategy.cluster_resolver
+        return os.path.join(tempfile.gettempdir(), 'fogg_checkpoints_{}_{}'.format(resolver.task_type,
+                                                                                   resolver.task_id))
+
+    def get_checkpoint_objects(self, include_optimizers=True, models=None):
+        """
+        :param include_optimizers:
+        :param models: names of the models to include (with their optimizers), e.g. ['generator_clear2fog'].
+            None includes all of them
+        :return: dict name -> model or optimizer
+        """
+        objects = {
+            'generator_clear2fog': self.generator_clear2fog,
+            'generator_fog2clear': self.generator_fog2clear,
+            'discriminator_clear': self.discriminator_clear,
+            'discriminator_fog': self.discriminator_fog,
+        }
+        if include_optimizers:
+            objects.update({
+                'generator_clear2fog_optimizer': self.generator_clear2fog_optimizer,
+                'generator_fog2clear_optimizer': self.generator_fog2clear_optimizer,
+                'discriminator_clear_optimizer': self.discriminator_clear_optimizer,
+                'discriminator_fog_optimizer': self.discriminator_fog_optimizer,
+            })
+        if models is not None:
+            names = set(models) | {name + '_optimizer' for name in models}
+            objects = {name: obj for name, obj in objects.items() if name in names}
+        return objects
+
+    def get_checkpoint_manager(self, include_optimizers=True):
+        """
+        The manager keeps the last `checkpoint_max_to_keep` checkpoints in `get_checkpoint_write_directory()`.
+        It's created again if `include_optimizers` changes, the new one continues from the existing checkpoints.
+        """
+        if self.checkpoint_manager is None or self.checkpoint_manager_optimizers != include_optimizers:
+            self.wait_for_checkpoint()
+            self.checkpoint = tf.train.Checkpoint(**self.get_checkpoint_objects(include_optimizers))
+            self.checkpoint_manager = tf.train.CheckpointManager(self.checkpoint,
+                                                                 self.get_checkpoint_write_directory(),
+                                                                 max_to_keep=self.checkpoint_max_to_keep)
+            self.checkpoint_manager_optimizers = include_optimizers
+        return self.checkpoint_manager
+
+    def save_checkpoint(self, save_optimizers=True):
+        """
+        Saves the models, and the optimizers if `save_optimizers`, in a new checkpoint numbered by the total epochs.
+        With `async_checkpoint`, the variables are only copied here and a background thread writes the files, so
+        training continues during the write. The files are written under temporary names and renamed once complete,
+        then the checkpoints older than the last `checkpoint_max_to_keep` are deleted.
+        Must be called by all the workers of a multi worker strategy, only the chief's checkpoint is kept.
+        :param save_optimizers:
+        :return: the checkpoint path prefix
+        """
+        manager = self.get_checkpoint_manager(save_optimizers)
+        options = tf.train.CheckpointOptions(experimental_enable_async_checkpoint=self.async_checkpoint)
+        path = manager.save(checkpoint_number=self.total_epochs + 1, options=options)
+        if not self.is_chief():
+            self.wait_for_checkpoint()
+            tf.io.gfile.rmtree(manager.directory)
+        return path
+
+    def wait_for_checkpoint(self):
+        """
+        Blocks until the checkpoint being written in the background (if any) is complete.
+        """
+        if self.checkpoint is not None:
+            self.checkpoint.sync()
+
+    def configure_checkpoint(self, weights_path, load_optimizers=True, max_to_keep=3, async_checkpoint=True,
+                             models=None):
+        """
+        Loads the latest checkpoint written by `save_checkpoint` in `weights_path`. If there isn't any, loads the
+        bundle written by `save_bundle`, or the `.h5` and `.pkl` files written by `save_weights`.
+        :param weights_path:
+        :param load_optimizers:
+        :param max_to_keep: number of checkpoints kept by `save_checkpoint`
+        :param async_checkpoint: whether `save_checkpoint` writes the files in the background
+        :param models: names of the models to load, e.g. ['generator_clear2fog'] for inference, the others are left
+            as they are. None loads all of them
+        :return:
+        """
         import os
         from . import tools
+        self.wait_for_checkpoint()
         self.weights_path = weights_path
-        models, paths = self.get_models_and_paths()
+        self.checkpoint_max_to_keep = max_to_keep
+        self.async_checkpoint = async_checkpoint
+        self.checkpoint = None
+        self.checkpoint_manager = None
         tools.create_dir(weights_path)
+        latest_checkpoint = tf.train.latest_checkpoint(self.get_checkpoint_directory())
+        if latest_checkpoint is not None:
+            # Missing objects (optimizers saved without `save_optimizers`) are left as they are
+            tf.train.Checkpoint(**self.get_checkpoint_objects(load_optimizers, models)).restore(
+                latest_checkpoint).expect_partial()
+            print("Checkpoint loaded: {}".format(latest_checkpoint))
+            return
+        if os.path.isfile(self.get_bundle_path()):
+            if models is None:
+                self.load_bundle(load_optimizers=load_optimizers)
+            else:
+                objects = self.get_checkpoint_objects(load_optimizers, models)
+                if load_optimizers:
+                    for name in models:
+                        self.build_optimizer(objects[name + '_optimizer'], objects[name])
+                self.load_bundle(objects=objects)
+            return
+
+        # The legacy files are named after the models, in the order of `get_models_and_paths`
+        selected = self.get_checkpoint_objects(load_optimizers, models)
+        models, paths = self.get_models_and_paths()
         for model, path in zip(models, paths):
+            if not any(model is obj for obj in selected.values()):
+                continue
             if os.path.isfile(path):
                 model.load_weights(path)
                 print("Weights loaded: {}".format(path))
@@ -186,8 +508,12 @@ class Trainer:
                 print("Not found: {}".format(path))
 
         if load_optimizers:
+            # `set_weights` expects the optimizers variables to exist
+            self.build_optimizers()
             optimizers, paths = self.get_optimizers_and_paths()
             for opt, path in zip(optimizers, paths):
+                if not any(opt is obj for obj in selected.values()):
+                    continue
                 if os.path.isfile(path):
                     self.load_optimizer_weights(opt, path)
                     print("Optimizer loaded: {}".format(path))
@@ -195,6 +521,10 @@ class Trainer:
                     print("Not found: {}".format(path))
 
     def save_weights(self, save_optimizers=True):
+        """
+        Writes the models as `.h5` files (and the optimizers as `.pkl` files) synchronously, `train` uses the
+        asynchronous `save_checkpoint` instead.
+        """
         models, paths = self.get_models_and_paths()
         for model, path in zip(models, paths):
             model.save_weights(path)
@@ -203,9 +533,97 @@ class Trainer:
             for opt, path in zip(optimizers, paths):
                 self.save_optimizer_weights(opt, path)
 
-    @tf.function
-    def train_step(self, real_clear_batch, real_fog_batch, use_intensity_for_fog_discriminator=False, use_transmission_map_loss=True, use_whitening_loss=True,
-                   use_rgb_ratio_loss=True):
+    def build_optimizers(self):
+        """
+        Creates the optimizers variables, which are otherwise created by the first training step, so their state
+        can be loaded before training. They're created for `model.trainable_variables`, the variables list of
+        `apply_gradients` in `train_step`, so `optimizer.weights` has the same order as after a training step
+        (the iterations, then each slot for every variable), which is the order saved by `save_optimizer_weights`
+        and `save_bundle`.
+        """
+        pairs = [(self.generator_clear2fog_optimizer, self.generator_clear2fog),
+                 (self.generator_fog2clear_optimizer, self.generator_fog2clear),
+                 (self.discriminator_clear_optimizer, self.discriminator_clear),
+                 (self.discriminator_fog_optimizer, self.discriminator_fog)]
+        for optimizer, model in pairs:
+            if model is not None:
+                self.build_optimizer(optimizer, model)
+
+    def build_optimizer(self, optimizer, model):
+        """
+        Creates the variables of an optimizer of `model`, see `build_optimizers`.
+        """
+        # The loss scale wrapper creates no slots itself, its weights are those of the inner optimizer
+        if isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+            optimizer = optimizer.inner_optimizer
+        with self.strategy.scope():
+            if hasattr(optimizer, 'build'):
+                optimizer.build(model.trainable_variables)
+            else:
+                # OptimizerV2 (Keras <= 2.10) has no `build`, `apply_gradients` creates the slots with this
+                optimizer._create_all_weights(model.trainable_variables)
+
+    def get_bundle_path(self):
+        from .bundle import BUNDLE_FILENAME
+        return os.path.join(self.weights_path, BUNDLE_FILENAME)
+
+    def save_bundle(self, path=None, save_optimizers=True, objects=None):
+        """
+        Writes the models (and the optimizers) in a single packed file (`bundle.write_bundle`), which loads without
+        parsing HDF5 and lets a single model be loaded alone (`bundle.load_bundle_weights`).
+        :param path: defaults to `get_bundle_path()`
+        :param save_optimizers:
+        :param objects: dict group name -> model or optimizer to write instead of the trainer's ones, e.g. the
+            student of `distill.Distiller`
+        :return: the bundle path
+        """
+        from . import bundle
+        if path is None:
+            path = self.get_bundle_path()
+        if objects is None:
+            objects = self.get_checkpoint_objects(save_optimizers)
+        groups = {}
+        for name, obj in objects.items():
+            if isinstance(obj, tf.keras.Model):
+                groups[name] = bundle.model_arrays(obj)
+            else:
+                groups[name] = bundle.optimizer_arrays(obj)
+        return bundle.write_bundle(path, groups, {'total_epochs': self.total_epochs, 'total_steps': self.total_steps})
+
+    def load_bundle(self, path=None, load_optimizers=True, objects=None):
+        """
+        Loads the models (and the optimizers, if the bundle has them) from a file written by `save_bundle` or
+        `bundle.convert_legacy_weights`.
+        :param objects: dict group name -> model or optimizer to load instead of the trainer's ones, their
+            optimizers must have been built (`build_optimizer`)
+        """
+        from . import bundle
+        if path is None:
+            path = self.get_bundle_path()
+        weights_bundle = bundle.Bundle(path)
+        if objects is None:
+            if load_optimizers:
+                self.build_optimizers()
+            objects = self.get_checkpoint_objects(load_optimizers)
+        for name, obj in objects.items():
+            if name not in weights_bundle.groups:
+                print("Not found: {} in {}".format(name, path))
+            elif isinstance(obj, tf.keras.Model):
+                weights_bundle.load_model(obj, name)
+            else:
+                weights_bundle.load_optimizer(obj, name)
+        print("Bundle loaded: {}".format(path))
+
+    def train_step_body(self, real_clear_batch, real_fog_batch):
+        from .tools import print_with_timestamp
+        # Python code only runs while tracing, this counts the traces. The first call traces twice, since it creates
+        # the optimizer slot variables. A mirrored strategy traces it once per local replica
+        self.train_step_traces += 1
+        print_with_timestamp("Tracing train_step (trace #{})".format(self.train_step_traces))
+        use_intensity_for_fog_discriminator = self.use_intensity_for_fog_discriminator
+        use_transmission_map_loss = self.use_transmission_map_loss
+        use_whitening_loss = self.use_whitening_loss
+        use_rgb_ratio_loss = self.use_rgb_ratio_loss
         # def mean(arr):
         #     """
         #     Calculates the mean values of the values that are not None in the passed array
@@ -222,37 +640,47 @@ class Trainer:
             real_fog = real_fog_batch[0]
             fog_intensity = real_fog_batch[1]
 
-            # Phase 1: clear2fog2clear and fog2clear2fog
-            fake_fog = self.generator_clear2fog((real_clear, clear_intensity), training=True)
-            cycled_clear = self.generator_fog2clear((fake_fog, clear_intensity), training=True)
+            no_intensity = tf.zeros_like(clear_intensity)
+            if self.normalized_input:
+                no_intensity = no_intensity - 1.0
 
-            fake_clear = self.generator_fog2clear((real_fog, fog_intensity), training=True)
+            # Independent inputs of the same model are run in a single forward pass:
+            # clear2fog: fake fog (Phase 1), same fog (Phase 2, identity) and clear2clear (Phase 5)
+            # Phase 5: Clear2Clear passes a clear image for c2f generator with intensity = 0 and expects to have
+            # the same image
+            if self.clear2fog_split is not None:
+                fake_fog, same_fog, fake_clear2clear, clear_features = self.clear2fog_outputs_shared_encoder(
+                    real_clear, clear_intensity, real_fog, fog_intensity, no_intensity, training=True)
+            else:
+                fake_fog, same_fog, fake_clear2clear = self.call_batched(self.generator_clear2fog,
+                                                                         [(real_clear, clear_intensity),
+                                                                          (real_fog, fog_intensity),
+                                                                          (real_clear, no_intensity)],
+                                                                         training=True)
+            # fog2clear: fake clear (Phase 1), same clear (Phase 2, identity) and the cycled clear of Phase 1
+            fake_clear, same_clear, cycled_clear = self.call_batched(self.generator_fog2clear,
+                                                                     [(real_fog, fog_intensity),
+                                                                      (real_clear, clear_intensity),
+                                                                      (fake_fog, clear_intensity)],
+                                                                     training=True)
+            # Phase 1: fog2clear2fog, depends on fake_clear
             cycled_fog = self.generator_clear2fog((fake_clear, fog_intensity), training=True)
 
-            # Phase 2: Identity Loss
-            # same_x and same_y are used for identity loss.
-            same_clear = self.generator_fog2clear((real_clear, clear_intensity), training=True)
-            same_fog = self.generator_clear2fog((real_fog, fog_intensity), training=True)
-
-            # Phase 3: Real images to Discriminators
+            # Phase 3 and 4: Real and Fake (Generated) images to Discriminators
             # discriminator_clear takes only an image
-            disc_real_clear = self.discriminator_clear(real_clear, training=True)
-            disc_real_fog = self.discriminator_fog_output(real_fog, fog_intensity, use_intensity_for_fog_discriminator, training=True)
-
-            # Phase 4: Fake (Generated) images to Discriminators
-            disc_fake_clear = self.discriminator_clear(fake_clear, training=True)
-            disc_fake_fog = self.discriminator_fog_output(fake_fog, clear_intensity, use_intensity_for_fog_discriminator, training=True)
-
-            # Phase 5: Clear2Clear
-            # Pass a clear image for c2f generator with intensity = 0 and expect to have the same image
-            no_intensity = tf.zeros_like(clear_intensity)
-            if self.normalized_input:
-                no_intensity = no_intensity - 1.0
-            fake_clear2clear = self.generator_clear2fog((real_clear, no_intensity), training=True)
+            disc_real_clear, disc_fake_clear = self.call_batched(self.discriminator_clear, [real_clear, fake_clear],
+                                                                 training=True)
+            disc_real_fog, disc_fake_fog = self.discriminator_fog_outputs([(real_fog, fog_intensity),
+                                                                           (fake_fog, clear_intensity)],
+                                                                          use_intensity_for_fog_discriminator,
+                                                                          training=True)
 
             # Phase 5: Clear2White
             full_intensity = tf.ones_like(clear_intensity)
-            fake_clear2white = self.generator_clear2fog((real_clear, full_intensity))
+            if self.clear2fog_split is not None:
+                fake_clear2white = self.clear2fog_split[1]([real_clear, full_intensity] + clear_features)
+            else:
+                fake_clear2white = self.generator_clear2fog((real_clear, full_intensity))
             white = tf.ones_like(real_clear)
 
             # calculate the loss
@@ -289,15 +717,34 @@ class Trainer:
             disc_clear_loss = self.discriminator_loss(disc_real_clear, disc_fake_clear)
             disc_fog_loss = self.discriminator_loss(disc_real_fog, disc_fake_fog)
 
+            # The gradients are summed over the replicas, each replica adds its share of the global batch mean
+            replica_scale = 1.0 / self.strategy.num_replicas_in_sync
+            total_gen_clear2fog_loss *= replica_scale
+            total_gen_fog2clear_loss *= replica_scale
+            disc_clear_loss *= replica_scale
+            disc_fog_loss *= replica_scale
+
+            # Loss scaling (only for float16 models)
+            scaled_gen_clear2fog_loss = self.get_scaled_loss(self.generator_clear2fog_optimizer,
+                                                             total_gen_clear2fog_loss)
+            scaled_gen_fog2clear_loss = self.get_scaled_loss(self.generator_fog2clear_optimizer,
+                                                             total_gen_fog2clear_loss)
+            scaled_disc_clear_loss = self.get_scaled_loss(self.discriminator_clear_optimizer, disc_clear_loss)
+            scaled_disc_fog_loss = self.get_scaled_loss(self.discriminator_fog_optimizer, disc_fog_loss)
+
         # Calculate the gradients for generator and discriminator
-        generator_clear2fog_gradients = tape.gradient(total_gen_clear2fog_loss,
-                                                      self.generator_clear2fog.trainable_variables)
-        generator_fog2clear_gradients = tape.gradient(total_gen_fog2clear_loss,
-                                                      self.generator_fog2clear.trainable_variables)
-        discriminator_clear_gradients = tape.gradient(disc_clear_loss,
-                                                      self.discriminator_clear.trainable_variables)
-        discriminator_fog_gradients = tape.gradient(disc_fog_loss,
-                                                    self.discriminator_fog.trainable_variables)
+        generator_clear2fog_gradients = self.get_unscaled_gradients(
+            self.generator_clear2fog_optimizer,
+            tape.gradient(scaled_gen_clear2fog_loss, self.generator_clear2fog.trainable_variables))
+        generator_fog2clear_gradients = self.get_unscaled_gradients(
+            self.generator_fog2clear_optimizer,
+            tape.gradient(scaled_gen_fog2clear_loss, self.generator_fog2clear.trainable_variables))
+        discriminator_clear_gradients = self.get_unscaled_gradients(
+            self.discriminator_clear_optimizer,
+            tape.gradient(scaled_disc_clear_loss, self.discriminator_clear.trainable_variables))
+        discriminator_fog_gradients = self.get_unscaled_gradients(
+            self.discriminator_fog_optimizer,
+            tape.gradient(scaled_disc_fog_loss, self.discriminator_fog.trainable_variables))
 
         # Apply the gradients to the optimizer
         self.generator_clear2fog_optimizer.apply_gradients(zip(generator_clear2fog_gradients,
@@ -311,9 +758,75 @@ class Trainer:
 
         return total_gen_clear2fog_loss, total_gen_fog2clear_loss, disc_clear_loss, disc_fog_loss
 
+    def sample_outputs(self, clear, clear_intensity, fog, fog_intensity, use_intensity_for_fog_discriminator):
+        """
+        Runs both generators and both discriminators on a sample pair.
+        :return: tuple in the order of the arguments of `plot.plot_generators_and_discriminators_predictions`
+        """
+        prediction_clear2fog = self.generator_clear2fog((clear, clear_intensity))
+        prediction_fog2clear = self.generator_fog2clear((fog, fog_intensity))
+        discriminator_clear_output = self.discriminator_clear(clear)
+        discriminator_fog_output = self.discriminator_fog_output(fog, fog_intensity, use_intensity_for_fog_discriminator)
+        discriminator_fakeclear_output = self.discriminator_clear(prediction_fog2clear)
+        discriminator_fakefog_output = self.discriminator_fog_output(prediction_clear2fog, clear_intensity, use_intensity_for_fog_discriminator)
+        return ((clear, clear_intensity), prediction_clear2fog, (fog, fog_intensity), prediction_fog2clear,
+                discriminator_clear_output, discriminator_fog_output, discriminator_fakeclear_output,
+                discriminator_fakefog_output)
+
+    def save_sample_outputs(self, samples_outputs, epoch, save_sample_generator_output,
+                            save_sample_gen_and_disc_output):
+        """
+        Renders and saves the images of the precomputed `sample_outputs`, doesn't use the models.
+        The figures aren't managed by pyplot, so this can run outside the main thread.
+        """
+        for ind, outputs in enumerate(samples_outputs):
+            if save_sample_gen_and_disc_output:
+                fig = plot.plot_generators_and_discriminators_predictions(*outputs,
+                                                                          normalized_input=self.normalized_input,
+                                                                          close_fig=True)
+                fig.savefig(
+                    os.path.join(self.image_log_path,
+                                 "sample_{}_gen_and_disc_output_epoch_{:03d}.jpg".format(ind, epoch)),
+                    bbox_inches='tight', pad_inches=0)
+
+            if save_sample_generator_output:
+                img = plot.get_generator_square_image(outputs[0], outputs[1], outputs[2], outputs[3],
+                                                      normalized_input=self.normalized_input)
+                tf.io.write_file(
+                    os.path.join(self.image_log_path,
+                                 "sample_{}_gen_output_epoch_{:03d}.jpg".format(ind, epoch)),
+                    tf.io.encode_jpeg(img))
+
+    def submit_sample_rendering(self, fn):
+        from concurrent.futures import ThreadPoolExecutor
+        if self.sample_rendering_executor is None:
+            # A single worker renders the epochs one after the other
+            self.sample_rendering_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sample_rendering')
+        self.sample_rendering_futures = [f for f in self.sample_rendering_futures if not f.done()]
+        future = self.sample_rendering_executor.submit(fn)
+        future.add_done_callback(self.sample_rendering_done)
+        self.sample_rendering_futures.append(future)
+
+    def sample_rendering_done(self, future):
+        if future.exception() is not None:
+            print("Saving the epoch's samples failed: {}".format(future.exception()))
+
+    def wait_for_sample_rendering(self):
+        """
+        Blocks until the samples submitted to the background worker are saved.
+        """
+        from concurrent.futures import wait
+        wait(self.sample_rendering_futures)
+        self.sample_rendering_futures = []
+
     def epoch_callback(self, sample_test, plot_sample_generator, plot_sample_gen_and_disc,
                        save_sample_generator_output, save_sample_gen_and_disc_output,
-                       plot_only_one_sample_gen_and_disc, use_intensity_for_fog_discriminator):
+                       plot_only_one_sample_gen_and_disc, use_intensity_for_fog_discriminator,
+                       render_in_background=True):
+        """
+        Only the model predictions run on the calling thread, the saved images are rendered by a background worker
+        if `render_in_background`. The interactive plots are still shown from the calling thread.
+        """
         if sample_test is None:
             return
         if type(sample_test) is not list and type(sample_test) is not tuple:
@@ -329,80 +842,79 @@ class Trainer:
         if plot_only_one_sample_gen_and_disc:
             clear, clear_intensity = next(iter(sample_clear.shuffle(10).take(1)))
             fog, fog_intensity = next(iter(sample_fog.shuffle(10).take(1)))
-            prediction_clear2fog = self.generator_clear2fog((clear, clear_intensity))
-            prediction_fog2clear = self.generator_fog2clear((fog, fog_intensity))
-            discriminator_clear_output = self.discriminator_clear(clear)
-            discriminator_fog_output = self.discriminator_fog_output(fog, fog_intensity, use_intensity_for_fog_discriminator)
-            discriminator_fakeclear_output = self.discriminator_clear(prediction_fog2clear)
-            discriminator_fakefog_output = self.discriminator_fog_output(prediction_clear2fog, clear_intensity, use_intensity_for_fog_discriminator)
-            plot.plot_generators_and_discriminators_predictions((clear, clear_intensity), prediction_clear2fog,
-                                                                (fog, fog_intensity),
-                                                                prediction_fog2clear,
-                                                                discriminator_clear_output,
-                                                                discriminator_fog_output,
-                                                                discriminator_fakeclear_output,
-                                                                discriminator_fakefog_output,
-                                                                normalized_input=self.normalized_input)
+            outputs = self.sample_outputs(clear, clear_intensity, fog, fog_intensity,
+                                          use_intensity_for_fog_discriminator)
+            plot.plot_generators_and_discriminators_predictions(*outputs, normalized_input=self.normalized_input)
             plt.show()
 
-        for (ind, ((clear, clear_intensity), (fog, fog_intensity))) in enumerate(
-                tf.data.Dataset.zip((sample_clear, sample_fog))):
-            prediction_clear2fog = self.generator_clear2fog((clear, clear_intensity))
-            prediction_fog2clear = self.generator_fog2clear((fog, fog_intensity))
-            discriminator_clear_output = self.discriminator_clear(clear)
-            discriminator_fog_output = self.discriminator_fog_output(fog, fog_intensity, use_intensity_for_fog_discriminator)
-            discriminator_fakeclear_output = self.discriminator_clear(prediction_fog2clear)
-            discriminator_fakefog_output = self.discriminator_fog_output(prediction_clear2fog, clear_intensity, use_intensity_for_fog_discriminator)
-            if plot_sample_gen_and_disc or save_sample_gen_and_disc_output:
-                fig = plot.plot_generators_and_discriminators_predictions((clear, clear_intensity),
-                                                                          prediction_clear2fog,
-                                                                          (fog, fog_intensity),
-                                                                          prediction_fog2clear,
-                                                                          discriminator_clear_output,
-                                                                          discriminator_fog_output,
-                                                                          discriminator_fakeclear_output,
-                                                                          discriminator_fakefog_output,
-                                                                          normalized_input=self.normalized_input,
-                                                                          close_fig=not plot_sample_gen_and_disc)
-                if save_sample_gen_and_disc_output:
-                    fig.savefig(
-                        os.path.join(self.image_log_path,
-                                     "sample_{}_gen_and_disc_output_epoch_{:03d}.jpg".format(ind, self.total_epochs)),
-                        bbox_inches='tight', pad_inches=0)
-
-                if plot_sample_gen_and_disc:
-                    plt.show()
-                else:
-                    plt.close(fig)
+        samples_outputs = []
+        for ((clear, clear_intensity), (fog, fog_intensity)) in tf.data.Dataset.zip((sample_clear, sample_fog)):
+            outputs = self.sample_outputs(clear, clear_intensity, fog, fog_intensity,
+                                          use_intensity_for_fog_discriminator)
+            if plot_sample_gen_and_disc:
+                plot.plot_generators_and_discriminators_predictions(*outputs, normalized_input=self.normalized_input)
+                plt.show()
 
             if plot_sample_generator:
-                plot.plot_generators_predictions_v2((clear, clear_intensity), prediction_clear2fog,
-                                                    (fog, fog_intensity),
-                                                    prediction_fog2clear,
+                plot.plot_generators_predictions_v2(outputs[0], outputs[1], outputs[2], outputs[3],
                                                     normalized_input=self.normalized_input)
                 plt.show()
+            samples_outputs.append(outputs)
 
-            if save_sample_generator_output:
-                img = plot.get_generator_square_image((clear, clear_intensity), prediction_clear2fog,
-                                                      (fog, fog_intensity),
-                                                      prediction_fog2clear,
-                                                      normalized_input=self.normalized_input)
-                tf.io.write_file(
-                    os.path.join(self.image_log_path,
-                                 "sample_{}_gen_output_epoch_{:03d}.jpg".format(ind, self.total_epochs)),
-                    tf.io.encode_jpeg(img))
+        if not save_sample_generator_output and not save_sample_gen_and_disc_output:
+            return
+        # The background worker gets copies, the models may change before it runs
+        samples_outputs = tf.nest.map_structure(lambda x: x.numpy(), samples_outputs)
+        save = functools.partial(self.save_sample_outputs, samples_outputs, self.total_epochs,
+                                 save_sample_generator_output, save_sample_gen_and_disc_output)
+        if render_in_background:
+            self.submit_sample_rendering(save)
+        else:
+            save()
 
     def train(self, train_clear, train_fog, epochs=40, epoch_save_rate=1, progress_print_rate=10,
               clear_output_callback=None, use_tensorboard=False, sample_test=None, plot_sample_generator=False,
               plot_sample_gen_and_disc=False, save_sample_generator_output=True, save_sample_gen_and_disc_output=True,
               load_config_first=True, save_config_each_epoch=True, plot_only_one_sample_gen_and_disc=True,
-              use_transmission_map_loss=True, use_whitening_loss=True, use_rgb_ratio_loss=True, save_optimizers=False,
-              use_intensity_for_fog_discriminator=False):
+              use_transmission_map_loss=None, use_whitening_loss=None, use_rgb_ratio_loss=None, save_optimizers=False,
+              use_intensity_for_fog_discriminator=None, sample_epoch_rate=1, render_samples_in_background=True,
+              telemetry_rate=10, profile_steps=None):
+        """
+        The `use_*` flags default to the values given to the constructor, passing different ones retraces
+        `train_step` once.
+        :param sample_epoch_rate: the samples are predicted and saved every `sample_epoch_rate` epochs
+        :param render_samples_in_background: saves the samples images from a background worker, so the training
+            doesn't wait for matplotlib (see `epoch_callback`)
+        :param telemetry_rate: with `use_tensorboard`, the step metrics (images/sec, input pipeline wait, train_step
+            duration, traces and host memory) are averaged and written every `telemetry_rate` steps. Each step then
+            waits for its result, so its duration is measured accurately. None disables them
+        :param profile_steps: (start, stop) global steps traced by `tf.profiler`, written next to the tensorboard logs
+        """
         from lib.tools import print_with_timestamp
+        from . import telemetry
         import time
         import datetime
         import os
 
+        self.set_train_step_flags(use_intensity_for_fog_discriminator, use_transmission_map_loss, use_whitening_loss,
+                                  use_rgb_ratio_loss)
+        use_intensity_for_fog_discriminator = self.use_intensity_for_fog_discriminator
+
+        dataset = tf.data.Dataset.zip((train_clear, train_fog))
+        if self.distributed:
+            # Each replica gets its part of the global batch, each worker reads its own shard of the dataset
+            dataset = self.strategy.experimental_distribute_dataset(dataset)
+            if dataset.element_spec != self.train_step_element_spec:
+                self.train_step_element_spec = dataset.element_spec
+                self.build_train_step()
+        # Every worker saves the checkpoints (`save_checkpoint`), only the chief writes the config, the logs and the
+        # samples
+        chief = self.is_chief()
+        if not chief:
+            save_sample_generator_output = save_sample_gen_and_disc_output = False
+            plot_sample_generator = plot_sample_gen_and_disc = plot_only_one_sample_gen_and_disc = False
+            use_tensorboard = save_config_each_epoch = False
+
         if load_config_first and self.config_path is not None:
             self.load_config()
 
@@ -422,6 +934,15 @@ class Trainer:
             tensorboard_logdir_fog = self.tensorboard_current_logdir + "-fog"
             tensorboard_summary_writer_clear = tf.summary.create_file_writer(logdir=tensorboard_logdir_clear)
             tensorboard_summary_writer_fog = tf.summary.create_file_writer(logdir=tensorboard_logdir_fog)
+        if not use_tensorboard:
+            telemetry_rate = None
+
+        profiler = None
+        if chief and profile_steps is not None:
+            if self.tensorboard_current_logdir is None:
+                self.tensorboard_current_logdir = os.path.join(self.tensorboard_base_logdir,
+                                                               datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
+            profiler = telemetry.ProfilerWindow(self.tensorboard_current_logdir + "-profile", *profile_steps)
 
         length = "Unknown"
         total_target_epochs = self.total_epochs + epochs
@@ -431,22 +952,37 @@ class Trainer:
                                                                                   self.total_epochs + 1,
                                                                                   total_target_epochs))
             clear2fog_loss_total = fog2clear_loss_total = disc_clear_loss_total = disc_fog_loss_total = 0
-            self.epoch_callback(sample_test, plot_sample_generator, plot_sample_gen_and_disc,
-                                save_sample_generator_output, save_sample_gen_and_disc_output,
-                                plot_only_one_sample_gen_and_disc, use_intensity_for_fog_discriminator)
+            if chief and sample_epoch_rate is not None and self.total_epochs % sample_epoch_rate == 0:
+                self.epoch_callback(sample_test, plot_sample_generator, plot_sample_gen_and_disc,
+                                    save_sample_generator_output, save_sample_gen_and_disc_output,
+                                    plot_only_one_sample_gen_and_disc, use_intensity_for_fog_discriminator,
+                                    render_in_background=render_samples_in_background)
 
-            dataset = tf.data.Dataset.zip((train_clear, train_fog))
             n = 0
+            step_telemetry = telemetry.StepTelemetry()
+            iterator = iter(dataset)
             start = time.time()
-            for image_clear, image_fog in dataset:
+            while True:
+                batch, data_seconds = telemetry.timed_next(iterator)
+                if batch is None:
+                    break
+                image_clear, image_fog = batch
+                if profiler is not None:
+                    profiler.before_step(self.total_steps)
+                step_start = time.perf_counter()
                 # Train Step
-                clear2fog_loss, fog2clear_loss, disc_clear_loss, disc_fog_loss = \
-                    self.train_step(image_clear,
-                                    image_fog,
-                                    use_transmission_map_loss=use_transmission_map_loss,
-                                    use_whitening_loss=use_whitening_loss,
-                                    use_rgb_ratio_loss=use_rgb_ratio_loss,
-                                    use_intensity_for_fog_discriminator=use_intensity_for_fog_discriminator)
+                clear2fog_loss, fog2clear_loss, disc_clear_loss, disc_fog_loss = self.train_step(image_clear, image_fog)
+                if telemetry_rate is not None:
+                    # Waits for the step to complete
+                    clear2fog_loss.numpy()
+                step_telemetry.record(data_seconds, time.perf_counter() - step_start, self.count_images(image_clear))
+                if profiler is not None:
+                    profiler.after_step(self.total_steps)
+                self.total_steps += 1
+                if telemetry_rate is not None and self.total_steps % telemetry_rate == 0:
+                    with tensorboard_summary_writer_clear.as_default():
+                        step_telemetry.write_summaries(step_telemetry.pop_window(), self.total_steps,
+                                                       self.train_step_traces)
                 # Update Epoch's losses
                 clear2fog_loss_total += clear2fog_loss
                 fog2clear_loss_total += fog2clear_loss
@@ -464,10 +1000,10 @@ class Trainer:
             # Save weights
             if self.weights_path is not None and epoch_save_rate is not None and (
                     epoch + 1) % epoch_save_rate == 0:
-                self.save_weights(save_optimizers=save_optimizers)
-                print_with_timestamp('Saving checkpoint for epoch {} (total {}) at {}'.format(epoch + 1,
-                                                                                              self.total_epochs + 1,
-                                                                                              self.weights_path))
+                checkpoint_path = self.save_checkpoint(save_optimizers=save_optimizers)
+                if chief:
+                    print_with_timestamp('Saving checkpoint for epoch {} (total {}) at {}'.format(
+                        epoch + 1, self.total_epochs + 1, checkpoint_path))
             print_with_timestamp('Time taken for epoch {} (total {})'
                                  ' is {:0.4f} sec (effective: {:0.4f} sec)'.format(epoch + 1,
                                                                                    self.total_epochs + 1,
@@ -477,6 +1013,14 @@ class Trainer:
                 'clear2fog loss: {:0.4f}, fog2clear loss: {:0.4f}\n\tdisc_clear loss: {:0.4f}, disc_fog loss: {:0.4f}'
                     .format(clear2fog_loss_total, fog2clear_loss_total, disc_clear_loss_total,
                             disc_fog_loss_total))
+            epoch_telemetry = step_telemetry.epoch_summary()
+            if epoch_telemetry is not None:
+                print_with_timestamp('{:0.2f} images/sec, input pipeline wait: {:0.1f} ms/step ({:0.0%}), '
+                                     'train_step: {:0.1f} ms/step'.format(epoch_telemetry['images_per_sec'],
+                                                                          epoch_telemetry['data_wait_ms'],
+                                                                          epoch_telemetry['data_wait_fraction'],
+                                                                          epoch_telemetry['step_ms']))
+            print_with_timestamp('train_step traces: {}'.format(self.train_step_traces))
             # Tensorboard
             if use_tensorboard:
                 with tensorboard_summary_writer_clear.as_default():
@@ -494,6 +1038,10 @@ class Trainer:
             self.total_epochs += 1
             if save_config_each_epoch:
                 self.save_config()
+        if profiler is not None:
+            profiler.close()
+        self.wait_for_checkpoint()
+        self.wait_for_sample_rendering()
 
 
 if __name__ == 'main':
@@ -0,0 +1,257 @@
+import tensorflow as tf
+
+
+def box_filter(x, radius):
+    """
+    Mean filter over a (2 * radius + 1) square window.
+    Border pixels are averaged over the valid part of the window only, since `avg_pool2d` with 'SAME' padding
+    doesn't count the padded values.
+    :param x: a 4D tensor [batch, height, width, channels]
+    :param radius: the window radius in pixels
+    :return: a tensor with the same shape as `x`
+    """
+    size = 2 * radius + 1
+    return tf.nn.avg_pool2d(x, ksize=size, strides=1, padding='SAME')
+
+
+def to_grayscale(image):
+    """
+    Luma of an RGB batch, used as the guidance image of the guided filter.
+    :param image: a 4D tensor [batch, height, width, 3]
+    :return: a 4D tensor [batch, height, width, 1]
+    """
+    return tf.image.rgb_to_grayscale(image)
+
+
+def fast_guided_filter(guide_full, source_low, radius=4, epsilon=1e-3):
+    """
+    Fast guided filter (https://arxiv.org/abs/1505.00996): the linear coefficients of the guided filter
+    (He et al.) are computed at the resolution of `source_low` and bilinearly upsampled, then applied to the
+    full resolution guide. This way the edges of the upsampled map follow the edges of the full resolution image,
+    while the cost stays close to the low resolution cost.
+    :param guide_full: full resolution guidance image, 4D tensor [batch, height, width, 1] in range [0,1]
+    :param source_low: low resolution map to upsample, 4D tensor [batch, low_height, low_width, 1]
+    :param radius: window radius, in low resolution pixels
+    :param epsilon: regularization, bigger values give smoother results
+    :return: the upsampled map, 4D tensor [batch, height, width, 1]
+    """
+    full_size = tf.shape(guide_full)[1:3]
+    low_size = tf.shape(source_low)[1:3]
+    guide_low = tf.image.resize(guide_full, low_size, method=tf.image.ResizeMethod.AREA)
+
+    mean_guide = box_filter(guide_low, radius)
+    mean_source = box_filter(source_low, radius)
+    covariance = box_filter(guide_low * source_low, radius) - mean_guide * mean_source
+    variance = box_filter(guide_low * guide_low, radius) - mean_guide * mean_guide
+
+    a = covariance / (variance + epsilon)
+    b = mean_source - a * mean_guide
+    mean_a = tf.image.resize(box_filter(a, radius), full_size, method=tf.image.ResizeMethod.BILINEAR)
+    mean_b = tf.image.resize(box_filter(b, radius), full_size, method=tf.image.ResizeMethod.BILINEAR)
+    return mean_a * guide_full + mean_b
+
+
+def get_transmission_model(generator):
+    """
+    Returns a model that outputs the transmission map of a generator built with
+    `ModelsBuilder.build_generator(use_transmission_map=True)`, or None if the generator doesn't have one.
+    The output of the returned model is in range [0,1], after the gauss blur if the generator uses it.
+    :param generator: a clear2fog generator
+    :return: tf.keras.Model or None
+    """
+    layer_names = [layer.name for layer in generator.layers]
+    if 'decoder' in layer_names and 'encoder' in layer_names:
+        # Generator split in an encoder and a decoder (intensity_conditioning='decoder'), the map is in the decoder
+        decoder_transmission_model = get_transmission_model(generator.get_layer('decoder'))
+        if decoder_transmission_model is None:
+            return None
+        image, intensity = generator.inputs
+        features = generator.get_layer('encoder')(image)
+        transmission = decoder_transmission_model([image, intensity] + features)
+        return tf.keras.Model(inputs=generator.inputs, outputs=transmission)
+    for name in ['gauss_blur', 'fix_transmission_range', 'transmission_layer']:
+        if name in layer_names:
+            return tf.keras.Model(inputs=generator.inputs, outputs=generator.get_layer(name).output)
+    return None
+
+
+def estimate_transmission_map(clear_image, fog_image, epsilon=1e-3):
+    """
+    Estimates the transmission map `t` of the fog model `fog = clear * t + (1 - t)` from a pair of images,
+    used for generators that output the foggy image directly.
+    `t` is the least squares solution over the 3 channels of `(1 - fog) = t * (1 - clear)`.
+    :param clear_image: 4D tensor [batch, height, width, 3] in range [0,1]
+    :param fog_image: 4D tensor [batch, height, width, 3] in range [0,1]
+    :param epsilon: avoids division by zero for white pixels
+    :return: 4D tensor [batch, height, width, 1] in range [0,1]
+    """
+    inv_clear = 1 - clear_image
+    inv_fog = 1 - fog_image
+    t = tf.reduce_sum(inv_fog * inv_clear, axis=-1, keepdims=True) / (
+            tf.reduce_sum(inv_clear * inv_clear, axis=-1, keepdims=True) + epsilon)
+    return tf.clip_by_value(t, 0., 1.)
+
+
+def composite_fog(image, transmission):
+    """
+    Applies the fog model `image * t + (1 - t)`.
+    :param image: 4D tensor [batch, height, width, 3] in range [0,1]
+    :param transmission: 4D tensor [batch, height, width, 1] in range [0,1]
+    :return: 4D tensor [batch, height, width, 3] in range [0,1]
+    """
+    transmission = tf.clip_by_value(transmission, 0., 1.)
+    return image * transmission + (1 - transmission)
+
+
+def native_aspect_size(size, short_side=256):
+    """
+    Size with the same aspect ratio as `size` and a shorter side of `short_side` pixels.
+    :param size: [height, width] tensor
+    :param short_side:
+    :return: [height, width] int32 tensor
+    """
+    size = tf.cast(size, tf.float32)
+    scale = short_side / tf.reduce_min(size)
+    return tf.cast(tf.round(size * scale), tf.int32)
+
+
+def pad_to_multiple(image, multiple=256):
+    """
+    Pads the bottom and the right of an image batch by mirroring it, up to the next multiple of `multiple`.
+    The padding must not be larger than the image, which holds when its shorter side is at least `multiple`.
+    :param image: 4D tensor [batch, height, width, channels]
+    :param multiple:
+    :return: (padded image, [height, width] of the original image)
+    """
+    size = tf.shape(image)[1:3]
+    padding = (size + multiple - 1) // multiple * multiple - size
+    padded = tf.pad(image, [[0, 0], [0, padding[0]], [0, padding[1]], [0, 0]], mode='SYMMETRIC')
+    return padded, size
+
+
+def predict_padded(model, model_input, multiple=256):
+    """
+    Runs a fully convolutional model (`ModelsBuilder(image_height=None, image_width=None)`) on (image, intensity)
+    padded to a multiple of `multiple`, and crops its output back to the image size.
+    """
+    image, intensity = model_input
+    padded, size = pad_to_multiple(image, multiple)
+    return model((padded, intensity))[:, :size[0], :size[1], :]
+
+
+def predict_transmission_map(generator, image_low, intensity, normalized_input=True, padding_multiple=None):
+    """
+    Predicts the transmission map of `image_low`: directly if the generator was built with
+    `use_transmission_map=True`, otherwise estimated from its output.
+    :param generator: a clear2fog generator that takes (image, intensity)
+    :param image_low: 4D tensor [1, height, width, 3] in range [0,1], at the generator's input size
+    :param intensity: fog intensity tensor [1, 1] in range [0,1]
+    :param normalized_input: whether the generator was trained on inputs in range [-1,1]
+    :param padding_multiple: if set, the image is padded to a multiple of it for a fully convolutional generator
+    :return: 4D tensor [1, height, width, 1] in range [0,1]
+    """
+    if normalized_input:
+        model_input = (image_low * 2 - 1, intensity * 2 - 1)
+    else:
+        model_input = (image_low, intensity)
+
+    def predict(model):
+        if padding_multiple is not None:
+            return predict_padded(model, model_input, padding_multiple)
+        return model(model_input)
+
+    transmission_model = get_transmission_model(generator)
+    if transmission_model is not None:
+        return predict(transmission_model)
+    fog_low = predict(generator)
+    if normalized_input:
+        fog_low = fog_low * 0.5 + 0.5
+    return estimate_transmission_map(image_low, fog_low)
+
+
+def clear2fog_native_aspect_ratio(generator, image, intensity, short_side=256, normalized_input=True,
+                                  padding_multiple=256):
+    """
+    Adds fog to an image at its own aspect ratio, without cropping it: the image is resized to a shorter side of
+    `short_side` pixels and padded for the generator, and the output is cropped back.
+    :param generator: a fully convolutional clear2fog generator (`ModelsBuilder(image_height=None,
+        image_width=None)`)
+    :param image: a decoded uint8 image [height, width, 3], at any resolution
+    :param intensity: fog intensity in range [0,1]
+    :param short_side: shorter side of the output
+    :param normalized_input: whether the generator was trained on inputs in range [-1,1]
+    :param padding_multiple: the generator's input size multiple
+    :return: the foggy uint8 image, with the aspect ratio of `image` and a shorter side of `short_side`
+    """
+    image = tf.expand_dims(tf.cast(image, tf.float32) / 255., 0)
+    image = tf.image.resize(image, native_aspect_size(tf.shape(image)[1:3], short_side),
+                            method=tf.image.ResizeMethod.AREA)
+    intensity = tf.reshape(tf.cast(intensity, tf.float32), (1, 1))
+    if normalized_input:
+        fog = predict_padded(generator, (image * 2 - 1, intensity * 2 - 1), padding_multiple) * 0.5 + 0.5
+    else:
+        fog = predict_padded(generator, (image, intensity), padding_multiple)
+    return tf.cast(tf.round(tf.clip_by_value(fog[0], 0., 1.) * 255.), tf.uint8)
+
+
+def clear2fog_full_resolution(generator, image, intensity, image_height=256, image_width=256,
+                              normalized_input=True, radius=4, epsilon=1e-3, native_aspect_ratio=False):
+    """
+    Adds fog to a full resolution image while running the generator at [image_height, image_width] only.
+    The generator predicts the transmission map at low resolution, which is then upsampled with the fast
+    guided filter against the full resolution image and composited onto it.
+    :param generator: a clear2fog generator that takes (image, intensity)
+    :param image: a decoded uint8 image [height, width, 3], at any resolution
+    :param intensity: fog intensity in range [0,1]
+    :param image_height: the generator's input height
+    :param image_width: the generator's input width
+    :param normalized_input: whether the generator was trained on inputs in range [-1,1]
+    :param radius: guided filter radius, in low resolution pixels
+    :param epsilon: guided filter regularization
+    :param native_aspect_ratio: runs a fully convolutional generator on the image at its own aspect ratio, with a
+        shorter side of min(image_height, image_width), instead of squeezing it to [image_height, image_width]
+    :return: the foggy uint8 image [height, width, 3]
+    """
+    image_full = tf.expand_dims(tf.cast(image, tf.float32) / 255., 0)
+    intensity = tf.reshape(tf.cast(intensity, tf.float32), (1, 1))
+    if native_aspect_ratio:
+        low_size = native_aspect_size(tf.shape(image_full)[1:3], min(image_height, image_width))
+        image_low = tf.image.resize(image_full, low_size, method=tf.image.ResizeMethod.AREA)
+        transmission_low = predict_transmission_map(generator, image_low, intensity, normalized_input,
+                                                    padding_multiple=max(image_height, image_width))
+    else:
+        # The whole frame is squeezed into the generator's input, the map is stretched back when upsampling
+        image_low = tf.image.resize(image_full, [image_height, image_width], method=tf.image.ResizeMethod.AREA)
+        transmission_low = predict_transmission_map(generator, image_low, intensity, normalized_input)
+
+    transmission_full = fast_guided_filter(to_grayscale(image_full), transmission_low, radius, epsilon)
+    fog_full = composite_fog(image_full, transmission_full)
+    return tf.cast(tf.round(tf.clip_by_value(fog_full[0], 0., 1.) * 255.), tf.uint8)
+
+
+def clear2fog_intensity_sweep(generator, image, intensities, image_height=256, image_width=256, normalized_input=True):
+    """
+    Adds fog to an image for each of the intensities. With a generator built with
+    `ModelsBuilder(intensity_conditioning='decoder')` the image is encoded once and only the decoder runs for each
+    intensity (`models.EncodedImages`), other generators run entirely for each intensity.
+    :param generator: a clear2fog generator that takes (image, intensity)
+    :param image: a decoded uint8 image [height, width, 3], resized to [image_height, image_width]
+    :param intensities: list of fog intensities in range [0,1]
+    :param image_height: the generator's input height
+    :param image_width: the generator's input width
+    :param normalized_input: whether the generator was trained on inputs in range [-1,1]
+    :return: list of foggy uint8 images [image_height, image_width, 3], one per intensity
+    """
+    from .models import EncodedImages, split_generator
+    image = tf.expand_dims(tf.cast(image, tf.float32) / 255., 0)
+    image = tf.image.resize(image, [image_height, image_width], method=tf.image.ResizeMethod.AREA)
+    model_intensities = [float(i) * 2 - 1 if normalized_input else float(i) for i in intensities]
+    if normalized_input:
+        image = image * 2 - 1
+    if split_generator(generator) is not None:
+        outputs = EncodedImages(generator, image).sweep(model_intensities)
+    else:
+        outputs = [generator((image, tf.reshape(intensity, (1, 1)))) for intensity in model_intensities]
+    if normalized_input:
+        outputs = [fog * 0.5 + 0.5 for fog in outputs]
+    return [tf.cast(tf.round(tf.clip_by_value(fog[0], 0., 1.) * 255.), tf.uint8) for fog in outputs]
@@ -0,0 +1,113 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.benchmark import transmission_map_loss_reference  # noqa: E402
+from lib.train import Trainer  # noqa: E402
+
+IMAGE_SIZE = 32
+BATCH_SIZES = [1, 4, 16]
+
+
+@pytest.fixture(scope='module')
+def trainer():
+    # Only the loss settings are used, the losses don't need the models
+    return Trainer(None, None, None, None)
+
+
+def random_batch(batch_size, seed):
+    rng = np.random.RandomState(seed)
+    shape = (batch_size, IMAGE_SIZE, IMAGE_SIZE, 3)
+    clear = rng.uniform(-1, 1, shape).astype(np.float32)
+    generated = rng.uniform(-1, 1, shape).astype(np.float32)
+    intensity = rng.uniform(-1, 1, (batch_size, 1)).astype(np.float32)
+    return clear, generated, intensity
+
+
+def transmission_map_loss_per_image(trainer, clear, generated, intensity):
+    if trainer.normalized_input:
+        intensity = intensity * 0.5 + 0.5
+    t = 1 - intensity
+    expected = np.stack([clear[i] * t[i] + (1 - t[i]) for i in range(clear.shape[0])])
+    return trainer.LAMBDA * abs(expected.mean() - generated.mean())
+
+
+def whitening_loss_per_image(trainer, clear, generated):
+    per_image = [np.maximum(clear[i] - generated[i], 0).mean() for i in range(clear.shape[0])]
+    return np.mean(per_image) * trainer.LAMBDA * trainer.LAMBDA_MULTIPLIER
+
+
+def rgb_ratio_loss_per_image(trainer, clear, generated):
+    rg_losses, gb_losses = [], []
+    for i in range(clear.shape[0]):
+        r, g, b = clear[i, :, :, 0], clear[i, :, :, 1], clear[i, :, :, 2]
+        # Same channels as `Trainer.rgb_ratio_loss`, whose b_hat is the green channel
+        r_hat, g_hat, b_hat = generated[i, :, :, 0], generated[i, :, :, 1], generated[i, :, :, 1]
+        rg_losses.append(np.abs(r * g_hat - g * r_hat).mean())
+        gb_losses.append(np.abs(g * b_hat - b * g_hat).mean())
+    return 0.5 * (np.mean(rg_losses) + np.mean(gb_losses)) * trainer.LAMBDA * trainer.LAMBDA_MULTIPLIER
+
+
+def identity_loss_per_image(trainer, real, same):
+    return trainer.LAMBDA * np.mean([np.abs(real[i] - same[i]).mean() for i in range(real.shape[0])])
+
+
+@pytest.mark.parametrize('batch_size', BATCH_SIZES)
+def test_transmission_map_loss(trainer, batch_size):
+    clear, generated, intensity = random_batch(batch_size, seed=batch_size)
+    loss = trainer.transmission_map_loss(tf.constant(clear), tf.constant(generated), tf.constant(intensity))
+    np.testing.assert_allclose(float(loss), transmission_map_loss_per_image(trainer, clear, generated, intensity),
+                               rtol=1e-5, atol=1e-6)
+    reference = transmission_map_loss_reference(trainer, tf.constant(clear), tf.constant(generated),
+                                                tf.constant(intensity))
+    np.testing.assert_allclose(float(loss), float(reference), rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize('batch_size', BATCH_SIZES)
+def test_whitening_loss(trainer, batch_size):
+    clear, generated, _ = random_batch(batch_size, seed=batch_size)
+    loss = trainer.whitening_loss(tf.constant(clear), tf.constant(generated))
+    np.testing.assert_allclose(float(loss), whitening_loss_per_image(trainer, clear, generated), rtol=1e-5)
+
+
+@pytest.mark.parametrize('batch_size', BATCH_SIZES)
+def test_rgb_ratio_loss(trainer, batch_size):
+    clear, generated, _ = random_batch(batch_size, seed=batch_size)
+    loss = trainer.rgb_ratio_loss(tf.constant(clear), tf.constant(generated))
+    np.testing.assert_allclose(float(loss), rgb_ratio_loss_per_image(trainer, clear, generated), rtol=1e-5)
+
+
+@pytest.mark.parametrize('batch_size', BATCH_SIZES)
+def test_identity_loss(trainer, batch_size):
+    real, same, _ = random_batch(batch_size, seed=batch_size)
+    loss = trainer.identity_loss(tf.constant(real), tf.constant(same))
+    np.testing.assert_allclose(float(loss), identity_loss_per_image(trainer, real, same), rtol=1e-5)
+
+
+def test_losses_traced_once_for_unknown_batch_size(trainer):
+    image_spec = tf.TensorSpec([None, IMAGE_SIZE, IMAGE_SIZE, 3], tf.float32)
+    intensity_spec = tf.TensorSpec([None, 1], tf.float32)
+    traces = []
+
+    @tf.function(input_signature=[image_spec, image_spec, intensity_spec])
+    def losses(clear, generated, intensity):
+        traces.append(1)
+        return (trainer.transmission_map_loss(clear, generated, intensity),
+                trainer.whitening_loss(clear, generated),
+                trainer.rgb_ratio_loss(clear, generated),
+                trainer.identity_loss(clear, generated))
+
+    for batch_size in BATCH_SIZES:
+        clear, generated, intensity = random_batch(batch_size, seed=batch_size)
+        values = [float(x) for x in losses(clear, generated, intensity)]
+        expected = [transmission_map_loss_per_image(trainer, clear, generated, intensity),
+                    whitening_loss_per_image(trainer, clear, generated),
+                    rgb_ratio_loss_per_image(trainer, clear, generated),
+                    identity_loss_per_image(trainer, clear, generated)]
+        np.testing.assert_allclose(values, expected, rtol=1e-5, atol=1e-6)
+    assert len(traces) == 1
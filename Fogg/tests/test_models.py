@@ -0,0 +1,39 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.models import IntensityDownsample, ModelsBuilder  # noqa: E402
+
+IMAGE_SIZE = 32
+
+
+def concat_outputs(block, image, intensity):
+    plane = tf.ones_like(image[..., :1]) * tf.reshape(intensity, [-1, 1, 1, 1])
+    return block(tf.concat([image, plane], axis=-1))
+
+
+@pytest.mark.parametrize('conv', [tf.keras.layers.Conv2D, tf.keras.layers.SeparableConv2D])
+@pytest.mark.parametrize('use_bias', [False, True])
+def test_intensity_downsample_matches_concatenation(conv, use_bias):
+    rng = np.random.RandomState(0)
+    image = rng.uniform(-1, 1, (3, IMAGE_SIZE, IMAGE_SIZE, 3)).astype(np.float32)
+    intensity = rng.uniform(-1, 1, (3, 1)).astype(np.float32)
+    block = tf.keras.Sequential([
+        conv(8, 4, strides=2, padding='same', use_bias=use_bias, bias_initializer='random_normal'),
+        tf.keras.layers.LeakyReLU()])
+    expected = concat_outputs(block, image, intensity)
+    folded = IntensityDownsample(block.layers)([image, intensity])
+    np.testing.assert_allclose(folded.numpy(), expected.numpy(), atol=1e-5)
+
+
+def test_concat_generator_folds_the_intensity():
+    generator = ModelsBuilder().build_generator()
+    folded = [layer for layer in generator.layers if isinstance(layer, IntensityDownsample)]
+    assert len(folded) == 1
+    # The kernel keeps the intensity channel, so the weights of the concatenation models still load
+    assert folded[0].layers[0].kernel.shape[2] == 4
@@ -10,6 +10,10 @@ from tkinter import ttk
 from pathlib import Path
 import time
 import threading
+import queue
+import glob
+import hashlib
+from collections import OrderedDict
 import tkinter.messagebox as messagebox
 
 
@@ -39,8 +43,180 @@ def ensure_directory(directory):
         os.makedirs(directory)
 
 
-ensure_directory("CycleGanImg")  # Ensure the CycleGanImg directory exists
-ensure_directory("FoggyImg")
+# The output directories are absolute, the jobs don't depend on the cwd
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+CYCLEGAN_IMG_DIR = os.path.join(APP_DIR, "CycleGanImg")  # Written by CycleGan/test.py
+FOGGY_IMG_DIR = os.path.join(APP_DIR, "FoggyImg")
+THUMBNAILS_DIR = os.path.join(APP_DIR, "Thumbnails")
+
+ensure_directory(CYCLEGAN_IMG_DIR)  # Ensure the CycleGanImg directory exists
+ensure_directory(FOGGY_IMG_DIR)
+
+
+class JobDispatcher:
+    """Runs jobs on a pool of worker threads and delivers their results on the Tk main thread.
+
+    Tk isn't thread safe: the workers only run the job functions and put the results in a queue, the main thread
+    drains it with `after()` and calls the callbacks, which are free to update widgets.
+    """
+
+    def __init__(self, widget, workers=4, poll_interval=50, max_results_per_poll=8):
+        self.widget = widget
+        self.poll_interval = poll_interval  # ms
+        # Bounds the time spent in callbacks per poll, the UI stays responsive when many jobs finish together
+        self.max_results_per_poll = max_results_per_poll
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        self.pending = {}  # Job key -> (on_done, on_error), only used on the main thread
+        for i in range(workers):
+            threading.Thread(target=self.work, name=f"job-worker-{i}", daemon=True).start()
+        self.widget.after(self.poll_interval, self.poll)
+
+    def submit(self, key, function, args=(), on_done=None, on_error=None):
+        """Queues function(*args), then on_done(result) or on_error(exception) is called on the main thread.
+
+        Returns False without queuing anything if a job with the same key is still pending.
+        """
+        if key in self.pending:
+            return False
+        self.pending[key] = (on_done, on_error)
+        self.jobs.put((key, function, args))
+        return True
+
+    def work(self):
+        while True:
+            key, function, args = self.jobs.get()
+            try:
+                self.results.put((key, function(*args), None))
+            except Exception as error:
+                self.results.put((key, None, error))
+
+    def poll(self):
+        for _ in range(self.max_results_per_poll):
+            try:
+                key, result, error = self.results.get_nowait()
+            except queue.Empty:
+                break
+            on_done, on_error = self.pending.pop(key)
+            try:
+                if error is None:
+                    if on_done is not None:
+                        on_done(result)
+                elif on_error is not None:
+                    on_error(error)
+                else:
+                    print(f"Job {key} failed: {error!r}")
+            except Exception as callback_error:
+                print(f"Callback of job {key} failed: {callback_error!r}")
+        self.widget.after(self.poll_interval, self.poll)
+
+
+def load_resized_image(image_path, size):
+    """Decodes and resizes an image off the main thread, the PhotoImage is created from it on the main thread."""
+    with Image.open(image_path) as image:
+        return image.convert("RGB").resize(size, Image.LANCZOS)
+
+
+class ThumbnailCache:
+    """Thumbnails of the generated images, keyed by (path, mtime, size) so a rewritten file gets a new thumbnail.
+
+    The recently used thumbnails are kept in memory (LRU), all of them are saved in cache_dir. Missing thumbnails
+    are read from the disk cache or decoded from the image on the workers of a JobDispatcher.
+    """
+
+    def __init__(self, widget, size=(400, 400), cache_dir=THUMBNAILS_DIR, max_items=128, workers=2):
+        self.size = size
+        self.cache_dir = cache_dir
+        self.max_items = max_items
+        self.memory = OrderedDict()  # Key -> PIL image, only used on the main thread
+        self.waiting = {}  # Key -> callbacks of the requests made while it's loading
+        self.jobs = JobDispatcher(widget, workers=workers)
+        # Path hash -> lock, the jobs writing the thumbnails of the same image run their file operations in turn
+        self.path_locks = {}
+        self.path_locks_lock = threading.Lock()
+        ensure_directory(cache_dir)
+
+    @staticmethod
+    def key(image_path):
+        stat = os.stat(image_path)
+        return os.path.abspath(image_path), stat.st_mtime_ns, stat.st_size
+
+    def request(self, key, on_done):
+        """Calls on_done(thumbnail) on the main thread, right away if the thumbnail is in memory."""
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            on_done(self.memory[key])
+        elif key in self.waiting:
+            self.waiting[key].append(on_done)
+        else:
+            self.waiting[key] = [on_done]
+            self.jobs.submit(
+                key,
+                self.load,
+                (key,),
+                on_done=lambda thumbnail: self.on_loaded(key, thumbnail),
+                on_error=lambda error: self.on_error(key, error),
+            )
+
+    def on_loaded(self, key, thumbnail):
+        self.memory[key] = thumbnail
+        while len(self.memory) > self.max_items:
+            self.memory.popitem(last=False)
+        for on_done in self.waiting.pop(key):
+            on_done(thumbnail)
+
+    def on_error(self, key, error):
+        # E.g. an image still being written, it gets a new key once complete
+        del self.waiting[key]
+        print(f"Thumbnail of {key[0]} failed: {error!r}")
+
+    def disk_path(self, key):
+        path, mtime, size = key
+        return os.path.join(self.cache_dir, f"{self.path_hash(path)}_{mtime}_{size}.jpg")
+
+    @staticmethod
+    def path_hash(path):
+        return hashlib.sha1(path.encode("utf-8")).hexdigest()
+
+    def path_lock(self, path_hash):
+        with self.path_locks_lock:
+            return self.path_locks.setdefault(path_hash, threading.Lock())
+
+    def remove_stale_thumbnails(self, key):
+        # On a worker, holding the lock of the image. Only the thumbnail of the current version of an image is kept
+        current_path = self.disk_path(key)
+        try:
+            current = self.key(key[0]) == key
+        except OSError:
+            current = False
+        if not current:
+            # The image was rewritten while this thumbnail was decoding, the job of its new version keeps its own
+            stale_paths = [current_path]
+        else:
+            pattern = os.path.join(glob.escape(self.cache_dir), f"{self.path_hash(key[0])}_*.jpg")
+            stale_paths = [path for path in glob.glob(pattern)
+                           if os.path.normcase(path) != os.path.normcase(current_path)]
+        for stale_path in stale_paths:
+            try:
+                os.remove(stale_path)
+            except OSError:
+                pass
+
+    def load(self, key):
+        # On a worker thread
+        disk_path = self.disk_path(key)
+        if os.path.isfile(disk_path):
+            with Image.open(disk_path) as thumbnail:
+                thumbnail.load()
+                return thumbnail.copy()
+        thumbnail = load_resized_image(key[0], self.size)
+        # Only newly decoded thumbnails write and clean up the disk cache, the disk cache hits don't touch it
+        with self.path_lock(self.path_hash(key[0])):
+            temp_path = disk_path + ".tmp"
+            thumbnail.save(temp_path, format="JPEG", quality=90)
+            os.replace(temp_path, disk_path)
+            self.remove_stale_thumbnails(key)
+        return thumbnail
 
 
 class ImageSelectionPage(tk.Frame):
@@ -259,13 +435,13 @@ class ImageDisplayPage(tk.Frame):
 
         self.duplicate_image_label = tk.Label(self.right_panel, bg="#f5f5f5")
         self.duplicate_image_label.pack(expand=True)
-        self.model_threads = {}  # Dictionary to store threads
         self.model_type = None
         # Storing current image path for operations
         self.current_image_path = ""
         self.start_time = time.time()
-        # Semaphore to limit the number of active threads
-        self.thread_semaphore = threading.Semaphore(4)
+        # Jobs submitted to the dispatcher of the application and not finished yet
+        self.running_jobs = 0
+        self.fog_lock = threading.Lock()
         # Start the timer
         self.update_timer()
         print(f" print wk from tkinter app {os.getcwd()}")
@@ -281,7 +457,7 @@ class ImageDisplayPage(tk.Frame):
         ):
             # If the page doesn't exist, create it
             self.master.pages["recent_generations"] = DisplayGanifiedImages(
-                self.master, self.master.go_back, ["./FoggyImg", "./CycleGanImg"]
+                self.master, self.master.go_back, [FOGGY_IMG_DIR, CYCLEGAN_IMG_DIR]
             )
 
         # Switch to the 'recent_generations' page
@@ -324,68 +500,71 @@ class ImageDisplayPage(tk.Frame):
         # Add your existing setup code or image display logic here
         self.display_image(image_path)
 
-    def apply_fog(self):
-        if self.current_image_path:
-            fogged_image_path = add_fog(self.current_image_path)
-            image = Image.open(fogged_image_path)
-            image = image.resize((600, 600), Image.LANCZOS)
-            photo = ImageTk.PhotoImage(image)
-            # Complete the progress when done
-            self.update_progress(100 - self.progress["value"])
-            self.duplicate_image_label.config(image=photo)
-            self.duplicate_image_label.image = photo
+    # The apply_* functions run on the worker threads of the JobDispatcher, they must not touch Tk
 
-    def apply_model(self, model_type):
-        if self.current_image_path:
-            cyclegan(model_type, self.current_image_path)
-            image_filename = (
-                f"{Path(self.current_image_path).stem}_result_{model_type}.jpg"
-            )
-            output_image_path = f"./CycleGanImg/{image_filename}"
-            # Wait until the file is created
-            while not os.path.exists(output_image_path):
-                time.sleep(0.1)  # Adjust the sleep interval as needed
-            image = Image.open(output_image_path)
-            image = image.resize((600, 600), Image.LANCZOS)
-            photo = ImageTk.PhotoImage(image)
+    def apply_fog(self, image_path):
+        # The fog figure is drawn with pyplot, which isn't thread safe
+        with self.fog_lock:
+            fogged_image_path = add_fog(image_path, save_directory=FOGGY_IMG_DIR)
+        return load_resized_image(fogged_image_path, (600, 600))
+
+    def apply_model(self, model_type, image_path):
+        # cyclegan() returns once test.py has written the output image
+        cyclegan(model_type, image_path)
+        output_image_path = os.path.join(
+            CYCLEGAN_IMG_DIR, f"{Path(image_path).stem}_result_{model_type}.jpg"
+        )
+        return load_resized_image(output_image_path, (600, 600))
+
+    # Callbacks of the jobs, on the main thread
+
+    def on_job_done(self, model_type, image_path, image):
+        self.running_jobs -= 1
+        if self.running_jobs == 0:
             # Complete the progress when done
             self.update_progress(100 - self.progress["value"])
-            # Update the display with the new image
+        # The user may have selected another image in the meantime
+        if image_path == self.current_image_path:
+            photo = ImageTk.PhotoImage(image)
             self.duplicate_image_label.config(image=photo)
             self.duplicate_image_label.image = photo
+        if model_type != "fogg":
             self.show_task_complete_popup(model_type)
-            # Remove the thread from the dictionary once completed
-            del self.model_threads[model_type]
-            # Release the semaphore to allow another thread to start
-            self.thread_semaphore.release()
+
+    def on_job_error(self, model_type, error):
+        self.running_jobs -= 1
+        if self.running_jobs == 0:
+            self.progress["value"] = 0
+        messagebox.showerror("Error", f"Applying {model_type} failed: {error}")
 
     def threaded_apply_model(self, model_type):
-        # Reset progress bar
-        self.progress["value"] = 0
-        self.update_progress(5)  # Initial quick update for better UX
-        if model_type == "fogg":
-            threading.Thread(target=self.apply_fog, daemon=True).start()
-        else:
-            # Acquire the semaphore before starting the thread
-            if self.thread_semaphore.acquire(blocking=False):
-                # Start the thread for applying the model
-                thread = threading.Thread(
-                    target=self.apply_model, args=(model_type,), daemon=True
-                )
-                self.model_threads[model_type] = (
-                    thread  # Store the thread in the dictionary
-                )
-                thread.start()
-            else:
-                messagebox.showinfo("Info", "Maximum number of threads reached.")
+        if not self.current_image_path:
+            return
+        image_path = self.current_image_path
+        function = self.apply_fog if model_type == "fogg" else self.apply_model
+        args = (image_path,) if model_type == "fogg" else (model_type, image_path)
+        submitted = self.master.jobs.submit(
+            (model_type, image_path),
+            function,
+            args,
+            on_done=lambda image: self.on_job_done(model_type, image_path, image),
+            on_error=lambda error: self.on_job_error(model_type, error),
+        )
+        if not submitted:
+            messagebox.showinfo("Info", "This transformation is already running.")
+            return
+        self.running_jobs += 1
+        if self.running_jobs == 1:
+            # Reset progress bar, a single progress loop runs while jobs are running
+            self.progress["value"] = 0
+            self.update_progress(5)  # Initial quick update for better UX
 
     def update_progress(self, increment):
         # Incrementally update the progress bar
         self.progress["value"] += increment
-        self.update_idletasks()  # Update the UI thread
         if self.progress["value"] >= 100:
             self.progress["value"] = 100  # Cap the progress bar
-        else:
+        elif self.running_jobs:
             # Schedule another update
             self.after(1000, lambda: self.update_progress(increment))
 
@@ -397,6 +576,16 @@ class ImageDisplayPage(tk.Frame):
 
 
 class DisplayGanifiedImages(tk.Frame):
+    """Gallery of the recent generations.
+
+    The grid is virtualized: only the rows near the viewport have widgets, they are created from the thumbnail
+    cache when they scroll into view and destroyed, with their PhotoImage, when they scroll out of it.
+    """
+
+    COLUMNS = 2
+    ROW_HEIGHT = 480  # 400 px thumbnail, its label and the paddings
+    OVERSCAN_ROWS = 1  # Rows materialized above and below the viewport
+
     def __init__(self, master, on_go_back, recent_folders):
         super().__init__(master, bg="lightgreen")
         self.master.title("View Recent Generations")
@@ -408,18 +597,12 @@ class DisplayGanifiedImages(tk.Frame):
         self.scrollbar = tk.Scrollbar(
             self, orient="vertical", command=self.canvas.yview
         )
-        self.scrollable_frame = tk.Frame(self.canvas, bg="lightgreen")
         self.ribbon_frame = tk.Frame(self, bg="#e1e1e1", height=12)
         self.ribbon_frame.pack(side="bottom", fill="x", expand=False)
-        self.canvas.configure(yscrollcommand=self.scrollbar.set)
-        self.canvas_frame = self.canvas.create_window(
-            (0, 0),
-            window=self.scrollable_frame,
-            anchor="nw",
-        )
+        # Every change of the view, from the scrollbar or not, goes through on_canvas_scroll
+        self.canvas.configure(yscrollcommand=self.on_canvas_scroll)
         self.scrollbar.pack(side="right", fill="y")
         self.canvas.pack(side="left", fill="both", expand=True)
-        self.scrollable_frame.bind("<Configure>", self.on_frame_configure)
         self.canvas.bind("<Configure>", self.on_canvas_configure)
 
         self.back_button = tk.Button(
@@ -431,25 +614,68 @@ class DisplayGanifiedImages(tk.Frame):
         )
         self.back_button.pack(side="bottom", fill="x", padx=10, pady=10)
 
-        self.loaded_images = []
+        self.thumbnails = ThumbnailCache(self)
+        # Shown until the thumbnail is loaded, so the grid doesn't move
+        self.placeholder = tk.PhotoImage(width=400, height=400)
+        self.recent_images = []  # (image path, thumbnail key) of every recent image, in display order
+        self.image_frames = {}  # (image path, thumbnail key) -> (canvas window, frame) of the materialized images
+        self.update_scheduled = False
         self.bind("<Visibility>", lambda event: self.reload_images())
 
     def reload_images(self):
-        self.clear_images()
-        self.load_and_display_images()
-
-    def clear_images(self):
-        for widget in self.scrollable_frame.winfo_children():
-            widget.destroy()
-        self.loaded_images.clear()
-
-    def load_and_display_images(self):
-        recent_images = self.find_recent_images()
-        self.loaded_images.clear()
-        for image_path in recent_images:
-            image = Image.open(image_path)
-            photo = ImageTk.PhotoImage(image.resize((400, 400), Image.LANCZOS))
-            self.add_image_to_display(photo, image_path)
+        """Updates the list of recent images, the widgets are only created for the rows in view."""
+        self.recent_images = []
+        for image_path in self.find_recent_images():
+            try:
+                self.recent_images.append((image_path, ThumbnailCache.key(image_path)))
+            except OSError:  # Deleted in the meantime
+                pass
+        rows = -(-len(self.recent_images) // self.COLUMNS)
+        self.canvas.configure(
+            scrollregion=(0, 0, self.canvas.winfo_width(), rows * self.ROW_HEIGHT)
+        )
+        self.update_visible_images()
+
+    def visible_rows(self):
+        top = self.canvas.canvasy(0)
+        bottom = self.canvas.canvasy(self.canvas.winfo_height())
+        first_row = max(0, int(top // self.ROW_HEIGHT) - self.OVERSCAN_ROWS)
+        last_row = int(bottom // self.ROW_HEIGHT) + self.OVERSCAN_ROWS
+        return first_row, last_row
+
+    def update_visible_images(self):
+        """Creates the widgets of the rows near the viewport and destroys the others."""
+        self.update_scheduled = False
+        first_row, last_row = self.visible_rows()
+        first_index = first_row * self.COLUMNS
+        last_index = min(len(self.recent_images), (last_row + 1) * self.COLUMNS)
+        visible = {
+            self.recent_images[index]: index for index in range(first_index, last_index)
+        }
+        for image, (window, frame) in list(self.image_frames.items()):
+            if image not in visible:
+                self.canvas.delete(window)
+                frame.destroy()
+                del self.image_frames[image]
+        for image, index in visible.items():
+            x, y = self.image_position(index)
+            if image in self.image_frames:
+                self.canvas.coords(self.image_frames[image][0], x, y)
+            else:
+                frame = self.display_image(*image)
+                window = self.canvas.create_window(x, y, window=frame, anchor="n")
+                self.image_frames[image] = (window, frame)
+
+    def schedule_update(self):
+        # Coalesces the scroll events of a frame into one update
+        if not self.update_scheduled:
+            self.update_scheduled = True
+            self.after_idle(self.update_visible_images)
+
+    def image_position(self, index):
+        row, column = divmod(index, self.COLUMNS)
+        column_width = self.canvas.winfo_width() / self.COLUMNS
+        return column_width * (column + 0.5), row * self.ROW_HEIGHT + 10
 
     def find_recent_images(self):
         recent_images = []
@@ -468,22 +694,18 @@ class DisplayGanifiedImages(tk.Frame):
                             recent_images.append(filepath)
         return recent_images
 
-    def add_image_to_display(self, photo, image_path):
-        if len(self.loaded_images) % 2 == 0:
-            self.row_frame = tk.Frame(self.scrollable_frame, bg="lightgreen")
-            self.row_frame.pack(fill="x", expand=True)
-        self.loaded_images.append((photo, image_path))
-        self.display_image(photo, self.row_frame, os.path.basename(image_path))
-
-    def display_image(self, photo, parent_frame, filename):
+    def display_image(self, image_path, key):
         image_frame = tk.Frame(
-            parent_frame,
+            self.canvas,
             bg="#2EF3FF",
         )
-        image_widget = tk.Label(image_frame, image=photo, bg="yellow")
-        image_widget.image = photo  # Keep a reference to avoid garbage collection
+        image_widget = tk.Label(image_frame, image=self.placeholder, bg="yellow")
         image_widget.pack(padx=10, pady=10)
+        self.thumbnails.request(
+            key, lambda thumbnail: self.show_thumbnail(image_widget, thumbnail)
+        )
 
+        filename = os.path.basename(image_path)
         fname = filename.split("_")
         if len(fname) > 2:
             transformation_name = fname[2][:-4].upper()
@@ -497,14 +719,27 @@ class DisplayGanifiedImages(tk.Frame):
             font=("Helvetica", 12, "bold"),
         )
         label.pack()
+        return image_frame
 
-        image_frame.pack(side="left", expand=True, padx=20, pady=10, anchor="n")
+    def show_thumbnail(self, image_widget, thumbnail):
+        # The frame may have been removed while the thumbnail was loading
+        if image_widget.winfo_exists():
+            photo = ImageTk.PhotoImage(thumbnail)
+            image_widget.config(image=photo)
+            image_widget.image = photo  # Keep a reference to avoid garbage collection
 
-    def on_frame_configure(self, event):
-        self.canvas.configure(scrollregion=self.canvas.bbox("all"))
+    def on_canvas_scroll(self, first, last):
+        self.scrollbar.set(first, last)
+        self.schedule_update()
 
     def on_canvas_configure(self, event):
-        self.canvas.itemconfig(self.canvas_frame, width=event.width)
+        # The columns follow the width of the canvas
+        scrollregion = self.canvas.cget("scrollregion").split()
+        if scrollregion:
+            self.canvas.configure(
+                scrollregion=(0, 0, event.width, scrollregion[3])
+            )
+        self.schedule_update()
 
 
 class MainApplication(TkinterDnD.Tk):
@@ -513,6 +748,8 @@ class MainApplication(TkinterDnD.Tk):
         self.geometry("2100x900")
         self.resizable(False, False)
         self.page_stack = []
+        # Inference jobs of all the pages, their results are delivered on the main thread
+        self.jobs = JobDispatcher(self)
         self.init_methods()
         self.init_pages()
 
@@ -553,7 +790,7 @@ class MainApplication(TkinterDnD.Tk):
                 self.pages[page_name] = ImageDisplayPage(self, self.go_back)
             elif page_name == "recent_generations":
                 self.pages[page_name] = DisplayGanifiedImages(
-                    self, self.go_back, ["FoggyImg", "CycleGanImg"]
+                    self, self.go_back, [FOGGY_IMG_DIR, CYCLEGAN_IMG_DIR]
                 )
 
         self.current_page = self.pages[page_name]